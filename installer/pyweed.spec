@@ -8,7 +8,7 @@ ONE_FILE = True
 a = Analysis(['../pyweed/pyweed_launcher.py'],
              pathex=['/workspace/test/pyweed/installer'],
              binaries=[],
-             datas=[],
+             datas=[('../pyweed/data/*.npz', 'pyweed/data')],
              hiddenimports=['ipykernel.datapub'],
              hookspath=['hooks'],
              runtime_hooks=['rthooks/qtconsole.py', 'rthooks/obspy.py'],
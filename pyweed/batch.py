@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Headless batch downloads.
+
+Runs a complete PyWEED request from a job spec file without any display: fetch events, fetch
+stations, pair them up, download the waveforms (into the usual download cache) and save them.
+Progress is written to stdout as one JSON object per line, so it can be monitored by a script.
+
+The job spec is a JSON file like::
+
+    {
+        "events": {"starttime": "2024-01-01", "endtime": "2024-02-01", "minmagnitude": 6},
+        "stations": {"network": "IU", "channel": "BHZ"},
+        "time_window": {"start_offset": 60, "end_offset": 600,
+                        "start_phase": "P", "end_phase": "P"},
+        "output_format": "MSEED",
+        "output_dir": "/data/harvest"
+    }
+
+`events` and `stations` take the same options as `EventOptions` and `StationOptions`. Anything
+not given in the spec is taken from the user's PyWEED preferences.
+
+:copyright:
+    Mazama Science, IRIS
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import json
+import logging
+import sys
+import time
+import matplotlib
+from PyQt5 import QtCore
+from pyweed.preferences import safe_bool, safe_int
+from pyweed.pyweed_core import PyWeedCore
+from pyweed.pyweed_utils import (
+    OUTPUT_FORMAT_EXTENSIONS,
+    PHASES,
+    DataRequest,
+    TimeWindow,
+    get_sncl,
+    iter_channels,
+)
+from pyweed.waveforms_handler import WaveformsHandler
+
+LOGGER = logging.getLogger(__name__)
+
+# Keys allowed in the job spec
+JOB_KEYS = (
+    "events",
+    "stations",
+    "time_window",
+    "output_format",
+    "output_dir",
+    "download_metadata",
+    "use_event_time",
+    "event_data_center",
+    "station_data_center",
+)
+TIME_WINDOW_KEYS = ("start_offset", "end_offset", "start_phase", "end_phase")
+
+# Exit codes
+EXIT_OK = 0
+EXIT_ERRORS = 1
+EXIT_FAILED = 2
+
+
+class JobError(Exception):
+    """
+    Raised for an invalid job spec
+    """
+
+
+def check_job(job):
+    """
+    Check that a job spec is valid, raising a `JobError` if not.
+
+    >>> check_job({"output_format": "MSEED"})
+    >>> check_job({"output_format": "WAV"})
+    Traceback (most recent call last):
+    ...
+    pyweed.batch.JobError: Unknown output format: WAV
+    """
+    if not isinstance(job, dict):
+        raise JobError("Job spec must be a JSON object")
+    unknown = sorted(set(job) - set(JOB_KEYS))
+    if unknown:
+        raise JobError("Unknown job settings: %s" % ", ".join(unknown))
+    for key in ("events", "stations", "time_window"):
+        if not isinstance(job.get(key, {}), dict):
+            raise JobError("%s must be a JSON object" % key)
+    time_window = job.get("time_window", {})
+    unknown = sorted(set(time_window) - set(TIME_WINDOW_KEYS))
+    if unknown:
+        raise JobError("Unknown time window settings: %s" % ", ".join(unknown))
+    phases = [phase.name for phase in PHASES]
+    for key in ("start_phase", "end_phase"):
+        if key in time_window and time_window[key] not in phases:
+            raise JobError("Unknown phase: %s" % time_window[key])
+    for key in ("start_offset", "end_offset"):
+        if key in time_window:
+            try:
+                float(time_window[key])
+            except (TypeError, ValueError):
+                raise JobError("Invalid %s: %s" % (key, time_window[key]))
+    output_format = job.get("output_format")
+    if output_format and output_format not in OUTPUT_FORMAT_EXTENSIONS:
+        raise JobError("Unknown output format: %s" % output_format)
+
+
+def read_job(path):
+    """
+    Read and check a job spec file ("-" reads from stdin)
+    """
+    try:
+        if path == "-":
+            job = json.load(sys.stdin)
+        else:
+            with open(path) as f:
+                job = json.load(f)
+    except (OSError, ValueError) as e:
+        raise JobError("Couldn't read job spec %s: %s" % (path, e))
+    check_job(job)
+    return job
+
+
+class ProgressReporter(object):
+    """
+    Writes progress messages as JSON lines
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self.start = time.monotonic()
+
+    def report(self, stage, status, **values):
+        message = dict(
+            time=time.strftime("%Y-%m-%dT%H:%M:%S"),
+            elapsed=round(time.monotonic() - self.start, 3),
+            stage=stage,
+            status=status,
+        )
+        message.update(values)
+        self.stream.write(json.dumps(message, default=str) + "\n")
+        self.stream.flush()
+
+
+def wait_for(signal, start):
+    """
+    Call `start` and run a Qt event loop until `signal` is emitted, returning the emitted value.
+    The loaders deliver their results through queued signals, so they need an event loop running.
+    """
+    loop = QtCore.QEventLoop()
+    results = []
+
+    def on_done(result):
+        results.append(result)
+        loop.quit()
+
+    signal.connect(on_done)
+    try:
+        start()
+        if not results:
+            loop.exec_()
+    finally:
+        signal.disconnect(on_done)
+    return results[0]
+
+
+class BatchRunner(object):
+    """
+    Runs a job spec through `PyWeedCore`
+    """
+
+    def __init__(self, pyweed, job, reporter):
+        self.pyweed = pyweed
+        self.job = job
+        self.reporter = reporter
+
+    def configure(self):
+        """
+        Apply the job spec on top of the preferences
+        """
+        prefs = self.pyweed.preferences
+        job = self.job
+        if job.get("event_data_center") or job.get("station_data_center"):
+            prefs.Data.eventDataCenter = job.get(
+                "event_data_center", prefs.Data.eventDataCenter
+            )
+            prefs.Data.stationDataCenter = job.get(
+                "station_data_center", prefs.Data.stationDataCenter
+            )
+            self.pyweed.initialize_clients()
+        self.pyweed.set_event_options(job.get("events", {}))
+        self.pyweed.set_station_options(job.get("stations", {}))
+        if "use_event_time" in job:
+            prefs.Waveforms.useEventTime = "y" if job["use_event_time"] else "n"
+
+    def get_time_window(self):
+        prefs = self.pyweed.preferences.Waveforms
+        values = self.job.get("time_window", {})
+        return TimeWindow(
+            float(values.get("start_offset", safe_int(prefs.timeWindowBefore, 60))),
+            float(values.get("end_offset", safe_int(prefs.timeWindowAfter, 600))),
+            values.get("start_phase", prefs.timeWindowBeforePhase),
+            values.get("end_phase", prefs.timeWindowAfterPhase),
+        )
+
+    def fetch_events(self):
+        pyweed = self.pyweed
+        self.reporter.report("events", "started")
+        request = DataRequest(
+            pyweed.client_manager.event_client,
+            pyweed.event_options.get_obspy_options(),
+        )
+        events = wait_for(
+            pyweed.events_handler.done,
+            lambda: pyweed.events_handler.load_catalog(request),
+        )
+        if isinstance(events, Exception):
+            raise events
+        pyweed.set_selected_event_ids(set(event.resource_id.id for event in events))
+        self.reporter.report("events", "done", count=len(events))
+
+    def fetch_stations(self):
+        pyweed = self.pyweed
+        self.reporter.report("stations", "started")
+        stations = wait_for(pyweed.stations_handler.done, pyweed.fetch_stations)
+        if isinstance(stations, Exception):
+            raise stations
+        pyweed.set_selected_station_ids(
+            set(
+                get_sncl(network, station, channel)
+                for network, station, channel in iter_channels(stations)
+            )
+        )
+        self.reporter.report("stations", "done", count=len(pyweed.selected_station_ids))
+
+    def download_waveforms(self, handler):
+        self.reporter.report("waveforms", "started", count=len(handler.waveforms))
+        progress = {"completed": 0, "errors": 0}
+
+        def on_progress(results):
+            progress["completed"] += len(results)
+            for result in results:
+                waveform = handler.get_waveform(result.waveform_id)
+                if waveform and waveform.error:
+                    progress["errors"] += 1
+            self.reporter.report(
+                "waveforms", "progress", total=len(handler.waveforms), **progress
+            )
+
+        def on_status(depths):
+            self.reporter.report(
+                "waveforms",
+                "pipeline",
+                stages=[
+                    dict(name=name, queued=queued, active=active)
+                    for (name, queued, active) in depths
+                ],
+            )
+
+        handler.progress.connect(on_progress)
+        handler.status.connect(on_status)
+        waveform_ids = [waveform.waveform_id for waveform in handler.waveforms]
+        result = wait_for(
+            handler.done,
+            lambda: handler.download_waveforms(
+                waveform_ids,
+                [],
+                self.get_time_window(),
+                self.job.get("download_metadata", True),
+            ),
+        )
+        if isinstance(result, Exception):
+            raise result
+        self.reporter.report("waveforms", "done", **progress)
+
+    def save_waveforms(self, handler):
+        prefs = self.pyweed.preferences.Waveforms
+        output_dir = self.job.get("output_dir") or prefs.saveDir
+        output_format = self.job.get("output_format") or prefs.saveFormat
+        waveforms = [
+            waveform
+            for waveform in handler.waveforms
+            if waveform.keep and waveform.mseed_exists
+        ]
+        self.reporter.report(
+            "save",
+            "started",
+            count=len(waveforms),
+            output_dir=output_dir,
+            output_format=output_format,
+        )
+        counts = {"saved": 0, "skipped": 0, "errors": 0}
+
+        def on_progress(results):
+            for result in results:
+                if isinstance(result.result, Exception):
+                    counts["errors"] += 1
+                    self.reporter.report(
+                        "save",
+                        "error",
+                        waveform_id=result.waveform_id,
+                        error=str(result.result),
+                    )
+                elif result.result:
+                    counts["saved"] += 1
+                else:
+                    counts["skipped"] += 1
+            self.reporter.report("save", "progress", total=len(waveforms), **counts)
+
+        handler.save_progress.connect(on_progress)
+        result = wait_for(
+            handler.save_done,
+            lambda: handler.save_waveforms(
+                output_dir,
+                output_format,
+                waveforms,
+                safe_bool(prefs.useEventTime),
+            ),
+        )
+        if isinstance(result, Exception):
+            raise result
+        self.reporter.report("save", "done", **counts)
+        return counts["errors"]
+
+    def run(self):
+        """
+        Run the job, returning the exit code
+        """
+        try:
+            self.configure()
+            self.fetch_events()
+            self.fetch_stations()
+            handler = WaveformsHandler(LOGGER, self.pyweed)
+            handler.create_waveforms()
+            if not handler.waveforms:
+                self.reporter.report("waveforms", "done", completed=0, errors=0)
+                return EXIT_OK
+            self.download_waveforms(handler)
+            errors = self.save_waveforms(handler)
+        except Exception as e:
+            LOGGER.error("Batch job failed: %s", e, exc_info=True)
+            self.reporter.report("job", "failed", error=str(e))
+            return EXIT_FAILED
+        finally:
+            self.pyweed.manage_cache(init=False)
+            if self.pyweed.cache_index:
+                self.reporter.report(
+                    "cache", "stats", **self.pyweed.cache_index.get_stats()
+                )
+        self.reporter.report("job", "done", errors=errors)
+        return EXIT_ERRORS if errors else EXIT_OK
+
+
+def main(argv=None):
+    """
+    Entry point for the `pyweed-batch` command
+    """
+    parser = argparse.ArgumentParser(
+        description="Download and save waveforms with PyWEED, without the GUI"
+    )
+    parser.add_argument("job", help='job spec (JSON) file, or "-" to read from stdin')
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="log to stderr as well as the PyWEED log file",
+    )
+    args = parser.parse_args(argv)
+
+    reporter = ProgressReporter()
+    try:
+        job = read_job(args.job)
+    except JobError as e:
+        reporter.report("job", "failed", error=str(e))
+        return EXIT_FAILED
+
+    # There's no display, so make sure nothing tries to use one (Qt is only used for its event
+    # loop and signals, which don't need one)
+    matplotlib.use("AGG")
+
+    app = QtCore.QCoreApplication.instance() or QtCore.QCoreApplication(sys.argv[:1])
+    pyweed = PyWeedCore()
+    if args.verbose:
+        handler = logging.StreamHandler()
+        handler.setFormatter(
+            logging.Formatter("%(asctime)s - %(levelname)s - %(name)s - %(message)s")
+        )
+        logging.getLogger().addHandler(handler)
+    try:
+        exit_code = BatchRunner(pyweed, job, reporter).run()
+    finally:
+        pyweed.close(save_preferences=False)
+    app.quit()
+    return exit_code
+
+
+# ------------------------------------------------------------------------------
+# Main
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+"""
+Index of the files in the waveform download cache.
+
+The index is kept in an SQLite database in the cache directory, recording the size and last use of
+every file the loaders write. This replaces walking and statting the whole directory (which is very
+slow for a large cache) and relying on file access times (which many filesystems don't keep):
+
+- Lookups are answered from memory, so checking for a cached file is O(1).
+- The least recently used files can be found without looking at every file, so eviction only
+  touches the files it removes.
+
+A lookup that misses still checks the filesystem, and adds the file if it's there, so the index
+catches up with files written by other means (eg. an older version of PyWEED, or another process
+sharing the cache).
+
+:copyright:
+    Mazama Science, IRIS
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+
+import os
+import sqlite3
+import threading
+import time
+import weakref
+from logging import getLogger
+
+LOGGER = getLogger(__name__)
+
+# Index database, in the cache directory (the leading "." keeps it out of the index itself)
+INDEX_FILENAME = ".pyweed_cache.sqlite"
+# Version of the database schema, an index with a different version is rebuilt
+SCHEMA_VERSION = 1
+# How often (in seconds) changes are committed to the database
+COMMIT_INTERVAL = 5.0
+# Number of files to evict at a time
+EVICT_BATCH = 1000
+# Fraction of the maximum size at which `CacheEvictor` starts removing files
+HIGH_WATERMARK = 1.0
+# Fraction of the maximum size `CacheEvictor` removes files down to
+LOW_WATERMARK = 0.8
+# How often (in seconds) `CacheEvictor` checks the cache size
+EVICT_INTERVAL = 2.0
+
+
+class CacheIndex(object):
+    """
+    Index of the files in a cache directory. This is safe to use from multiple threads.
+    """
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.path = os.path.join(self.directory, INDEX_FILENAME)
+        self.lock = threading.RLock()
+        #: Size of each file in the index, by name
+        self.files = {}
+        self.total_size = 0
+        # Last use times that haven't been written to the database yet
+        self.pending_uses = {}
+        self.last_commit = time.monotonic()
+        # Functions returning paths that mustn't be evicted, see `add_pins`
+        self.pins = []
+        # Statistics, see `get_stats`
+        self.hits = 0
+        self.misses = 0
+        self.evicted_files = 0
+        self.evicted_bytes = 0
+        self.db = None
+        self.open()
+
+    def open(self):
+        """
+        Open the index database, creating (or recreating) it if necessary
+        """
+        try:
+            self.connect()
+        except sqlite3.DatabaseError as e:
+            LOGGER.warning(
+                "Cache index %s is unusable, rebuilding it: %s", self.path, e
+            )
+            self.remove_database()
+            self.connect()
+
+    def connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            (version,) = db.execute("PRAGMA user_version").fetchone()
+            if version != SCHEMA_VERSION:
+                db.execute("DROP TABLE IF EXISTS files")
+                db.execute(
+                    "CREATE TABLE files ("
+                    "name TEXT PRIMARY KEY, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+                )
+                db.execute("CREATE INDEX files_last_used ON files (last_used)")
+                db.execute("PRAGMA user_version=%d" % SCHEMA_VERSION)
+                db.commit()
+                self.db = db
+                self.rebuild()
+            else:
+                self.db = db
+                self.files = dict(db.execute("SELECT name, size FROM files"))
+                self.total_size = sum(self.files.values())
+        except BaseException:
+            self.db = None
+            db.close()
+            raise
+        LOGGER.info(
+            "Cache index has %d files (%.0f megabytes)",
+            len(self.files),
+            self.total_size / 1000000,
+        )
+
+    def remove_database(self):
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(self.path + suffix)
+            except FileNotFoundError:
+                pass
+
+    def rebuild(self):
+        """
+        Rebuild the index from the files in the directory. The last use of each file is taken to
+        be its modification time.
+        """
+        LOGGER.info("Building the cache index for %s", self.directory)
+        with self.lock:
+            rows = []
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    # Skip hidden files (including partially written ones)
+                    if entry.name.startswith(".") or not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    rows.append((entry.name, stat.st_size, stat.st_mtime))
+            self.db.execute("DELETE FROM files")
+            self.db.executemany("INSERT INTO files VALUES (?, ?, ?)", rows)
+            self.db.commit()
+            self.files = dict((name, size) for (name, size, _used) in rows)
+            self.total_size = sum(self.files.values())
+            self.pending_uses = {}
+
+    def get_name(self, path):
+        """
+        Get the name for a path in the index
+        """
+        (directory, name) = os.path.split(path)
+        if directory != self.directory:
+            name = os.path.relpath(path, self.directory)
+        return name
+
+    def lookup(self, path):
+        """
+        Check whether the given file is in the cache, and if so record that it was used
+        """
+        name = self.get_name(path)
+        with self.lock:
+            if name in self.files:
+                self.hits += 1
+                self.pending_uses[name] = time.time()
+                self.maybe_commit()
+                return True
+        # See if the file was added some other way
+        if os.path.exists(path):
+            self.add(path)
+            with self.lock:
+                self.hits += 1
+            return True
+        with self.lock:
+            self.misses += 1
+        return False
+
+    def add(self, path, size=None):
+        """
+        Record a file that was just written to the cache
+        """
+        name = self.get_name(path)
+        if size is None:
+            size = os.path.getsize(path)
+        with self.lock:
+            self.total_size += size - self.files.get(name, 0)
+            self.files[name] = size
+            self.pending_uses.pop(name, None)
+            self.db.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?)",
+                (name, size, time.time()),
+            )
+            self.maybe_commit()
+
+    def remove(self, path):
+        """
+        Remove a file from the cache (and the index)
+        """
+        name = self.get_name(path)
+        with self.lock:
+            self.forget([name])
+            self.maybe_commit()
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            pass
+
+    def forget(self, names):
+        """
+        Remove entries from the index, must be called with the lock held
+        """
+        for name in names:
+            self.total_size -= self.files.pop(name, 0)
+            self.pending_uses.pop(name, None)
+        self.db.executemany("DELETE FROM files WHERE name = ?", ((n,) for n in names))
+
+    def add_pins(self, fn):
+        """
+        Protect files from eviction.
+
+        :param fn: a method returning a list of paths that are still in use, this is called whenever
+            files are evicted. Only a weak reference is kept, so the pins go away along with the
+            method's object.
+        """
+        with self.lock:
+            self.pins.append(weakref.WeakMethod(fn))
+
+    def get_pinned(self):
+        """
+        Get the names of all the files that mustn't be evicted
+        """
+        with self.lock:
+            self.pins = [ref for ref in self.pins if ref() is not None]
+            pins = [ref() for ref in self.pins]
+        pinned = set()
+        for fn in pins:
+            if fn:
+                pinned.update(self.get_name(path) for path in fn())
+        return pinned
+
+    def evict(self, max_size):
+        """
+        Remove the least recently used files until the cache is no larger than max_size (in bytes),
+        skipping any pinned files. Returns the number of files removed.
+        """
+        pinned = self.get_pinned()
+        # Pick the files to remove
+        with self.lock:
+            self.commit()
+            remaining = self.total_size
+            victims = []
+            cursor = self.db.execute("SELECT name, size FROM files ORDER BY last_used")
+            while remaining > max_size:
+                rows = cursor.fetchmany(EVICT_BATCH)
+                if not rows:
+                    break
+                for name, size in rows:
+                    if remaining <= max_size:
+                        break
+                    if name not in pinned:
+                        victims.append((name, size))
+                        remaining -= size
+            cursor.close()
+        # Remove them a batch at a time, so lookups aren't held up for long
+        for i in range(0, len(victims), EVICT_BATCH):
+            batch = victims[i : i + EVICT_BATCH]
+            with self.lock:
+                names = []
+                for name, size in batch:
+                    if name not in self.files:
+                        # Already gone
+                        continue
+                    try:
+                        os.remove(os.path.join(self.directory, name))
+                    except FileNotFoundError:
+                        pass
+                    except OSError as e:
+                        LOGGER.warning(
+                            "Failed to remove %s from the cache: %s", name, e
+                        )
+                    # Forget it either way, so a file that can't be removed doesn't block eviction
+                    names.append(name)
+                    self.evicted_bytes += self.files[name]
+                self.forget(names)
+                self.db.commit()
+                self.evicted_files += len(names)
+        if victims:
+            LOGGER.info(
+                "Removed %d files to keep %s below %.0f megabytes",
+                len(victims),
+                self.directory,
+                max_size / 1000000,
+            )
+        return len(victims)
+
+    def get_stats(self):
+        """
+        Get a dictionary of cache statistics
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return dict(
+                files=len(self.files),
+                size=self.total_size,
+                hits=self.hits,
+                misses=self.misses,
+                hit_ratio=(self.hits / lookups) if lookups else None,
+                evicted_files=self.evicted_files,
+                evicted_bytes=self.evicted_bytes,
+            )
+
+    def maybe_commit(self):
+        """
+        Commit if it's been a while since the last commit, must be called with the lock held
+        """
+        if time.monotonic() - self.last_commit > COMMIT_INTERVAL:
+            self.commit()
+
+    def commit(self):
+        """
+        Write any pending changes to the database
+        """
+        with self.lock:
+            if self.db:
+                if self.pending_uses:
+                    self.db.executemany(
+                        "UPDATE files SET last_used = ? WHERE name = ?",
+                        ((used, name) for (name, used) in self.pending_uses.items()),
+                    )
+                    self.pending_uses = {}
+                self.db.commit()
+            self.last_commit = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            if self.db:
+                self.commit()
+                self.db.close()
+                self.db = None
+
+
+class CacheEvictor(object):
+    """
+    Keeps a `CacheIndex` below a maximum size, by checking it in the background and evicting files
+    whenever it grows past the high watermark, down to the low watermark. Evicting a good chunk at
+    a time (rather than a file whenever one is added) means this runs only occasionally.
+    """
+
+    def __init__(
+        self,
+        index,
+        max_size,
+        high_watermark=HIGH_WATERMARK,
+        low_watermark=LOW_WATERMARK,
+        interval=EVICT_INTERVAL,
+    ):
+        """
+        :param index: the `CacheIndex`
+        :param max_size: maximum size of the cache (in bytes)
+        :param high_watermark: fraction of max_size at which eviction starts
+        :param low_watermark: fraction of max_size that eviction goes down to
+        :param interval: how often (in seconds) to check the size
+        """
+        self.index = index
+        self.max_size = max_size
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.interval = interval
+        # Size of the cache when eviction last left it over the limit because of pinned files
+        self.stuck_size = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.run, name="cache-evictor", daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                LOGGER.error("Cache eviction failed: %s", e)
+
+    def check(self):
+        """
+        Evict files if the cache is over the high watermark. Returns the number of files removed.
+        """
+        size = self.index.total_size
+        if size <= self.max_size * self.high_watermark or size == self.stuck_size:
+            return 0
+        count = self.index.evict(self.max_size * self.low_watermark)
+        LOGGER.info("Cache statistics: %s", self.index.get_stats())
+        size = self.index.total_size
+        if size > self.max_size * self.high_watermark:
+            # Don't try again until something changes
+            if self.stuck_size is None:
+                LOGGER.warning(
+                    "Cache %s is over %.0f megabytes, but the rest of the files are in use",
+                    self.index.directory,
+                    self.max_size / 1000000,
+                )
+            self.stuck_size = size
+        else:
+            self.stuck_size = None
+        return count
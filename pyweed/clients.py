@@ -1,10 +1,34 @@
 from enum import Enum
 from typing import Dict
+import io
+import functools
+import socket
+import threading
+import time
+from urllib.parse import urlparse
 from obspy.clients.fdsn import Client
+from obspy.clients.fdsn.client import raise_on_error
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPDigestAuth
+from pyweed.concurrency import ConcurrencyManager, ConcurrencyLimiter, MAX_CONCURRENCY
+from pyweed.governor import (
+    GovernorManager,
+    Governor,
+    CircuitOpenError,
+    DEFAULT_RATE,
+    DEFAULT_RETRIES,
+)
+from pyweed.pyweed_utils import CancelToken, CancelledException, get_cancel_token
 import logging
 
 LOGGER = logging.getLogger(__name__)
 
+# Default number of connections to keep open for each host
+DEFAULT_POOL_SIZE = 5
+# Size of the chunks read from a response, cancellation is checked between chunks
+READ_CHUNK_SIZE = 64 * 1024
+
 
 class FDSNService(Enum):
     EVENT = "event"
@@ -20,6 +44,265 @@ class ClientInitializationError(Exception):
     pass
 
 
+def create_session(pool_size: int = DEFAULT_POOL_SIZE):
+    """
+    Create a requests Session that keeps up to `pool_size` connections alive for each host
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def abort_response(response: requests.Response):
+    """
+    Shut down the connection under a streaming response, so that a read blocked in another thread
+    returns right away
+    """
+    raw = response.raw
+    connection = getattr(raw, "connection", None) or getattr(raw, "_connection", None)
+    sock = getattr(connection, "sock", None)
+    if sock:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+def send_request(send, token: CancelToken = None) -> requests.Response:
+    """
+    Send a (streaming) request, returning as soon as the response headers arrive, or raising a
+    `CancelledException` as soon as the token is cancelled.
+
+    Until the headers arrive there's no socket we can get at to abort, so the request is made in a
+    separate thread that's abandoned on cancellation (its response is closed whenever it comes in).
+
+    :param send: function making the request
+    """
+    if not token:
+        return send()
+    token.check()
+    finished = threading.Event()
+    lock = threading.Lock()
+    outcome = {}
+
+    def run():
+        try:
+            result = send()
+        except Exception as e:
+            result = e
+        with lock:
+            abandoned = outcome.get("abandoned")
+            outcome["result"] = result
+        if abandoned and isinstance(result, requests.Response):
+            result.close()
+        finished.set()
+
+    threading.Thread(target=run, name="request", daemon=True).start()
+    token.add_callback(finished.set)
+    try:
+        finished.wait()
+    finally:
+        token.remove_callback(finished.set)
+    with lock:
+        if "result" not in outcome:
+            outcome["abandoned"] = True
+            raise CancelledException()
+        result = outcome["result"]
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def read_response(response: requests.Response, token: CancelToken = None):
+    """
+    Read the full content of a streaming response. If the token is cancelled while reading, the
+    connection is shut down and a `CancelledException` raised.
+    """
+    if not token:
+        return response.content
+    abort = functools.partial(abort_response, response)
+    token.add_callback(abort)
+    try:
+        chunks = []
+        for chunk in response.iter_content(READ_CHUNK_SIZE):
+            token.check()
+            chunks.append(chunk)
+        return b"".join(chunks)
+    except Exception:
+        # Shutting down the connection usually shows up as a read error
+        token.check()
+        raise
+    finally:
+        token.remove_callback(abort)
+        if token.cancelled:
+            response.close()
+
+
+class PooledClient(Client):
+    """
+    ObsPy FDSN client that makes its requests through a `requests.Session`. The session keeps
+    connections alive and reuses them across requests and threads, rather than opening a new
+    connection (with a new TLS handshake) for every request. Responses are gzip-encoded whenever
+    the server supports it.
+
+    The session can (and should) be shared between clients, see `ClientManager`.
+
+    If a `ConcurrencyManager` is given, the number of concurrent requests to the data center is
+    limited (and tuned) by it. If a `GovernorManager` is given, requests to the data center are rate
+    limited and retried by it.
+
+    Requests are cancellable: if the thread has a `CancelToken` (see `cancel_scope`), cancelling it
+    aborts any request in progress with a `CancelledException`.
+    """
+
+    session: requests.Session = None
+    auth: HTTPDigestAuth = None
+    concurrency: ConcurrencyManager = None
+    governors: GovernorManager = None
+
+    def __init__(
+        self,
+        *args,
+        session: requests.Session = None,
+        concurrency: ConcurrencyManager = None,
+        governors: GovernorManager = None,
+        **kwargs,
+    ):
+        # Set these first, since the base class may make requests during initialization
+        self.session = session or create_session()
+        self.concurrency = concurrency
+        self.governors = governors
+        super(PooledClient, self).__init__(*args, **kwargs)
+
+    @property
+    def data_center(self):
+        """
+        Identifies the data center (ie. the host) for concurrency tuning
+        """
+        return urlparse(self.base_url).netloc or self.base_url
+
+    @property
+    def limiter(self) -> ConcurrencyLimiter:
+        if self.concurrency:
+            return self.concurrency.get_limiter(self.data_center)
+        return None
+
+    @property
+    def governor(self) -> Governor:
+        if self.governors:
+            return self.governors.get_governor(self.data_center)
+        return None
+
+    def _set_opener(self, user, password):
+        """
+        Called by the base class to set up authentication
+        """
+        super(PooledClient, self)._set_opener(user, password)
+        if user is not None and password is not None:
+            self.auth = HTTPDigestAuth(user, password)
+        else:
+            self.auth = None
+
+    def _request(self, url, data, headers):
+        """
+        Make a single request through the session.
+
+        :return: a tuple of (status code, content, Retry-After header value)
+        """
+        method = "GET" if data is None else "POST"
+        if self.debug:
+            print("%s %s" % (method, url))
+        token = get_cancel_token()
+        limiter = self.limiter
+        if limiter:
+            limiter.acquire()
+        start = time.monotonic()
+        latency = None
+        code = None
+        content = b""
+        try:
+            response = send_request(
+                functools.partial(
+                    self.session.request,
+                    method,
+                    url,
+                    data=data,
+                    headers=headers,
+                    auth=self.auth,
+                    timeout=self.timeout,
+                    stream=True,
+                ),
+                token,
+            )
+            # Latency is measured to the start of the response, since the download time depends
+            # on the size
+            latency = time.monotonic() - start
+            code = response.status_code
+            content = read_response(response, token)
+            return (code, content, response.headers.get("Retry-After"))
+        finally:
+            if limiter:
+                # A cancelled request doesn't say anything about the data center
+                if not (token and token.cancelled):
+                    if latency is None:
+                        latency = time.monotonic() - start
+                    limiter.record(
+                        latency,
+                        code,
+                        len(content),
+                        kind=(method, urlparse(url).path),
+                    )
+                limiter.release()
+
+    def _download(
+        self, url, return_string=False, data=None, use_gzip=True, content_type=None
+    ):
+        """
+        Replaces the base class download (which opens a new connection each time) with one that goes
+        through the session. This is used for all the service requests.
+
+        If there is a governor for the data center, the request is rate limited and retried
+        according to it.
+        """
+        headers = self.request_headers.copy()
+        if content_type:
+            headers["Content-Type"] = content_type
+        if not use_gzip:
+            headers["Accept-Encoding"] = "identity"
+        request = functools.partial(self._request, url, data, headers)
+        governor = self.governor
+        try:
+            if governor:
+                (code, content) = governor.run(request)
+            else:
+                (code, content, _retry_after) = request()
+        except (CircuitOpenError, CancelledException):
+            raise
+        except Exception as e:
+            # The base class treats a missing code as a connection error
+            raise_on_error(None, e)
+        if code != 200:
+            raise_on_error(code, io.BytesIO(content))
+        if return_string:
+            return content
+        return io.BytesIO(content)
+
+
+def get_worker_count(client: Client, default: int = 5):
+    """
+    Get the number of worker threads to use for requests to the given client.
+
+    For a client with a concurrency limiter, this is enough threads to reach the limiter's maximum, since
+    the limiter is what actually controls the number of requests in flight.
+    """
+    limiter = getattr(client, "limiter", None)
+    if limiter:
+        return limiter.maximum
+    return default
+
+
 class ClientManager(object):
     """
     Manages a set of ObsPy clients for different services and data centers.
@@ -29,6 +312,12 @@ class ClientManager(object):
     data_centers: Dict[FDSNService, str] = None
     username: str = None
     password: str = None
+    # HTTP session shared by all the clients
+    session: requests.Session = None
+    # Concurrency limits for each data center, shared by all the clients
+    concurrency: ConcurrencyManager = None
+    # Rate limits, retries and circuit breakers for each data center, shared by all the clients
+    governors: GovernorManager = None
 
     def initialize(
         self,
@@ -37,12 +326,35 @@ class ClientManager(object):
         dataselect_data_center: str,
         username: str,
         password: str,
+        concurrency_limits: Dict[str, int] = None,
+        default_concurrency: int = None,
+        rate_limit: float = DEFAULT_RATE,
+        max_retries: int = DEFAULT_RETRIES,
+        pool_size: int = MAX_CONCURRENCY,
     ):
+        """
+        :param concurrency_limits: tuned concurrency limits for each data center, as saved from
+            `ConcurrencyManager.get_limits` in a previous session
+        :param default_concurrency: starting concurrency limit for other data centers
+        :param rate_limit: maximum requests per second to each data center (0 for no limit)
+        :param max_retries: number of times to retry a request that failed with a transient error
+        :param pool_size: number of connections to keep alive for each host, this should be
+            the number of threads that may be making requests at once
+        """
         LOGGER.info("Initializing ObsPy client(s)")
         self.data_centers = {}
         self.clients = {}
         self.username = username
         self.password = password
+        self.session = create_session(pool_size)
+        # Keep any limits tuned so far in this session
+        if not self.concurrency:
+            self.concurrency = ConcurrencyManager()
+        if default_concurrency:
+            self.concurrency.default_limit = default_concurrency
+        if concurrency_limits:
+            self.concurrency.load_limits(concurrency_limits)
+        self.governors = GovernorManager(rate_limit, max_retries)
         self.set_data_center(FDSNService.EVENT, event_data_center)
         self.set_data_center(FDSNService.STATION, station_data_center)
         self.set_data_center(FDSNService.DATASELECT, dataselect_data_center)
@@ -105,16 +417,22 @@ class ClientManager(object):
         To allow totally custom URLs, we take the URL for the service itself
         (eg. https://service.iris.edu/fdsnwsbeta/station/1/) and explicitly map it.
         """
-        kwargs = {}
+        kwargs = {
+            "session": self.session,
+            "concurrency": self.concurrency,
+            "governors": self.governors,
+        }
         if self.username and self.password:
             kwargs["user"] = self.username
             kwargs["password"] = self.password
         if url_or_label.startswith("http"):
             service_mappings = {}
             service_mappings[service.value] = url_or_label
-            return Client(url_or_label, service_mappings=service_mappings, **kwargs)
+            return PooledClient(
+                url_or_label, service_mappings=service_mappings, **kwargs
+            )
         else:
-            return Client(url_or_label, **kwargs)
+            return PooledClient(url_or_label, **kwargs)
 
     @property
     def event_data_center(self):
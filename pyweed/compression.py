@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Compressed storage for the download cache.
+
+When the `Waveforms.compressCache` preference is set, cached files are stored compressed:
+
+- StationXML is compressed with zstd if the optional `zstandard` package is installed, otherwise
+  with gzip. Compressed files have an extra ".zst" or ".gz" extension, and are decompressed
+  wherever they are read.
+- Each waveform's MiniSEED file has any records with uncompressed integer samples re-encoded with
+  Steim2, which is lossless and still MiniSEED, so nothing reading them needs to change. Floating
+  point samples can't be Steim encoded without losing precision, so those records are stored as
+  they are.
+- Segments (see `SegmentStore`) are matched up record by record, so the records have to stay
+  exactly as they were received. Instead, each segment file is compressed like StationXML.
+
+Waveform images are already compressed PNGs, so these are left alone.
+
+:copyright:
+    Mazama Science, IRIS
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+
+import gzip
+import io
+import shutil
+from logging import getLogger
+import obspy
+from pyweed.mseed import INTEGER_ENCODINGS, iter_records
+from pyweed.pyweed_utils import atomic_file
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+LOGGER = getLogger(__name__)
+
+ZSTD_EXTENSION = "zst"
+GZIP_EXTENSION = "gz"
+# zstd compression level, this is fast and still compresses XML very well
+ZSTD_LEVEL = 9
+
+
+def get_extension():
+    """
+    Get the file extension for compressed files (without the ".")
+    """
+    return ZSTD_EXTENSION if zstandard else GZIP_EXTENSION
+
+
+def is_compressed(path):
+    """
+    Check whether a cache file is compressed (going by its name)
+    """
+    return path.endswith(("." + ZSTD_EXTENSION, "." + GZIP_EXTENSION))
+
+
+def compress(data, path):
+    """
+    Compress data for the given (compressed) path
+    """
+    if path.endswith("." + ZSTD_EXTENSION):
+        if not zstandard:
+            raise ValueError("zstandard is needed to write %s" % path)
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return gzip.compress(data)
+
+
+def open_file(path):
+    """
+    Open a cache file for reading, decompressing it if necessary
+    """
+    if path.endswith("." + ZSTD_EXTENSION):
+        if not zstandard:
+            raise ValueError("zstandard is needed to read %s" % path)
+        with open(path, "rb") as f:
+            return io.BytesIO(zstandard.ZstdDecompressor().decompress(f.read()))
+    if path.endswith("." + GZIP_EXTENSION):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def write_file(path, data, cache=None):
+    """
+    Write data to a cache file, compressing it if the path is for a compressed file
+
+    :param cache: `CacheIndex` to record the file in
+    """
+    if is_compressed(path):
+        data = compress(data, path)
+    with atomic_file(path, cache) as temp_path:
+        with open(temp_path, "wb") as f:
+            f.write(data)
+
+
+def decompress_file(source, dest):
+    """
+    Write a decompressed copy of a cache file
+    """
+    with open_file(source) as f:
+        with atomic_file(dest) as temp_path:
+            with open(temp_path, "wb") as out:
+                shutil.copyfileobj(f, out)
+
+
+def recompress_mseed(data):
+    """
+    Re-encode any MiniSEED records holding uncompressed integer samples with Steim2. Returns the
+    data unchanged if there aren't any, or it can't be re-encoded.
+    """
+    try:
+        records = list(iter_records(data))
+    except ValueError:
+        return data
+    if not any(record.encoding in INTEGER_ENCODINGS for record in records):
+        return data
+    try:
+        st = obspy.read(io.BytesIO(data), format="MSEED")
+        for tr in st:
+            if tr.data.dtype.kind == "i":
+                tr.data = tr.data.astype("int32")
+                tr.stats.mseed.encoding = "STEIM2"
+        buf = io.BytesIO()
+        st.write(buf, format="MSEED", reclen=records[0].length)
+    except Exception as e:
+        LOGGER.warning("Couldn't re-encode MiniSEED data: %s", e)
+        return data
+    return buf.getvalue()
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+Adaptive concurrency limits for data center requests.
+
+Each data center gets a `ConcurrencyLimiter`, which caps the number of requests in flight and tunes
+that cap AIMD-style (additive increase, multiplicative decrease) from what it observes:
+
+- While responses come back about as fast as the best latency seen so far, and all the available
+  slots are in use, the limit grows by about one request per round trip.
+- If latency climbs well above that baseline (requests are queueing at the server), or throughput
+  drops after the limit was raised, the limit is eased back.
+
+Latency is the time until the response starts (not counting the download), and each kind of request
+(eg. a station query vs. a bulk dataselect POST) has its own baseline, so a fast small request
+doesn't make every large one look slow.
+- An HTTP 429 or 503 response, or a connection failure, cuts the limit in half.
+
+The tuned limits are saved in the preferences, so the next session starts near the optimum.
+
+:copyright:
+    Mazama Science, IRIS
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+
+import threading
+import time
+from logging import getLogger
+
+LOGGER = getLogger(__name__)
+
+# Bounds for the concurrency limit
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 32
+# Starting limit for a data center that hasn't been tuned yet
+DEFAULT_CONCURRENCY = 5
+
+# HTTP status codes meaning the data center is overloaded
+OVERLOAD_CODES = (429, 503)
+# Multiplier applied to the limit when the data center is overloaded
+OVERLOAD_BACKOFF = 0.5
+# Multiplier applied to the limit when latency or throughput gets worse
+SLOWDOWN_BACKOFF = 0.9
+# Latency (as a multiple of the baseline) above which requests are considered to be queueing
+LATENCY_TOLERANCE = 2.0
+# How quickly the baseline latency drifts up toward current latencies (so it can recover if the
+# network path changes)
+BASELINE_DRIFT = 0.01
+# Weight of each new sample in the average latency
+LATENCY_SMOOTHING = 0.2
+# Minimum length (in seconds) of a throughput measurement window
+THROUGHPUT_WINDOW = 1.0
+# Fractional drop in throughput that counts as getting worse
+THROUGHPUT_TOLERANCE = 0.1
+
+
+class LatencyStats(object):
+    """
+    Baseline (fastest) and average latency for one kind of request
+    """
+
+    def __init__(self, latency):
+        self.baseline = latency
+        self.average = latency
+
+    def update(self, latency):
+        if latency < self.baseline:
+            self.baseline = latency
+        else:
+            self.baseline += (latency - self.baseline) * BASELINE_DRIFT
+        self.average += (latency - self.average) * LATENCY_SMOOTHING
+
+
+class ConcurrencyLimiter(object):
+    """
+    Adaptive limit on the number of concurrent requests to a single data center.
+
+    A thread takes a slot with `acquire` and gives it back with `release`. These nest, so a thread
+    that already holds a slot (eg. a pipeline worker) can make any number of requests under it.
+    Each request's outcome is reported with `record`, which is what drives the tuning.
+    """
+
+    def __init__(
+        self,
+        name,
+        limit=DEFAULT_CONCURRENCY,
+        minimum=MIN_CONCURRENCY,
+        maximum=MAX_CONCURRENCY,
+    ):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(min(max(limit, minimum), maximum))
+        #: Number of slots currently taken
+        self.in_flight = 0
+        #: Number of requests recorded
+        self.samples = 0
+        self.condition = threading.Condition()
+        self.local = threading.local()
+        #: `LatencyStats` for each kind of request
+        self.latencies = {}
+        # Moving average of the latency (in seconds) across all requests
+        self.average_latency = None
+        # When the limit was last decreased, to avoid reacting more than once to one overload
+        self.last_decrease = 0
+        # Throughput measurement
+        self.window_start = time.monotonic()
+        self.window_bytes = 0
+        self.window_limit = self.limit
+        self.last_throughput = None
+
+    def current_limit(self):
+        """
+        The limit as a whole number of requests
+        """
+        return max(int(self.limit), self.minimum)
+
+    def acquire(self, timeout=None):
+        """
+        Take a slot, waiting until one is free. Returns False if the timeout expired first.
+        """
+        depth = getattr(self.local, "depth", 0)
+        if depth:
+            self.local.depth = depth + 1
+            return True
+        with self.condition:
+            if not self.condition.wait_for(
+                lambda: self.in_flight < self.current_limit(), timeout
+            ):
+                return False
+            self.in_flight += 1
+        self.local.depth = 1
+        return True
+
+    def release(self):
+        """
+        Give back a slot taken by `acquire`
+        """
+        self.local.depth -= 1
+        if not self.local.depth:
+            with self.condition:
+                self.in_flight -= 1
+                self.condition.notify()
+
+    def record(self, latency, code, size=0, kind=None):
+        """
+        Record the outcome of a request, and adjust the limit accordingly
+
+        :param latency: how long the request took to get a response, in seconds
+        :param code: the HTTP status code, or None if the request failed to connect or timed out
+        :param size: size of the response in bytes
+        :param kind: identifies the kind of request, latency is only compared between requests of
+            the same kind
+        """
+        now = time.monotonic()
+        with self.condition:
+            self.samples += 1
+            if code is None or code in OVERLOAD_CODES:
+                self.decrease(OVERLOAD_BACKOFF, now, "overloaded (%s)" % code)
+                return
+            if code >= 400:
+                # Some other error, this says nothing about the load
+                return
+
+            stats = self.latencies.get(kind)
+            if stats is None:
+                stats = self.latencies[kind] = LatencyStats(latency)
+            else:
+                stats.update(latency)
+            if self.average_latency is None:
+                self.average_latency = latency
+            else:
+                self.average_latency += (
+                    latency - self.average_latency
+                ) * LATENCY_SMOOTHING
+
+            # Throughput, measured over a window of at least a couple of round trips
+            self.window_bytes += size
+            elapsed = now - self.window_start
+            if elapsed >= max(THROUGHPUT_WINDOW, self.average_latency * 2):
+                throughput = self.window_bytes / elapsed
+                raised = self.limit > self.window_limit
+                if (
+                    raised
+                    and self.last_throughput
+                    and throughput < self.last_throughput * (1 - THROUGHPUT_TOLERANCE)
+                ):
+                    self.decrease(SLOWDOWN_BACKOFF, now, "throughput dropped")
+                self.last_throughput = throughput
+                self.window_start = now
+                self.window_bytes = 0
+                self.window_limit = self.limit
+
+            if stats.average > stats.baseline * LATENCY_TOLERANCE:
+                self.decrease(SLOWDOWN_BACKOFF, now, "latency increased")
+            elif self.in_flight >= self.current_limit() and self.limit < self.maximum:
+                # Only grow while the current limit is actually being used
+                previous = self.current_limit()
+                self.limit = min(self.limit + 1.0 / self.limit, self.maximum)
+                if self.current_limit() > previous:
+                    LOGGER.debug(
+                        "Concurrency for %s raised to %d",
+                        self.name,
+                        self.current_limit(),
+                    )
+                    self.condition.notify()
+
+    def decrease(self, factor, now, reason):
+        """
+        Multiply the limit by the given factor, at most once per round trip since all the requests
+        already in flight will tend to see the same conditions.
+        Must be called with the condition held.
+        """
+        if now - self.last_decrease < (self.average_latency or 0):
+            return
+        self.last_decrease = now
+        self.limit = max(self.limit * factor, self.minimum)
+        LOGGER.debug(
+            "Concurrency for %s lowered to %d: %s",
+            self.name,
+            self.current_limit(),
+            reason,
+        )
+
+
+class ConcurrencyManager(object):
+    """
+    Holds the `ConcurrencyLimiter` for each data center
+    """
+
+    def __init__(self, default_limit=DEFAULT_CONCURRENCY):
+        self.default_limit = default_limit
+        self.limiters = {}
+        # Limits saved from a previous session, for data centers not used yet
+        self.saved_limits = {}
+        self.lock = threading.Lock()
+
+    def load_limits(self, limits):
+        """
+        Load the limits saved from a previous session (see `get_limits`)
+        """
+        with self.lock:
+            for name, limit in limits.items():
+                try:
+                    self.saved_limits[name] = int(limit)
+                except (TypeError, ValueError):
+                    LOGGER.warning("Bad concurrency limit for %s: %s", name, limit)
+
+    def get_limits(self):
+        """
+        Get the current limits for all data centers, as a dictionary that can be saved
+        """
+        with self.lock:
+            limits = dict(self.saved_limits)
+            for name, limiter in self.limiters.items():
+                if limiter.samples:
+                    limits[name] = limiter.current_limit()
+            return limits
+
+    def get_limiter(self, name):
+        """
+        Get the limiter for the given data center, creating it if necessary
+        """
+        with self.lock:
+            limiter = self.limiters.get(name)
+            if not limiter:
+                limit = self.saved_limits.get(name, self.default_limit)
+                LOGGER.debug("Starting concurrency for %s at %d", name, limit)
+                limiter = self.limiters[name] = ConcurrencyLimiter(name, limit)
+            return limiter
@@ -2,6 +2,18 @@
 """
 Selecting stations based on selected events.
 
+A station query for everything within some distance of the selected events is broken up into
+sub-queries (see `get_combined_locations`):
+
+- The events are grouped into clusters of nearby events, so events in Japan and Chile are queried
+  separately rather than with one box spanning the Pacific.
+- Each cluster is covered by either a radius query (latitude/longitude/maxradius) or one or more
+  latitude/longitude boxes, whichever covers the smaller area. Boxes crossing the dateline are
+  split in two, and a box reaching a pole covers all longitudes.
+
+The areas are only approximate (the sub-queries may return stations that are too far away), the
+results are filtered by the actual distance afterwards.
+
 :copyright:
     Mazama Science, IRIS
 :license:
@@ -9,56 +21,234 @@ Selecting stations based on selected events.
     (http://www.gnu.org/copyleft/lesser.html)
 """
 
-from __future__ import (absolute_import, division, print_function)
+from __future__ import absolute_import, division, print_function
 from logging import getLogger
+import numpy as np
+from pyweed.pyweed_utils import SPHERICAL_DISTANCE_ERROR, get_spherical_distances
 
 LOGGER = getLogger(__name__)
 
-
-class CrossBorderException(Exception):
-    pass
+# Most clusters of events to make sub-queries for, the closest clusters are merged until there are
+# no more than this (a cluster crossing the dateline makes two sub-queries)
+MAX_CLUSTERS = 16
+# Area of the whole globe (on a unit sphere)
+GLOBAL_AREA = 4 * np.pi
 
 
 class LatLonBox(object):
-    lat1 = None
-    lat2 = None
-    lon1 = None
-    lon2 = None
-
-    def __init__(self, distance):
-        self.distance = distance
-
-    def add_point(self, lat, lon):
-        if self.lat1 is None:
-            self.lat1 = lat - self.distance
-            self.lat2 = lat + self.distance
-            self.lon1 = lon - self.distance
-            self.lon2 = lon + self.distance
-        else:
-            self.lat1 = min(self.lat1, lat - self.distance)
-            self.lat2 = max(self.lat2, lat + self.distance)
-            self.lon1 = min(self.lon1, lon - self.distance)
-            self.lon2 = max(self.lon2, lon + self.distance)
-
-        if self.lat1 < -90 or self.lat2 > 90 or self.lon1 < -180 or self.lon2 > 180:
-            raise CrossBorderException()
+    """
+    A latitude/longitude box, this never crosses the dateline
+    """
+
+    def __init__(self, lat1, lat2, lon1, lon2):
+        self.lat1 = lat1
+        self.lat2 = lat2
+        self.lon1 = lon1
+        self.lon2 = lon2
+
+    def get_options(self):
+        """
+        Get the station query options for this area
+        """
+        return dict(
+            minlatitude=self.lat1,
+            maxlatitude=self.lat2,
+            minlongitude=self.lon1,
+            maxlongitude=self.lon2,
+        )
+
+    def get_area(self):
+        """
+        Get the area covered (on a unit sphere)
+        """
+        return (
+            np.sin(np.radians(self.lat2)) - np.sin(np.radians(self.lat1))
+        ) * np.radians(self.lon2 - self.lon1)
 
     def __str__(self):
         return "[%s, %s, %s, %s]" % (self.lat1, self.lon1, self.lat2, self.lon2)
 
 
+class LatLonCircle(object):
+    """
+    Everything within a radius (in degrees) of a point
+    """
+
+    def __init__(self, lat, lon, radius):
+        self.lat = lat
+        self.lon = lon
+        self.radius = radius
+
+    def get_options(self):
+        """
+        Get the station query options for this area
+        """
+        return dict(latitude=self.lat, longitude=self.lon, maxradius=self.radius)
+
+    def get_area(self):
+        """
+        Get the area covered (on a unit sphere)
+        """
+        if self.radius >= 180:
+            return GLOBAL_AREA
+        return 2 * np.pi * (1 - np.cos(np.radians(self.radius)))
+
+    def __str__(self):
+        return "(%s, %s) within %s" % (self.lat, self.lon, self.radius)
+
+
+def get_padded_distance(distance):
+    """
+    Pad a distance so an area based on spherical distances covers the actual distance (see
+    `get_distance`)
+    """
+    return distance * (1 + SPHERICAL_DISTANCE_ERROR) + 0.01
+
+
+def cluster_points(points, radius):
+    """
+    Group points into clusters, each made up of the points within radius (in degrees) of the
+    first one that isn't in an earlier cluster.
+
+    :param points: array of (lat, lon) points
+    :return: a list of arrays of points
+    """
+    labels = np.full(len(points), -1)
+    count = 0
+    for i in range(len(points)):
+        if labels[i] >= 0:
+            continue
+        distances = get_spherical_distances(
+            points[i, 0], points[i, 1], points[:, 0], points[:, 1]
+        )
+        labels[(labels < 0) & (distances <= radius)] = count
+        count += 1
+    return [points[labels == label] for label in range(count)]
+
+
+def get_center(points):
+    """
+    Get the center of a set of points (the average position in 3D), or the first point if they're
+    spread too evenly to have one
+    """
+    lats = np.radians(points[:, 0])
+    lons = np.radians(points[:, 1])
+    xyz = np.array(
+        [
+            np.mean(np.cos(lats) * np.cos(lons)),
+            np.mean(np.cos(lats) * np.sin(lons)),
+            np.mean(np.sin(lats)),
+        ]
+    )
+    norm = np.linalg.norm(xyz)
+    if norm < 1e-6:
+        return (float(points[0, 0]), float(points[0, 1]))
+    return (
+        float(np.degrees(np.arcsin(xyz[2] / norm))),
+        float(np.degrees(np.arctan2(xyz[1], xyz[0]))),
+    )
+
+
+def merge_clusters(clusters, max_clusters):
+    """
+    Merge the clusters with the closest centers until there are no more than max_clusters
+    """
+    clusters = list(clusters)
+    centers = [get_center(cluster) for cluster in clusters]
+    while len(clusters) > max_clusters:
+        lats = np.array([center[0] for center in centers])
+        lons = np.array([center[1] for center in centers])
+        distances = get_spherical_distances(
+            lats[:, np.newaxis], lons[:, np.newaxis], lats, lons
+        )
+        np.fill_diagonal(distances, np.inf)
+        (i, j) = sorted(np.unravel_index(distances.argmin(), distances.shape))
+        clusters[i] = np.concatenate((clusters[i], clusters.pop(j)))
+        centers.pop(j)
+        centers[i] = get_center(clusters[i])
+    return clusters
+
+
+def get_circle(points, distance):
+    """
+    Get the circle covering everything within distance of the points
+    """
+    (lat, lon) = get_center(points)
+    spread = get_spherical_distances(lat, lon, points[:, 0], points[:, 1]).max()
+    return LatLonCircle(lat, lon, float(spread + distance))
+
+
+def get_boxes(points, distance):
+    """
+    Get the boxes covering everything within distance of the points. This is usually one box, or
+    two if it crosses the dateline.
+    """
+    lat1 = points[:, 0].min() - distance
+    lat2 = points[:, 0].max() + distance
+    if lat1 <= -90 or lat2 >= 90:
+        # Reaches a pole, so it takes in every longitude
+        return [LatLonBox(max(lat1, -90), min(lat2, 90), -180, 180)]
+    # The longitude range within distance of a point is widest away from the equator
+    dlon = np.degrees(
+        np.arcsin(np.sin(np.radians(distance)) / np.cos(np.radians(points[:, 0])))
+    ).max()
+    # The smallest range covering all the longitudes starts after the largest gap between them
+    lons = np.sort(points[:, 1] % 360)
+    gaps = np.diff(np.append(lons, lons[0] + 360))
+    largest = gaps.argmax()
+    lon1 = lons[(largest + 1) % len(lons)] - dlon
+    width = 360 - gaps[largest] + 2 * dlon
+    if width >= 360:
+        return [LatLonBox(lat1, lat2, -180, 180)]
+    lon1 = (lon1 + 180) % 360 - 180
+    lon2 = lon1 + width
+    if lon2 > 180:
+        # Split at the dateline
+        return [
+            LatLonBox(lat1, lat2, lon1, 180),
+            LatLonBox(lat1, lat2, -180, lon2 - 360),
+        ]
+    return [LatLonBox(lat1, lat2, lon1, lon2)]
+
+
+def get_cluster_areas(points, distance):
+    """
+    Get the smallest set of areas (a circle, or boxes) covering everything within distance of a
+    cluster of points
+    """
+    circle = get_circle(points, distance)
+    boxes = get_boxes(points, distance)
+    if circle.get_area() < sum(box.get_area() for box in boxes):
+        return [circle]
+    return boxes
+
+
 def get_combined_locations(points, distance):
     """
     Given a set of points and a distance, return a reasonable set of
     bounding areas covering everything within that distance of any point.
-    """
-    # Very simple implementation, try to draw a box around all points
-    box = LatLonBox(distance)
 
+    :param points: list of (lat, lon) points
+    :param distance: distance in degrees
+    :return: a list of areas (`LatLonBox` or `LatLonCircle`)
+    """
     if not points:
         return []
-
-    for lat, lon in points:
-        box.add_point(lat, lon)
-    LOGGER.info("Combined points into: %s", box)
-    return [box]
+    points = np.array(points, dtype=float).reshape(-1, 2)
+    distance = get_padded_distance(distance)
+    clusters = merge_clusters(cluster_points(points, distance), MAX_CLUSTERS)
+    areas = []
+    for cluster in clusters:
+        areas.extend(get_cluster_areas(cluster, distance))
+    total_area = sum(area.get_area() for area in areas)
+    if total_area >= GLOBAL_AREA:
+        # Might as well make one global query
+        areas = [LatLonBox(-90, 90, -180, 180)]
+    LOGGER.info(
+        "Combined %d points into %d areas (%.0f%% of the globe): %s",
+        len(points),
+        len(areas),
+        100 * min(total_area / GLOBAL_AREA, 1),
+        ", ".join(str(area) for area in areas),
+    )
+    return areas
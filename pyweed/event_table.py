@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar store of the loaded events.
+
+The events are loaded as an ObsPy `Catalog`, where getting at the basic values for an event means
+resolving its preferred origin and magnitude (see `get_preferred_origin`) and parsing its id. The
+`EventTable` does this once when the events are loaded, and keeps the values in arrays (one row
+per event, in catalog order) for the GUI and the waveform code to read:
+
+- Times, locations, depths and magnitudes are NumPy arrays, so they can be used for many events
+  at once (eg. the event/station distances).
+- Ids, descriptions and magnitude types are lists of interned strings, since many events share
+  the same description or magnitude type.
+
+The `Event` objects are still kept in the catalog, `get_event` gets the one for a row.
+
+:copyright:
+    Mazama Science, IRIS
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+
+import sys
+from logging import getLogger
+import numpy as np
+from obspy import UTCDateTime
+from pyweed.pyweed_utils import (
+    get_event_id,
+    get_preferred_magnitude,
+    get_preferred_origin,
+)
+
+LOGGER = getLogger(__name__)
+
+# Description shown for events without one
+NO_DESCRIPTION = "No Description"
+
+
+def intern(s):
+    """
+    Intern a string (leaving anything else as it is)
+    """
+    return sys.intern(s) if isinstance(s, str) else s
+
+
+class EventTable(object):
+    """
+    The values for each event in a catalog, see the module docstring
+    """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        count = len(catalog)
+        #: Origin times, in nanoseconds (see `UTCDateTime.ns`)
+        self.times = np.zeros(count, dtype=np.int64)
+        self.latitudes = np.full(count, np.nan)
+        self.longitudes = np.full(count, np.nan)
+        #: Depths in km
+        self.depths = np.full(count, np.nan)
+        self.magnitudes = np.full(count, np.nan)
+        self.magnitude_types = [None] * count
+        #: Whether each event has an origin (and so a time and location)
+        self.has_origin = np.zeros(count, dtype=bool)
+        #: Whether each event has a magnitude
+        self.has_magnitude = np.zeros(count, dtype=bool)
+        #: Full resource ids, these identify the events within PyWEED
+        self.resource_ids = [None] * count
+        #: Short ids, see `get_event_id`
+        self.event_ids = [None] * count
+        self.descriptions = [None] * count
+        #: Row for each resource id
+        self.rows = {}
+
+        for row, event in enumerate(catalog):
+            resource_id = intern(event.resource_id.id)
+            self.resource_ids[row] = resource_id
+            self.event_ids[row] = intern(get_event_id(event))
+            self.rows[resource_id] = row
+            if len(event.event_descriptions):
+                self.descriptions[row] = intern(
+                    str(event.event_descriptions[0].text).title()
+                )
+            else:
+                self.descriptions[row] = NO_DESCRIPTION
+            origin = get_preferred_origin(event)
+            if origin:
+                self.has_origin[row] = True
+                self.times[row] = origin.time.ns
+                self.latitudes[row] = origin.latitude
+                self.longitudes[row] = origin.longitude
+                if origin.depth is not None:
+                    self.depths[row] = origin.depth / 1000
+            magnitude = get_preferred_magnitude(event)
+            if magnitude:
+                self.has_magnitude[row] = True
+                if magnitude.mag is not None:
+                    self.magnitudes[row] = magnitude.mag
+                self.magnitude_types[row] = intern(magnitude.magnitude_type)
+
+        #: Origin times formatted like `format_time_str`
+        self.time_strs = [
+            s.replace("T", " ")
+            for s in np.datetime_as_string(
+                self.times.astype("datetime64[ns]"), unit="s"
+            ).tolist()
+        ]
+        LOGGER.debug("Built event table for %d events", count)
+
+    def __len__(self):
+        return len(self.resource_ids)
+
+    def get_event(self, row):
+        """
+        Get the full `Event` for a row
+        """
+        return self.catalog[row]
+
+    def get_rows(self, resource_ids):
+        """
+        Get the rows (in catalog order) for a set of resource ids
+        """
+        return sorted(self.rows[i] for i in resource_ids if i in self.rows)
+
+    def get_time(self, row):
+        return UTCDateTime(ns=int(self.times[row]))
+
+    def get_magnitude_str(self, row):
+        """
+        Format the magnitude like `get_event_mag_str`
+        """
+        return "%s%s" % (float(self.magnitudes[row]), self.magnitude_types[row])
+
+    def get_name(self, row):
+        """
+        Get the name for an event, like `get_event_name`
+        """
+        return "%s | %s | %s" % (
+            self.time_strs[row],
+            self.get_magnitude_str(row),
+            self.descriptions[row],
+        )
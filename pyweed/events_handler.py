@@ -11,11 +11,18 @@ Container for events.
 
 from __future__ import absolute_import, division, print_function
 
+from pyweed.clients import get_worker_count
 from pyweed.signals import SignalingThread, SignalingObject
 import logging
 from obspy.core.event.catalog import Catalog
 from obspy.clients.fdsn import Client
-from pyweed.pyweed_utils import DataRequest, get_service_url, CancelledException
+from pyweed.pyweed_utils import (
+    DataRequest,
+    get_service_url,
+    CancelledException,
+    CancelToken,
+    call_with_token,
+)
 from PyQt5 import QtCore
 import concurrent.futures
 
@@ -54,6 +61,7 @@ class EventsLoader(SignalingThread):
         # Keep a reference to globally shared components
         self.request = request
         self.futures = {}
+        self.token = CancelToken()
         super(EventsLoader, self).__init__()
 
     def run(self):
@@ -66,14 +74,24 @@ class EventsLoader(SignalingThread):
 
         catalog = None
         LOGGER.info("Making %d event requests", len(self.request.sub_requests))
-        with concurrent.futures.ThreadPoolExecutor(5) as executor:
+        with concurrent.futures.ThreadPoolExecutor(
+            get_worker_count(self.request.client)
+        ) as executor:
             for sub_request in self.request.sub_requests:
                 # Dictionary lets us look up argument by result later
                 self.futures[
-                    executor.submit(load_events, self.request.client, sub_request)
+                    executor.submit(
+                        call_with_token,
+                        self.token,
+                        load_events,
+                        self.request.client,
+                        sub_request,
+                    )
                 ] = sub_request
             # Iterate through Futures as they complete
             for result in concurrent.futures.as_completed(self.futures):
+                if self.token.cancelled:
+                    break
                 LOGGER.debug("Events loaded")
                 try:
                     if not catalog:
@@ -84,6 +102,9 @@ class EventsLoader(SignalingThread):
                 except Exception:
                     self.progress.emit()
         self.futures = {}
+        if self.token.cancelled:
+            LOGGER.info("Events request cancelled")
+            return
         if not catalog:
             catalog = Catalog()
         LOGGER.info("Loader processing")
@@ -107,6 +128,8 @@ class EventsLoader(SignalingThread):
         """
         self.done.disconnect()
         self.progress.disconnect()
+        # Stop any requests in progress, and anything not started yet
+        self.token.cancel()
         self.clearFutures()
 
 
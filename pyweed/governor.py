@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""
+Traffic governor for data center requests.
+
+Each data center gets a `Governor`, which every request goes through. It:
+
+- Limits the request rate with a token bucket.
+- Retries transient failures (connection errors, HTTP 429 and 5xx responses) with exponential
+  backoff and jitter, honoring any Retry-After header from the server.
+- Opens a circuit breaker when the data center keeps failing, so further requests fail
+  immediately rather than piling up behind it. After a cooling-off period a single trial request
+  is let through, and if that succeeds the circuit closes again.
+
+:copyright:
+    Mazama Science, IRIS
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from logging import getLogger
+from pyweed.pyweed_utils import CancelledException, get_cancel_token
+
+LOGGER = getLogger(__name__)
+
+# Default requests per second (and burst size) for each data center
+DEFAULT_RATE = 20.0
+DEFAULT_BURST = 20
+# Default number of retries after the initial attempt
+DEFAULT_RETRIES = 4
+# Backoff delay (in seconds) for the first retry, this doubles for each retry after that
+BACKOFF_BASE = 1.0
+# Maximum backoff delay (in seconds)
+BACKOFF_MAX = 60.0
+# Maximum delay (in seconds) we'll accept from a Retry-After header
+RETRY_AFTER_MAX = 120.0
+# HTTP status codes that are worth retrying
+RETRY_CODES = (429, 500, 502, 503, 504)
+# Number of consecutive failures that opens the circuit
+BREAKER_THRESHOLD = 5
+# How long (in seconds) the circuit stays open before a trial request is let through
+BREAKER_TIMEOUT = 30.0
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of making a request while a data center's circuit breaker is open
+    """
+
+
+def parse_retry_after(value):
+    """
+    Parse a Retry-After header, which is either a number of seconds or an HTTP date.
+    Returns the delay in seconds, or None if there isn't a valid value.
+
+    >>> parse_retry_after("5")
+    5.0
+    >>> parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT")
+    0.0
+    >>> parse_retry_after("soon")
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max((when - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+def get_backoff(attempt, base=BACKOFF_BASE, maximum=BACKOFF_MAX):
+    """
+    Get the delay before the given retry (starting with 0), using exponential backoff with
+    "full jitter" so that many clients retrying at once don't all hit the server together.
+    """
+    return random.uniform(0, min(base * 2**attempt, maximum))
+
+
+class TokenBucket(object):
+    """
+    Token bucket rate limiter, allowing `rate` requests per second on average with bursts of up
+    to `capacity` requests.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = max(float(capacity), 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Take a token, returning how long (in seconds) the caller needs to wait before using it
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.tokens + (now - self.updated) * self.rate, self.capacity
+            )
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def release(self):
+        """
+        Give back a token that wasn't used
+        """
+        with self.lock:
+            self.tokens = min(self.tokens + 1, self.capacity)
+
+    def take(self):
+        """
+        Take a token, waiting as long as needed. If the thread has a `CancelToken`, cancelling it
+        ends the wait (giving the token back) with a `CancelledException`.
+        """
+        if self.rate > 0:
+            delay = self.reserve()
+            if delay:
+                token = get_cancel_token()
+                if not token:
+                    time.sleep(delay)
+                    return
+                try:
+                    token.wait(delay)
+                except CancelledException:
+                    self.release()
+                    raise
+
+
+class CircuitBreaker(object):
+    """
+    Tracks consecutive failures for a data center, and stops requests while it looks to be down
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, name, threshold=BREAKER_THRESHOLD, timeout=BREAKER_TIMEOUT):
+        self.name = name
+        self.threshold = threshold
+        self.timeout = timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def check(self):
+        """
+        Raise a `CircuitOpenError` if a request shouldn't be made now
+        """
+        with self.lock:
+            if self.state == self.CLOSED:
+                return
+            remaining = self.opened + self.timeout - time.monotonic()
+            if self.state == self.OPEN and remaining <= 0:
+                # Let one trial request through
+                LOGGER.info("Trying %s again", self.name)
+                self.state = self.HALF_OPEN
+                return
+            raise CircuitOpenError(
+                "Too many failures from %s, not trying again for %d seconds"
+                % (self.name, max(remaining, 1))
+            )
+
+    def success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                LOGGER.info("%s is responding again", self.name)
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (
+                self.state == self.CLOSED and self.failures >= self.threshold
+            ):
+                LOGGER.warning(
+                    "%s failed %d times in a row, pausing requests for %d seconds",
+                    self.name,
+                    self.failures,
+                    self.timeout,
+                )
+                self.state = self.OPEN
+                self.opened = time.monotonic()
+
+
+class Governor(object):
+    """
+    Applies the rate limit, retry policy and circuit breaker for one data center
+    """
+
+    def __init__(
+        self,
+        name,
+        rate=DEFAULT_RATE,
+        burst=DEFAULT_BURST,
+        retries=DEFAULT_RETRIES,
+    ):
+        self.name = name
+        self.retries = retries
+        self.bucket = TokenBucket(rate, burst)
+        self.breaker = CircuitBreaker(name)
+
+    def run(self, request):
+        """
+        Make a request, retrying as needed.
+
+        :param request: function making the request, returning a tuple of
+            (status code, content, Retry-After header value)
+        :return: (status code, content) from the last attempt
+        :raise: `CircuitOpenError` if the data center's circuit is open, `CancelledException` if the
+            thread's `CancelToken` is cancelled, or the exception from the last attempt if it failed
+            to connect
+        """
+        attempt = 0
+        while True:
+            self.breaker.check()
+            self.bucket.take()
+            retry_after = None
+            try:
+                (code, content, retry_after) = request()
+            except CancelledException:
+                raise
+            except Exception as e:
+                self.breaker.failure()
+                if attempt >= self.retries:
+                    raise
+                LOGGER.debug("Request to %s failed: %s", self.name, e)
+            else:
+                if code not in RETRY_CODES:
+                    # Note that errors like "bad request" still mean the server is working
+                    self.breaker.success()
+                    return (code, content)
+                self.breaker.failure()
+                if attempt >= self.retries:
+                    return (code, content)
+                LOGGER.debug("Request to %s returned %s", self.name, code)
+            delay = get_backoff(attempt)
+            retry_after = parse_retry_after(retry_after)
+            if retry_after is not None:
+                delay = max(delay, min(retry_after, RETRY_AFTER_MAX))
+            attempt += 1
+            LOGGER.info(
+                "Retrying request to %s in %.1f seconds (attempt %d of %d)",
+                self.name,
+                delay,
+                attempt,
+                self.retries,
+            )
+            token = get_cancel_token()
+            if token:
+                token.wait(delay)
+            else:
+                time.sleep(delay)
+
+
+class GovernorManager(object):
+    """
+    Holds the `Governor` for each data center
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, retries=DEFAULT_RETRIES):
+        self.rate = rate
+        self.retries = retries
+        self.governors = {}
+        self.lock = threading.Lock()
+
+    def get_governor(self, name):
+        """
+        Get the governor for the given data center, creating it if necessary
+        """
+        with self.lock:
+            governor = self.governors.get(name)
+            if not governor:
+                governor = self.governors[name] = Governor(
+                    name,
+                    rate=self.rate,
+                    burst=max(self.rate, 1),
+                    retries=self.retries,
+                )
+            return governor
@@ -17,11 +17,8 @@ from PyQt5 import QtWidgets
 from pyweed.gui.uic import MainWindow
 from pyweed.preferences import safe_int, safe_bool, bool_to_str
 import logging
-from pyweed.pyweed_utils import (
-    iter_channels,
-    get_preferred_origin,
-    get_preferred_magnitude,
-)
+import numpy as np
+from pyweed.pyweed_utils import iter_channels
 from pyweed.gui.Seismap import Seismap
 from pyweed.gui.EventOptionsWidget import EventOptionsWidget
 from pyweed.gui.StationOptionsWidget import StationOptionsWidget
@@ -61,34 +58,23 @@ class EventTableItems(TableItems):
 
     def rows(self, data):
         """
-        Turn the data into rows (an iterable of lists) of QTableWidgetItems
+        Turn the data (an EventTable) into rows (an iterable of lists) of QTableWidgetItems
         """
-        for i, event in enumerate(data):
-            origin = get_preferred_origin(event)
-            if not origin:
-                continue
-            magnitude = get_preferred_magnitude(event)
-            if not magnitude:
-                continue
-            time = origin.time.strftime(
-                "%Y-%m-%d %H:%M:%S"
-            )  # use strftime to remove milliseconds
-            event_description = "no description"
-            if len(event.event_descriptions) > 0:
-                event_description = event.event_descriptions[0].text
-
+        magnitudes = data.magnitudes.tolist()
+        longitudes = data.longitudes.tolist()
+        latitudes = data.latitudes.tolist()
+        depths = data.depths.tolist()
+        for i in np.flatnonzero(data.has_origin & data.has_magnitude).tolist():
             yield [
                 self.numericWidget(i),
-                self.stringWidget(time),
+                self.stringWidget(data.time_strs[i]),
                 self.numericWidget(
-                    magnitude.mag, "%s %s" % (magnitude.mag, magnitude.magnitude_type)
+                    magnitudes[i], "%s %s" % (magnitudes[i], data.magnitude_types[i])
                 ),
-                self.numericWidget(origin.longitude, "%.03f°"),
-                self.numericWidget(origin.latitude, "%.03f°"),
-                self.numericWidget(
-                    origin.depth / 1000, "%.02f km"
-                ),  # we wish to report in km
-                self.stringWidget(event_description.title()),
+                self.numericWidget(longitudes[i], "%.03f°"),
+                self.numericWidget(latitudes[i], "%.03f°"),
+                self.numericWidget(depths[i], "%.02f km"),  # we wish to report in km
+                self.stringWidget(data.descriptions[i]),
             ]
 
 
@@ -370,16 +356,14 @@ class MainWindow(QtWidgets.QMainWindow, MainWindow.Ui_MainWindow):
                 )
             elif options["location_choice"] == StationOptions.LOCATION_EVENTS:
                 # Show distance markers around all events
-                for event in self.pyweed.iter_selected_events():
-                    origin = get_preferred_origin(event)
-                    if origin:
-                        self.seismap.addMarkerToroid(
-                            markers,
-                            origin.latitude,
-                            origin.longitude,
-                            float(options["mindistance"]),
-                            float(options["maxdistance"]),
-                        )
+                for _id, (lat, lon) in self.pyweed.iter_selected_event_locations():
+                    self.seismap.addMarkerToroid(
+                        markers,
+                        lat,
+                        lon,
+                        float(options["mindistance"]),
+                        float(options["maxdistance"]),
+                    )
         except Exception as e:
             LOGGER.error("Failed to update seismap! %s", e, exc_info=True)
 
@@ -398,11 +382,11 @@ class MainWindow(QtWidgets.QMainWindow, MainWindow.Ui_MainWindow):
 
         if not self.eventTableItems:
             self.eventTableItems = EventTableItems(self.eventsTable)
-        self.eventTableItems.fill(events)
+        self.eventTableItems.fill(self.pyweed.event_table)
 
         # Add items to the map -------------------------------------------------
 
-        self.seismap.addEvents(events)
+        self.seismap.addEvents(self.pyweed.event_table)
 
         self.onEventSelectionChanged()
         status = "Finished loading events"
@@ -472,13 +456,13 @@ class MainWindow(QtWidgets.QMainWindow, MainWindow.Ui_MainWindow):
         # Get locations and event IDs
         points = []
         eventIDs = []
-        for id in ids:
-            event = self.pyweed.events[id]
-            origin = get_preferred_origin(event)
-            if not origin:
-                continue
-            points.append((origin.latitude, origin.longitude))
-            eventIDs.append(event.resource_id.id)
+        table = self.pyweed.event_table
+        if table:
+            rows = [row for row in ids if table.has_origin[row]]
+            points = list(
+                zip(table.latitudes[rows].tolist(), table.longitudes[rows].tolist())
+            )
+            eventIDs = [table.resource_ids[row] for row in rows]
 
         # Update the events_handler with the latest selection information
         self.pyweed.set_selected_event_ids(eventIDs)
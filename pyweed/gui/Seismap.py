@@ -17,7 +17,7 @@ from __future__ import (absolute_import, division, print_function)
 import numpy as np
 
 from mpl_toolkits.basemap import Basemap
-from pyweed.pyweed_utils import get_bounding_circle, get_preferred_origin, get_distance
+from pyweed.pyweed_utils import get_bounding_circle, get_distance
 from logging import getLogger
 from PyQt5 import QtCore
 from PyQt5.QtCore import pyqtSignal
@@ -279,16 +279,17 @@ class Seismap(QtCore.QObject):
         if redraw:
             self.canvas.draw_idle()
 
-    def addEvents(self, catalog):
+    def addEvents(self, event_table):
         """
         Display event locations
+
+        @param event_table: an EventTable
         """
-        points = [
-            (o.latitude, o.longitude)
-            for o in
-            [get_preferred_origin(e) for e in catalog]
-            if o
-        ]
+        located = event_table.has_origin
+        points = list(zip(
+            event_table.latitudes[located].tolist(),
+            event_table.longitudes[located].tolist()
+        ))
         self.addMarkers(self.eventMarkers, points)
 
     def addEventsHighlighting(self, points):
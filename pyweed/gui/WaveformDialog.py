@@ -9,12 +9,18 @@ Dialog for selecting and downloading waveform data
     (http://www.gnu.org/copyleft/lesser.html)
 """
 
+from contextlib import contextmanager
 from PyQt5 import QtWidgets, QtGui, QtCore
 from pyweed.gui.uic import WaveformDialog
 from pyweed.waveforms_handler import WaveformsHandler, NO_DATA_ERROR
 from logging import getLogger
 from pyweed.gui.TableItems import TableItems, Column
-from pyweed.pyweed_utils import get_event_name, TimeWindow, OUTPUT_FORMATS, PHASES
+from pyweed.pyweed_utils import (
+    TimeWindow,
+    OUTPUT_FORMATS,
+    PHASES,
+    CancelledException,
+)
 from pyweed.preferences import safe_int, safe_bool
 from pyweed.gui.Adapters import ComboBoxAdapter
 from pyweed.gui.BaseDialog import BaseDialog
@@ -104,6 +110,9 @@ class WaveformTableWidgetItem(CustomTableWidgetItemMixin, QtWidgets.QTableWidget
                 if waveform.image_path != self.imagePath:
                     self.imagePath = waveform.image_path
                     pic = QtGui.QPixmap(waveform.image_path)
+                    if pic.isNull():
+                        # Generate it again next time
+                        waveform.forget_file(waveform.image_path)
                     self.setData(QtCore.Qt.DecorationRole, pic)
                     self.setText("")
         else:
@@ -272,24 +281,49 @@ class WaveformDialog(BaseDialog, WaveformDialog.Ui_WaveformDialog):
         )
         # The callbacks here are expensive, so use QueuedConnection to run them asynchronously
         self.waveforms_handler.progress.connect(
-            self.onWaveformDownloaded, QtCore.Qt.QueuedConnection
+            self.onWaveformsDownloaded, QtCore.Qt.QueuedConnection
         )
         self.waveforms_handler.done.connect(
             self.onAllDownloaded, QtCore.Qt.QueuedConnection
         )
+        self.waveforms_handler.status.connect(
+            self.onDownloadStatus, QtCore.Qt.QueuedConnection
+        )
+        self.waveforms_handler.save_progress.connect(
+            self.onWaveformsSaved, QtCore.Qt.QueuedConnection
+        )
+        self.waveforms_handler.save_done.connect(
+            self.onAllSaved, QtCore.Qt.QueuedConnection
+        )
 
         # Spinner overlays for downloading and saving
         self.downloadSpinner = SpinnerWidget(
             "Downloading...", parent=self.downloadGroupBox
         )
         self.downloadSpinner.cancelled.connect(self.onDownloadCancel)
-        self.saveSpinner = SpinnerWidget(
-            "Saving...", cancellable=False, parent=self.saveGroupBox
-        )
+        self.saveSpinner = SpinnerWidget("Saving...", parent=self.saveGroupBox)
+        self.saveSpinner.cancelled.connect(self.onSaveCancel)
 
         # Connect signals associated with the main table
         # self.selectionTable.horizontalHeader().sortIndicatorChanged.connect(self.selectionTable.resizeRowsToContents)
         self.selectionTable.itemClicked.connect(self.handleTableItemClicked)
+        # Reprioritize downloads when the rows shown change
+        self.selectionTable.verticalScrollBar().valueChanged.connect(
+            self.onTableViewChanged
+        )
+        self.selectionTable.horizontalHeader().sortIndicatorChanged.connect(
+            self.onTableOrderChanged
+        )
+        # Scrolling generates a lot of events, so only reprioritize once it pauses
+        self.prioritizeTimer = QtCore.QTimer(self)
+        self.prioritizeTimer.setSingleShot(True)
+        self.prioritizeTimer.setInterval(200)
+        self.prioritizeTimer.timeout.connect(self.prioritizeDownloads)
+        # Downloaded waveforms are shown in batches, so a fast download doesn't flood the table
+        self.updateTimer = QtCore.QTimer(self)
+        self.updateTimer.setSingleShot(True)
+        self.updateTimer.setInterval(100)
+        self.updateTimer.timeout.connect(self.showDownloadedWaveforms)
 
         # Connect the Download and Save GUI elements
         self.downloadPushButton.clicked.connect(self.onDownloadPushButton)
@@ -317,10 +351,24 @@ class WaveformDialog(BaseDialog, WaveformDialog.Ui_WaveformDialog):
 
         # Dictionary of filter values
         self.filters = {}
+        # Waveform IDs of the rows matching the filters, in table order (None if not known)
+        self.matchingWaveformIDs = None
+        # Table row for each waveform ID (None if not known), see `getTableRow`
+        self.tableRows = None
+        # Downloaded waveform IDs waiting to be shown in the table
+        self.downloadedWaveformIDs = []
 
         # Information about download progress
+        self.waveformsDownloadStatus = STATUS_READY
         self.downloadCount = 0
         self.downloadCompleted = 0
+        self.downloadPipelineStatus = ""
+
+        # Information about save progress
+        self.waveformsSaveStatus = STATUS_READY
+        self.saveErrors = []
+        self.savedCount = 0
+        self.skippedCount = 0
 
         # Initialize the status messages to be blank
         self.downloadStatusLabel.setText("")
@@ -367,8 +415,8 @@ class WaveformDialog(BaseDialog, WaveformDialog.Ui_WaveformDialog):
         self.eventComboBox.clear()
 
         self.eventComboBox.addItem("All events")
-        for event in self.pyweed.iter_selected_events():
-            self.eventComboBox.addItem(get_event_name(event))
+        for row in self.pyweed.get_selected_event_rows():
+            self.eventComboBox.addItem(self.pyweed.event_table.get_name(row))
 
         # Add networks/stations to the networkComboBox and stationsComboBox ---------------------------
 
@@ -408,6 +456,7 @@ class WaveformDialog(BaseDialog, WaveformDialog.Ui_WaveformDialog):
         if not self.tableItems:
             self.tableItems = WaveformTableItems(self.selectionTable)
         self.tableItems.fill(self.iterWaveforms())
+        self.tableRows = None
 
         self.filterSelectionTable()
 
@@ -442,6 +491,56 @@ class WaveformDialog(BaseDialog, WaveformDialog.Ui_WaveformDialog):
                 return filterResults.get(waveformID)
 
             self.tableItems.filter(filterFn)
+            self.onTableOrderChanged()
+
+    def onTableOrderChanged(self):
+        """
+        Called when the set or order of rows matching the filters changes
+        """
+        self.matchingWaveformIDs = None
+        self.tableRows = None
+        self.onTableViewChanged()
+
+    def onTableViewChanged(self):
+        """
+        Called when the rows visible in the table change
+        """
+        if self.waveformsDownloadStatus == STATUS_WORKING:
+            self.prioritizeTimer.start()
+
+    def getDownloadPriorities(self):
+        """
+        Get the IDs of the waveforms that should be downloaded first.
+
+        @return a tuple of (IDs in the rows currently visible, IDs in all the rows matching the filters)
+        each in table order
+        """
+        table = self.selectionTable
+        if self.matchingWaveformIDs is None:
+            self.matchingWaveformIDs = [
+                table.item(row, WAVEFORM_ID_COLUMN).text()
+                for row in range(table.rowCount())
+                if not table.isRowHidden(row)
+            ]
+        visible_ids = []
+        first_row = table.rowAt(0)
+        if first_row >= 0:
+            last_row = table.rowAt(table.viewport().height() - 1)
+            if last_row < 0:
+                last_row = table.rowCount() - 1
+            for row in range(first_row, last_row + 1):
+                if not table.isRowHidden(row):
+                    visible_ids.append(table.item(row, WAVEFORM_ID_COLUMN).text())
+        return (visible_ids, self.matchingWaveformIDs)
+
+    @QtCore.pyqtSlot()
+    def prioritizeDownloads(self):
+        """
+        Have the downloader fetch the visible and matching rows first
+        """
+        if self.waveformsDownloadStatus == STATUS_WORKING:
+            (visible_ids, matching_ids) = self.getDownloadPriorities()
+            self.waveforms_handler.prioritize_waveforms(visible_ids, matching_ids)
 
     def iterWaveforms(self, saveable_only=False):
         """
@@ -465,7 +564,7 @@ class WaveformDialog(BaseDialog, WaveformDialog.Ui_WaveformDialog):
         net_code = sncl_parts[0]
         netsta_code = ".".join(sncl_parts[:2])
         filter_values = {
-            "event": get_event_name(waveform.event_ref()),
+            "event": waveform.event_name,
             "network": net_code,
             "station": netsta_code,
         }
@@ -537,6 +636,9 @@ class WaveformDialog(BaseDialog, WaveformDialog.Ui_WaveformDialog):
         start saving from the beginning.
         """
         LOGGER.debug("Save button reset")
+        if self.waveformsSaveStatus == STATUS_WORKING:
+            self.waveforms_handler.cancel_save()
+            self.saveSpinner.hide()
         self.waveformsSaveStatus = STATUS_READY
         self.updateToolbars()
 
@@ -556,14 +658,24 @@ class WaveformDialog(BaseDialog, WaveformDialog.Ui_WaveformDialog):
         self.waveformsDownloadStatus = STATUS_WORKING
         self.downloadCount = len(self.waveforms_handler.waveforms)
         self.downloadCompleted = 0
+        self.downloadPipelineStatus = ""
         self.downloadSpinner.show()
         self.updateToolbars()
 
-        # Priority is given to waveforms shown on the screen
-        priority_ids = [
-            waveform.waveform_id for waveform in self.waveforms_handler.waveforms
+        # Priority is given to waveforms shown on the screen, then to those matching the filters
+        (visible_ids, matching_ids) = self.getDownloadPriorities()
+        visible_set = set(visible_ids)
+        priority_ids = visible_ids + [
+            waveform_id
+            for waveform_id in matching_ids
+            if waveform_id not in visible_set
+        ]
+        priority_set = set(priority_ids)
+        other_ids = [
+            waveform.waveform_id
+            for waveform in self.waveforms_handler.waveforms
+            if waveform.waveform_id not in priority_set
         ]
-        other_ids = []
 
         self.waveforms_handler.download_waveforms(
             priority_ids,
@@ -571,53 +683,126 @@ class WaveformDialog(BaseDialog, WaveformDialog.Ui_WaveformDialog):
             self.timeWindowAdapter.timeWindow,
             self.downloadMetadataCheckBox.isChecked(),
         )
+        # This lets the downloader know which waveforms to move back if these change
+        self.waveforms_handler.prioritize_waveforms(visible_ids, matching_ids)
 
         # Update the table rows
-        for row in range(self.selectionTable.rowCount()):
-            waveform_id = self.selectionTable.item(row, WAVEFORM_ID_COLUMN).text()
-            waveform = self.waveforms_handler.waveforms_by_id.get(waveform_id)
-            self.selectionTable.item(row, WAVEFORM_IMAGE_COLUMN).setWaveform(waveform)
+        self.downloadedWaveformIDs = []
+        with self.tableUpdates():
+            for row in range(self.selectionTable.rowCount()):
+                waveform_id = self.selectionTable.item(row, WAVEFORM_ID_COLUMN).text()
+                waveform = self.waveforms_handler.waveforms_by_id.get(waveform_id)
+                self.selectionTable.item(row, WAVEFORM_IMAGE_COLUMN).setWaveform(
+                    waveform
+                )
 
     def getTableRow(self, waveform_id):
         """
-        Get the table row for a given waveform
+        Get the table row for a given waveform.
+
+        This looks up the row in `tableRows`, and rebuilds that if the row has moved (eg. because
+        the table was re-sorted).
         """
-        for row in range(self.selectionTable.rowCount()):
-            if self.selectionTable.item(row, WAVEFORM_ID_COLUMN).text() == waveform_id:
+        table = self.selectionTable
+        if self.tableRows is not None:
+            row = self.tableRows.get(waveform_id)
+            if (
+                row is not None
+                and table.item(row, WAVEFORM_ID_COLUMN).text() == waveform_id
+            ):
                 return row
-        return None
+        self.tableRows = dict(
+            (table.item(row, WAVEFORM_ID_COLUMN).text(), row)
+            for row in range(table.rowCount())
+        )
+        return self.tableRows.get(waveform_id)
 
-    @QtCore.pyqtSlot(object)
-    def onWaveformDownloaded(self, result):
+    @contextmanager
+    def tableUpdates(self):
         """
-        Called each time a waveform request has completed
+        Context for making a batch of changes to the waveform and keep columns of the table.
+
+        This holds off repainting until the end, and if the table is sorted on one of these
+        columns it holds off sorting too, so the table is sorted once rather than for every change.
         """
-        waveform_id = result.waveform_id
-        LOGGER.debug(
-            "Ready to display waveform %s (%s)",
-            waveform_id,
-            QtCore.QThread.currentThreadId(),
+        table = self.selectionTable
+        sorting = table.isSortingEnabled() and (
+            table.horizontalHeader().sortIndicatorSection()
+            in (WAVEFORM_IMAGE_COLUMN, WAVEFORM_KEEP_COLUMN)
         )
+        if sorting:
+            table.setSortingEnabled(False)
+        table.setUpdatesEnabled(False)
+        try:
+            yield
+        finally:
+            if sorting:
+                table.setSortingEnabled(True)
+                self.onTableOrderChanged()
+            table.setUpdatesEnabled(True)
 
-        self.downloadCompleted += 1
-        msg = "Downloaded %d of %d" % (self.downloadCompleted, self.downloadCount)
-        # self.downloadStatusLabel.setText(msg)
-        self.downloadSpinner.setLabel(msg)
+    @QtCore.pyqtSlot(object)
+    def onWaveformsDownloaded(self, results):
+        """
+        Called with each batch of completed waveform requests
+        """
+        self.downloadedWaveformIDs.extend(result.waveform_id for result in results)
+        self.downloadCompleted += len(results)
+        self.updateDownloadSpinner()
+        if not self.updateTimer.isActive():
+            self.updateTimer.start()
 
-        row = self.getTableRow(waveform_id)
-        if row is None:
-            LOGGER.error("Couldn't find a row for waveform %s", waveform_id)
+    @QtCore.pyqtSlot()
+    def showDownloadedWaveforms(self):
+        """
+        Update the table rows for all the waveforms downloaded since the last update
+        """
+        self.updateTimer.stop()
+        waveform_ids = self.downloadedWaveformIDs
+        if not waveform_ids:
             return
+        self.downloadedWaveformIDs = []
+        LOGGER.debug("Showing %d downloaded waveforms", len(waveform_ids))
+
+        hideNoData = self.hideNoDataCheckBox.isChecked()
+        with self.tableUpdates():
+            for waveform_id in waveform_ids:
+                row = self.getTableRow(waveform_id)
+                if row is None:
+                    LOGGER.error("Couldn't find a row for waveform %s", waveform_id)
+                    continue
+
+                waveform = self.waveforms_handler.waveforms_by_id.get(waveform_id)
+                self.selectionTable.item(row, WAVEFORM_IMAGE_COLUMN).setWaveform(
+                    waveform
+                )
+                self.selectionTable.item(row, WAVEFORM_KEEP_COLUMN).setKeep(
+                    waveform.keep
+                )
 
-        waveform = self.waveforms_handler.waveforms_by_id.get(waveform_id)
-        self.selectionTable.item(row, WAVEFORM_IMAGE_COLUMN).setWaveform(waveform)
-        self.selectionTable.item(row, WAVEFORM_KEEP_COLUMN).setKeep(waveform.keep)
+                # If hiding empty rows, do that here
+                if waveform.error == NO_DATA_ERROR and hideNoData:
+                    self.selectionTable.hideRow(row)
 
-        # If hiding empty rows, do that here
-        if waveform.error == NO_DATA_ERROR and self.hideNoDataCheckBox.isChecked():
-            self.selectionTable.hideRow(row)
+    @QtCore.pyqtSlot(object)
+    def onDownloadStatus(self, depths):
+        """
+        Called periodically with the state of the download pipeline (see `Pipeline.depths`)
+        """
+        self.downloadPipelineStatus = ", ".join(
+            "%s: %d queued / %d active" % depth for depth in depths
+        )
+        self.updateDownloadSpinner()
 
-        LOGGER.debug("Downloaded waveform %s", waveform_id)
+    def updateDownloadSpinner(self):
+        """
+        Show the download progress in the spinner
+        """
+        msg = "Downloaded %d of %d" % (self.downloadCompleted, self.downloadCount)
+        if self.downloadPipelineStatus:
+            msg = "%s\n%s" % (msg, self.downloadPipelineStatus)
+        # self.downloadStatusLabel.setText(msg)
+        self.downloadSpinner.setLabel(msg)
 
     @QtCore.pyqtSlot(object)
     def onAllDownloaded(self, result):
@@ -626,6 +811,9 @@ class WaveformDialog(BaseDialog, WaveformDialog.Ui_WaveformDialog):
         """
         LOGGER.debug("COMPLETED all downloads")
 
+        # Show anything still waiting for the update timer
+        self.showDownloadedWaveforms()
+
         if self.waveformsDownloadStatus == STATUS_WORKING:
             self.downloadSpinner.hide()
 
@@ -648,42 +836,64 @@ class WaveformDialog(BaseDialog, WaveformDialog.Ui_WaveformDialog):
     def saveWaveformData(self):
         """
         Save waveforms after all downloads are complete.
+
+        The saving is done in the background, see `onWaveformsSaved` and `onAllSaved`.
         """
 
         # Update status
         self.waveformsSaveStatus = STATUS_WORKING
         self.updateToolbars()
 
-        # Update GUI in case we came from an internal call
-        QtWidgets.QApplication.processEvents()
+        self.saveErrors = []
+        self.savedCount = 0
+        self.skippedCount = 0
 
-        errors = []
-        savedCount = 0
-        skippedCount = 0
+        try:
+            self.waveforms_handler.save_waveforms(
+                self.waveformDirectory,
+                self.saveFormatAdapter.getValue(),
+                list(self.iterWaveforms(saveable_only=True)),
+                self.sacUseEventTimeCheckBox.isChecked(),
+            )
+        except Exception as e:
+            self.onAllSaved(e)
+
+    @QtCore.pyqtSlot(object)
+    def onWaveformsSaved(self, results):
+        """
+        Called with each batch of saved waveforms
+        """
+        for result in results:
+            if isinstance(result.result, Exception):
+                self.saveErrors.append("%s: %s" % (result.waveform_id, result.result))
+            elif result.result:
+                self.savedCount += 1
+            else:
+                self.skippedCount += 1
+        self.saveSpinner.setLabel("Saved %d new waveforms" % self.savedCount)
 
+    @QtCore.pyqtSlot(object)
+    def onAllSaved(self, result):
+        """
+        Called when the save has finished
+        """
+        if self.waveformsSaveStatus != STATUS_WORKING or isinstance(
+            result, CancelledException
+        ):
+            # Save was cancelled
+            return
+
+        errors = self.saveErrors
         try:
-            waveforms = self.iterWaveforms(saveable_only=True)
-            outputDir = self.waveformDirectory
-            outputFormat = self.saveFormatAdapter.getValue()
+            if isinstance(result, Exception):
+                raise result
 
-            for result in self.waveforms_handler.save_waveforms_iter(
-                outputDir, outputFormat, waveforms
-            ):
-                if isinstance(result.result, Exception):
-                    errors.append("%s: %s" % (result.waveform_id, result.result))
-                elif result.result:
-                    savedCount += 1
-                    self.saveSpinner.setLabel("Saved %d new waveforms" % savedCount)
-                    QtWidgets.QApplication.processEvents()  # update GUI
-                else:
-                    skippedCount += 1
-            self.saveStatusLabel.setText("Saved %d new waveforms" % savedCount)
-            self.saveStatusLabel.repaint()
+            self.saveStatusLabel.setText("Saved %d new waveforms" % self.savedCount)
 
             LOGGER.info(
                 "Save complete: %d saved, %d already existed, %d errors",
-                savedCount,
-                skippedCount,
+                self.savedCount,
+                self.skippedCount,
                 len(errors),
             )
 
@@ -709,6 +919,15 @@ class WaveformDialog(BaseDialog, WaveformDialog.Ui_WaveformDialog):
         self.saveSpinner.hide()
         LOGGER.debug("COMPLETED saving all waveforms")
 
+    @QtCore.pyqtSlot()
+    def onSaveCancel(self):
+        if self.waveformsSaveStatus == STATUS_WORKING:
+            # Cancel running save (or one waiting for the download to finish)
+            self.waveforms_handler.cancel_save()
+            self.waveformsSaveStatus = STATUS_READY
+            self.saveSpinner.hide()
+            self.updateToolbars()
+
     @QtCore.pyqtSlot()
     def getWaveformDirectory(self):
         """
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Raw MiniSEED record handling.
+
+This works on the fixed header of each MiniSEED 2 record, without decoding any samples, so that
+downloaded data can be split up and written to the cache exactly as the server sent it.
+
+:copyright:
+    Mazama Science, IRIS
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+
+import datetime
+import struct
+from collections import namedtuple
+
+# Size of the fixed section of the data header
+FIXED_HEADER_SIZE = 48
+# Valid data quality indicators
+QUALITY_CODES = b"DRQM"
+# Blockette giving the record length
+BLOCKETTE_1000 = 1000
+# Activity flag set when the time correction has already been applied
+TIME_CORRECTION_APPLIED = 0x02
+# Ordinal of the Unix epoch, for converting dates to timestamps
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+# Data encodings (from blockette 1000) for uncompressed integers
+INTEGER_ENCODINGS = (1, 2, 3)
+
+#: A record in a block of MiniSEED data. The times are POSIX timestamps, and `end` is the time of
+#: the last sample. `encoding` is the data encoding code from blockette 1000.
+Record = namedtuple("Record", ["sncl", "start", "end", "offset", "length", "encoding"])
+
+
+def get_sample_rate(factor, multiplier):
+    """
+    Calculate the sample rate from the header's rate factor and multiplier
+
+    >>> get_sample_rate(40, 1)
+    40.0
+    >>> get_sample_rate(-10, 1)
+    0.1
+    """
+    if not factor or not multiplier:
+        return 0.0
+    if factor > 0 and multiplier > 0:
+        return float(factor * multiplier)
+    if factor > 0:
+        return -float(factor) / multiplier
+    if multiplier > 0:
+        return -float(multiplier) / factor
+    return 1.0 / (factor * multiplier)
+
+
+def read_record(data, offset):
+    """
+    Read the header of the record at the given offset
+
+    :raise ValueError: if there isn't a valid MiniSEED 2 record there
+    """
+    if len(data) - offset < FIXED_HEADER_SIZE:
+        raise ValueError("Truncated record at offset %d" % offset)
+    if data[offset + 6] not in QUALITY_CODES:
+        raise ValueError("Not a MiniSEED 2 record at offset %d" % offset)
+    # Byte order isn't flagged anywhere, so check for a sensible year
+    for byte_order in (">", "<"):
+        (year,) = struct.unpack_from(byte_order + "H", data, offset + 20)
+        if 1900 <= year <= 2100:
+            break
+    else:
+        raise ValueError("Invalid record start time at offset %d" % offset)
+    (
+        year,
+        day,
+        hour,
+        minute,
+        second,
+        _unused,
+        fraction,
+        samples,
+        rate_factor,
+        rate_multiplier,
+        activity_flags,
+        _io_flags,
+        _quality_flags,
+        _blockettes,
+        time_correction,
+        _data_offset,
+        blockette_offset,
+    ) = struct.unpack_from(byte_order + "HHBBBBHHhhBBBBiHH", data, offset + 20)
+
+    # Find the record length and encoding in blockette 1000
+    length = None
+    encoding = None
+    seen = set()
+    while blockette_offset and blockette_offset not in seen:
+        seen.add(blockette_offset)
+        position = offset + blockette_offset
+        if position + 7 > len(data):
+            break
+        (blockette_type, next_offset) = struct.unpack_from(
+            byte_order + "HH", data, position
+        )
+        if blockette_type == BLOCKETTE_1000:
+            encoding = data[position + 4]
+            length = 2 ** data[position + 6]
+            break
+        blockette_offset = next_offset
+    if not length or length < FIXED_HEADER_SIZE:
+        raise ValueError("No record length for record at offset %d" % offset)
+    if offset + length > len(data):
+        raise ValueError("Truncated record at offset %d" % offset)
+
+    start = (
+        (datetime.date(year, 1, 1).toordinal() - EPOCH_ORDINAL + day - 1) * 86400
+        + hour * 3600
+        + minute * 60
+        + second
+        + fraction * 0.0001
+    )
+    if time_correction and not activity_flags & TIME_CORRECTION_APPLIED:
+        start += time_correction * 0.0001
+    rate = get_sample_rate(rate_factor, rate_multiplier)
+    end = start + (samples - 1) / rate if rate and samples else start
+    sncl = ".".join(
+        data[offset + a : offset + b].decode("ascii", "replace").strip()
+        for (a, b) in ((18, 20), (8, 13), (13, 15), (15, 18))
+    )
+    return Record(sncl, start, end, offset, length, encoding)
+
+
+def iter_records(data):
+    """
+    Iterate over the records in a block of MiniSEED data
+
+    :raise ValueError: if the data isn't all valid MiniSEED 2 records
+    """
+    offset = 0
+    while offset < len(data):
+        record = read_record(data, offset)
+        yield record
+        offset += record.length
+
+
+def index_records(data):
+    """
+    Index a block of MiniSEED data, returning a dictionary of SNCL -> list of `Record`
+
+    :raise ValueError: if the data isn't all valid MiniSEED 2 records
+    """
+    index = {}
+    for record in iter_records(data):
+        index.setdefault(record.sncl, []).append(record)
+    return index
+
+
+def select_records(data, records, start, end):
+    """
+    Get the data for all the given records that overlap a time window
+
+    :param records: `Record` entries for the data
+    :param start: start of the window, as a POSIX timestamp
+    :param end: end of the window, as a POSIX timestamp
+    :return: the selected records, concatenated in their original order
+    """
+    return b"".join(
+        data[record.offset : record.offset + record.length]
+        for record in records
+        if record.start <= end and record.end >= start
+    )
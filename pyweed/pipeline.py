@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-stage work pipeline with bounded queues.
+
+Each stage runs in its own set of worker threads and feeds the next stage through a bounded
+queue, so slow stages apply backpressure to the stages before them instead of tying up their
+workers. This lets I/O-bound stages (many workers) overlap with CPU-bound stages (few workers).
+
+:copyright:
+    Mazama Science, IRIS
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+
+import heapq
+import itertools
+import queue
+import threading
+from logging import getLogger
+
+LOGGER = getLogger(__name__)
+
+# How often (in seconds) blocked workers check whether the pipeline has been stopped
+POLL_INTERVAL = 0.1
+
+
+class PriorityQueue(object):
+    """
+    Queue whose waiting items can be reordered, for use as the first stage queue of a `Pipeline`.
+
+    Items come out lowest priority first, and in the order they were added for equal priorities.
+    Each item is identified by `key(item)`, which is what `set_priorities` uses to find it.
+    This has the parts of the `queue.Queue` interface that `Pipeline` uses, and is unbounded.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        # Heap of [priority, sequence, item] entries
+        self.heap = []
+        # Entries by key
+        self.entries = {}
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+
+    def put(self, item, block=True, timeout=None, priority=0):
+        with self.condition:
+            entry = [priority, next(self.counter), item]
+            self.entries[self.key(item)] = entry
+            heapq.heappush(self.heap, entry)
+            self.condition.notify()
+
+    def get(self, block=True, timeout=None):
+        with self.condition:
+            if block and not self.condition.wait_for(lambda: self.heap, timeout):
+                raise queue.Empty()
+            if not self.heap:
+                raise queue.Empty()
+            (_priority, _sequence, item) = heapq.heappop(self.heap)
+            self.entries.pop(self.key(item), None)
+            return item
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def qsize(self):
+        with self.condition:
+            return len(self.heap)
+
+    def set_priorities(self, priorities):
+        """
+        Change the priorities of waiting items
+
+        :param priorities: dictionary of key -> priority, keys of items that are no longer waiting
+            are ignored
+        """
+        with self.condition:
+            changed = False
+            for key, priority in priorities.items():
+                entry = self.entries.get(key)
+                if entry and entry[0] != priority:
+                    entry[0] = priority
+                    changed = True
+            if changed:
+                heapq.heapify(self.heap)
+
+
+class Stage(object):
+    """
+    Defines one stage of a `Pipeline`.
+
+    A stage function takes a single item and returns a result. If the stage is `batched`, the
+    function instead takes a list of items and returns a list of (item, result) pairs.
+
+    A result of `Pipeline.CONTINUE` passes the item on to the next stage, any other result (including
+    an Exception) finishes the item. A stage function may also raise an exception, which finishes all
+    the items it was given.
+
+    By default each stage has a FIFO queue, a different queue (eg. a `PriorityQueue`) can be given
+    instead.
+    """
+
+    def __init__(
+        self,
+        name,
+        fn,
+        workers=1,
+        queue_size=0,
+        batch_size=1,
+        linger=0,
+        stage_queue=None,
+        batched=None,
+    ):
+        """
+        :param name: name used for logging and reporting
+        :param fn: the stage function
+        :param workers: number of worker threads for this stage
+        :param queue_size: maximum number of items waiting for this stage (0 is unbounded)
+        :param batch_size: maximum number of items passed to the stage function at once
+        :param linger: how long (in seconds) to wait for more items when filling a batch
+        :param stage_queue: queue to use instead of the default (in which case `queue_size` is
+            ignored)
+        :param batched: whether the stage function takes a list of items, by default this is true
+            if `batch_size` is more than 1
+        """
+        self.name = name
+        self.fn = fn
+        self.workers = max(workers, 1)
+        self.batch_size = max(batch_size, 1)
+        self.batched = self.batch_size > 1 if batched is None else batched
+        self.linger = linger
+        if stage_queue is None:
+            stage_queue = queue.Queue(queue_size)
+        self.queue = stage_queue
+        #: Number of items currently being worked on
+        self.active = 0
+
+
+class Pipeline(object):
+    """
+    Runs items through a series of stages, for example::
+
+        pipeline = Pipeline([
+            Stage("fetch", fetch_fn, workers=10, queue_size=100),
+            Stage("render", render_fn, workers=2, queue_size=10),
+        ])
+        pipeline.start()
+        pipeline.feed(items)
+        for i in range(len(items)):
+            (item, result) = pipeline.get_result()
+        pipeline.stop()
+    """
+
+    #: Stage function result indicating that the item should go on to the next stage
+    CONTINUE = object()
+
+    def __init__(self, stages):
+        self.stages = stages
+        self.results = queue.Queue()
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def start(self):
+        """
+        Start the worker threads for all stages
+        """
+        for index, stage in enumerate(self.stages):
+            for i in range(stage.workers):
+                thread = threading.Thread(
+                    target=self.work,
+                    args=(index,),
+                    name="%s-%d" % (stage.name, i),
+                    daemon=True,
+                )
+                thread.start()
+                self.threads.append(thread)
+
+    def feed(self, items):
+        """
+        Feed items into the first stage. This runs in a separate thread, since it will block
+        whenever the first stage is full.
+        """
+        thread = threading.Thread(
+            target=self.feed_all, args=(items,), name="feed", daemon=True
+        )
+        thread.start()
+        self.threads.append(thread)
+
+    def feed_all(self, items):
+        for item in items:
+            if not self.put(0, item):
+                return
+
+    def put(self, index, item):
+        """
+        Put an item on the queue for the given stage, blocking while the queue is full.
+        Returns False if the pipeline was stopped while waiting.
+        """
+        stage_queue = self.stages[index].queue
+        while not self.stopped.is_set():
+            try:
+                stage_queue.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def take(self, stage):
+        """
+        Take the next batch of items for the given stage, blocking until at least one is available.
+        Returns None if the pipeline was stopped while waiting.
+        """
+        batch = None
+        while batch is None:
+            if self.stopped.is_set():
+                return None
+            try:
+                batch = [stage.queue.get(timeout=POLL_INTERVAL)]
+            except queue.Empty:
+                pass
+        while len(batch) < stage.batch_size:
+            try:
+                if stage.linger:
+                    batch.append(stage.queue.get(timeout=stage.linger))
+                else:
+                    batch.append(stage.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def work(self, index):
+        """
+        Worker thread for the stage at the given index
+        """
+        stage = self.stages[index]
+        is_last = index + 1 >= len(self.stages)
+        while True:
+            self.work_batch(index, stage, is_last)
+            if self.stopped.is_set():
+                return
+
+    def work_batch(self, index, stage, is_last):
+        """
+        Take and process one batch of items for the given stage
+        """
+        batch = self.take(stage)
+        if batch is None:
+            return
+        with self.lock:
+            stage.active += 1
+        try:
+            try:
+                if stage.batched:
+                    results = stage.fn(batch)
+                else:
+                    results = [(batch[0], stage.fn(batch[0]))]
+            except Exception as e:
+                results = [(item, e) for item in batch]
+            for item, result in results:
+                if result is not self.CONTINUE:
+                    self.results.put((item, result))
+                elif is_last:
+                    self.results.put((item, True))
+                else:
+                    self.put(index + 1, item)
+        finally:
+            with self.lock:
+                stage.active -= 1
+
+    def get_result(self, timeout=None):
+        """
+        Get the next finished item, as an (item, result) pair.
+        Returns None if nothing finished within the timeout.
+        """
+        try:
+            return self.results.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def depths(self):
+        """
+        Get the current state of each stage, as a list of (name, queued, active) tuples
+        """
+        with self.lock:
+            return [
+                (stage.name, stage.queue.qsize(), stage.active) for stage in self.stages
+            ]
+
+    def stop(self):
+        """
+        Stop all the workers. Items still in the pipeline are dropped.
+        """
+        LOGGER.debug("Stopping pipeline")
+        self.stopped.set()
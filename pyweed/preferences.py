@@ -40,6 +40,13 @@ def safe_int(s, default=0):
         return default
 
 
+def safe_float(s, default=0.0):
+    try:
+        return float(s)
+    except:
+        return default
+
+
 class Section(object):
     def __init__(self, **initial):
         self.__dict__.update(initial)
@@ -97,6 +104,12 @@ class Preferences(QtCore.QObject):
         self.Data.stationDataCenter = "IRIS"
         self.Data.username = ""
         self.Data.password = ""
+        # Tuned number of concurrent requests for each data center (JSON)
+        self.Data.concurrency = "{}"
+        # Maximum requests per second to each data center (0 for no limit)
+        self.Data.rateLimit = "20"
+        # Number of times to retry a request after a transient failure
+        self.Data.maxRetries = "4"
 
         self.Waveforms = Section.create("Waveforms")
         self.Waveforms.downloadDir = user_download_path()
@@ -110,7 +123,22 @@ class Preferences(QtCore.QObject):
         self.Waveforms.useEventTime = "n"
         self.Waveforms.hideNoData = "n"
         self.Waveforms.downloadMetadata = "y"
+        # Starting number of concurrent requests, for data centers that haven't been tuned yet
         self.Waveforms.threads = "5"
+        # Threads for CPU-bound work (eg. rendering waveform images)
+        self.Waveforms.renderThreads = "2"
+        # Waveforms per dataselect POST request (1 means no bulk requests)
+        self.Waveforms.bulkSize = "50"
+        # Processes for saving waveforms (0 means one per CPU core)
+        self.Waveforms.saveProcesses = "0"
+        # Length (in seconds) of the segments downloaded data is stored in (0 to store each
+        # waveform's data on its own)
+        self.Waveforms.segmentLength = "600"
+        # Store the download cache compressed (see pyweed.compression)
+        self.Waveforms.compressCache = "n"
+        # Calculate phase arrivals exactly with TauP, rather than from the travel time tables (see
+        # pyweed.traveltimes)
+        self.Waveforms.exactArrivals = "n"
 
         self.Logging = Section.create("Logging")
         self.Logging.level = "INFO"
@@ -176,7 +204,7 @@ class Preferences(QtCore.QObject):
             # Override defaults with anything found in config.ini
             f = open(path, "r")
             config = ConfigParser()
-            config.readfp(f)
+            config.read_file(f)
 
             sections = [
                 self.Data,
@@ -14,30 +14,57 @@ from __future__ import absolute_import, division, print_function
 
 # Basic packages
 import os
+import json
 import logging
 from typing import Dict
+import numpy as np
 
 # Pyweed UI components
+from pyweed.cache import CacheIndex, CacheEvictor
 from pyweed.clients import ClientManager
-from pyweed.preferences import Preferences, user_config_path
+from pyweed.preferences import Preferences, user_config_path, safe_int, safe_float
 from pyweed.pyweed_utils import (
-    manage_cache,
     iter_channels,
     get_sncl,
-    get_preferred_origin,
     DataRequest,
-    get_distance,
+    get_distance_matrix,
 )
 from obspy.clients.fdsn import Client
 from pyweed.event_options import EventOptions
 from pyweed.station_options import StationOptions
 from pyweed.events_handler import EventsHandler
+from pyweed.event_table import EventTable
 from pyweed.stations_handler import StationsHandler, StationsDataRequest
 from PyQt5.QtCore import QObject
 
 LOGGER = logging.getLogger(__name__)
 
 
+def load_concurrency_limits(value):
+    """
+    Parse the saved concurrency limits preference, which is a JSON dictionary of data center -> limit
+    """
+    try:
+        limits = json.loads(value)
+        if isinstance(limits, dict):
+            return limits
+    except Exception:
+        pass
+    LOGGER.warning("Ignoring invalid concurrency limits: %s", value)
+    return {}
+
+
+def save_concurrency_limits(limits):
+    """
+    Save the tuned concurrency limits (see `load_concurrency_limits`) without touching the rest of
+    the saved preferences
+    """
+    preferences = Preferences()
+    preferences.load()
+    preferences.Data.concurrency = json.dumps(limits, sort_keys=True)
+    preferences.save()
+
+
 class NoConsoleLoggingFilter(logging.Filter):
     """
     Logging filter that excludes the (very noisy) output from the attached Python console
@@ -65,9 +92,13 @@ class PyWeedCore(QObject):
 
     client_manager: ClientManager = None
 
+    cache_index: CacheIndex = None
+    cache_evictor: CacheEvictor = None
+
     event_options: EventOptions = None
     events_handler: EventsHandler = None
     events = None
+    event_table: EventTable = None
     selected_event_ids = None
 
     station_options: StationOptions = None
@@ -100,6 +131,10 @@ class PyWeedCore(QObject):
             self.preferences.Data.stationDataCenter,
             self.preferences.Data.username,
             self.preferences.Data.password,
+            load_concurrency_limits(self.preferences.Data.concurrency),
+            safe_int(self.preferences.Waveforms.threads, 5),
+            safe_float(self.preferences.Data.rateLimit, 20.0),
+            safe_int(self.preferences.Data.maxRetries, 4),
         )
 
     def load_preferences(self):
@@ -145,6 +180,10 @@ class PyWeedCore(QObject):
                 self.preferences.Data.stationDataCenter = (
                     self.client_manager.station_data_center
                 )
+            if self.client_manager.concurrency:
+                self.preferences.Data.concurrency = json.dumps(
+                    self.client_manager.concurrency.get_limits(), sort_keys=True
+                )
             self.preferences.save()
         except Exception as e:
             LOGGER.error("Unable to save configuration preferences: %s", e)
@@ -180,11 +219,11 @@ class PyWeedCore(QObject):
         Make sure the waveform download directory exists and isn't full
         """
         download_path = self.preferences.Waveforms.downloadDir
-        cache_size = int(self.preferences.Waveforms.cacheSize)
+        cache_size = safe_int(self.preferences.Waveforms.cacheSize, 50)
         LOGGER.info("Checking on download directory...")
-        if os.path.exists(download_path):
-            manage_cache(download_path, cache_size)
-        elif init:
+        if not os.path.exists(download_path):
+            if not init:
+                return
             try:
                 os.makedirs(download_path, 0o700)
             except Exception as e:
@@ -192,6 +231,30 @@ class PyWeedCore(QObject):
                     "Creation of download directory failed with" + " error: \"%s'" % e
                 )
                 raise
+        try:
+            cache_index = self.get_cache_index()
+            cache_index.evict(cache_size * 1000000)
+            cache_index.commit()
+            if init:
+                # Keep the size down while PyWEED is running
+                if self.cache_evictor:
+                    self.cache_evictor.stop()
+                self.cache_evictor = CacheEvictor(cache_index, cache_size * 1000000)
+                self.cache_evictor.start()
+        except Exception as e:
+            LOGGER.error("Failed to manage the download cache: %s", e)
+
+    def get_cache_index(self):
+        """
+        Get the index of the waveform download directory, opening it if necessary
+        """
+        download_path = os.path.abspath(self.preferences.Waveforms.downloadDir)
+        if self.cache_index and self.cache_index.directory != download_path:
+            self.cache_index.close()
+            self.cache_index = None
+        if not self.cache_index:
+            self.cache_index = CacheIndex(download_path)
+        return self.cache_index
 
     ###############
     # Events
@@ -235,30 +298,36 @@ class PyWeedCore(QObject):
         """
         LOGGER.info("Set events")
         self.events = events
+        self.event_table = EventTable(events) if events is not None else None
 
     def set_selected_event_ids(self, event_ids):
         self.selected_event_ids = event_ids
 
+    def get_selected_event_rows(self):
+        """
+        Get the rows in the event table for the selected events
+        """
+        if not self.event_table or not self.selected_event_ids:
+            return []
+        return self.event_table.get_rows(self.selected_event_ids)
+
     def iter_selected_events(self):
         """
         Iterate over the selected events
         """
-        if self.events:
-            for event in self.events:
-                event_id = event.resource_id.id
-                if event_id in self.selected_event_ids:
-                    yield event
+        for row in self.get_selected_event_rows():
+            yield self.event_table.get_event(row)
 
     def iter_selected_event_locations(self):
         """
         Return an iterator of (id, (lat, lon)) for each event.
         """
-        for event in self.iter_selected_events():
-            origin = get_preferred_origin(event)
-            if origin:
+        table = self.event_table
+        for row in self.get_selected_event_rows():
+            if table.has_origin[row]:
                 yield (
-                    event.resource_id.id,
-                    (origin.latitude, origin.longitude),
+                    table.resource_ids[row],
+                    (float(table.latitudes[row]), float(table.longitudes[row])),
                 )
 
     ###############
@@ -315,6 +384,8 @@ class PyWeedCore(QObject):
     def iter_selected_events_stations(self):
         """
         Iterate through the selected event/station combinations.
+        Yields (event row, network, station, channel, distance) for each combination, the
+        event row is the event's row in `event_table`.
 
         The main use case this method is meant to handle is where the user
         loaded stations based on selected events.
@@ -323,49 +394,80 @@ class PyWeedCore(QObject):
         within 20 degrees of any event, there may be stations that are within 20 degrees
         of one event but farther away from others -- we want to ensure that we only include
         the event/station combinations that are within 20 degrees of each other.
+
+        The distances are calculated for all the events and stations at once, see
+        `get_distance_matrix`.
         """
-        events = list(self.iter_selected_events())
+        rows = self.get_selected_event_rows()
+        channels = list(self.iter_selected_stations())
+        if not rows or not channels:
+            return
 
         # Look for any event-based distance filter
         distance_range = self.station_options.get_event_distances()
 
-        if distance_range:
-            # Event locations by id
-            event_locations = dict(self.iter_selected_event_locations())
-        else:
-            event_locations = {}
-
-        # Iterate through the stations
-        for network, station, channel in self.iter_selected_stations():
-            for event in events:
-                if distance_range:
-                    event_location = event_locations.get(event.resource_id.id)
-                    if event_location:
-                        distance = get_distance(
-                            event_location[0],
-                            event_location[1],
-                            station.latitude,
-                            station.longitude,
-                        )
-                        LOGGER.debug(
-                            "Distance from (%s, %s) to (%s, %s): %s",
-                            event_location[0],
-                            event_location[1],
-                            station.latitude,
-                            station.longitude,
-                            distance,
-                        )
-                        if (
-                            distance < distance_range["mindistance"]
-                            or distance > distance_range["maxdistance"]
-                        ):
-                            continue
-                # If we reach here, include this event/station pair
-                yield (event, network, station, channel)
-
-    def close(self):
+        # Event locations, NaN for any event without one
+        event_lats = self.event_table.latitudes[rows]
+        event_lons = self.event_table.longitudes[rows]
+
+        # Distances only need to be calculated once for each station
+        station_indexes = {}
+        station_locations = []
+        for network, station, channel in channels:
+            if id(station) not in station_indexes:
+                station_indexes[id(station)] = len(station_locations)
+                station_locations.append((station.latitude, station.longitude))
+        station_locations = np.array(station_locations, dtype=float)
+
+        # Station x event distances, NaN where the pair is out of range
+        distances = get_distance_matrix(
+            station_locations[:, 0],
+            station_locations[:, 1],
+            event_lats,
+            event_lons,
+            distance_range.get("mindistance"),
+            distance_range.get("maxdistance"),
+        )
+        # Events without a location can't be filtered by distance, so they're always included
+        unlocated = np.isnan(event_lats)
+
+        # The (event, distance) pairs for each station
+        station_pairs = {}
+        for network, station, channel in channels:
+            index = station_indexes[id(station)]
+            if index not in station_pairs:
+                station_distances = distances[index]
+                included = np.flatnonzero(~np.isnan(station_distances) | unlocated)
+                station_pairs[index] = [
+                    (rows[i], None if distance != distance else distance)
+                    for (i, distance) in zip(
+                        included.tolist(), station_distances[included].tolist()
+                    )
+                ]
+            for event_row, distance in station_pairs[index]:
+                yield (event_row, network, station, channel, distance)
+
+    def close(self, save_preferences=True):
+        """
+        Shut down the cache and save the preferences
+
+        :param save_preferences: if False, only the tuned concurrency limits are saved (eg. for a
+            batch job, whose options shouldn't replace the user's)
+        """
+        if self.cache_evictor:
+            self.cache_evictor.stop()
+            self.cache_evictor = None
         self.manage_cache(init=False)
-        self.save_preferences()
+        if self.cache_index:
+            self.cache_index.close()
+            self.cache_index = None
+        if save_preferences:
+            self.save_preferences()
+        elif self.client_manager.concurrency:
+            try:
+                save_concurrency_limits(self.client_manager.concurrency.get_limits())
+            except Exception as e:
+                LOGGER.error("Unable to save concurrency limits: %s", e)
 
 
 if __name__ == "__main__":
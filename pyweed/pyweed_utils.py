@@ -15,7 +15,13 @@ from __future__ import absolute_import, division, print_function
 import os
 import logging
 import re
+import shutil
+import sys
+import threading
+import uuid
+from contextlib import contextmanager
 from typing import Dict
+import numpy as np
 from pyproj import Geod
 from obspy import UTCDateTime
 from obspy.core.event import Event
@@ -24,12 +30,23 @@ from obspy.clients.fdsn import Client
 from obspy.taup.tau import TauPyModel
 from urllib.parse import urlencode
 
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows
+    fcntl = None
+
 LOGGER = logging.getLogger(__name__)
 GEOD = Geod(ellps="WGS84")
 TAUP = TauPyModel()
+# The travel time model isn't safe to use from multiple threads at once
+TAUP_LOCK = threading.Lock()
 
 # Rough meters/degree calculation
 M_PER_DEG = (GEOD.inv(0, 0, 0, 1)[2] + GEOD.inv(0, 0, 1, 0)[2]) / 2
+# Spherical distances are within this fraction (plus a hundredth of a degree) of `get_distance`,
+# the actual difference is up to about twice the flattening of the ellipsoid
+SPHERICAL_DISTANCE_ERROR = 0.01
 
 
 class OutputFormat(object):
@@ -87,50 +104,83 @@ PHASES = [
 # Actual phase values retrieved from TauP, this should give us a good P and S value for any input (I hope!)
 TAUP_PHASES = ["P", "PKIKP", "Pdiff", "S", "SKIKS", "SKS", "p", "s"]
 
+# ioctl request to clone a file (Linux)
+FICLONE = 0x40049409
+
 
-def manage_cache(download_dir, cache_size):
+def reflink(source, dest):
+    """
+    Try to create `dest` as a copy-on-write clone of `source`. This only works on Linux, on
+    filesystems that support it (eg. Btrfs or XFS).
+    Returns False if the clone couldn't be made.
     """
-    Maintain a cache directory at a certain size (MB) by removing the oldest files.
+    if not fcntl or not sys.platform.startswith("linux"):
+        return False
+    with open(source, "rb") as src:
+        fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            fcntl.ioctl(fd, FICLONE, src.fileno())
+            return True
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+    os.remove(dest)
+    return False
+
+
+def link_or_copy(source, dest):
     """
+    Make `dest` a copy of `source`, as cheaply as possible: a copy-on-write clone if the
+    filesystem supports it, otherwise a hard link, otherwise a regular copy.
 
+    A hard link shares the data with the source, this is fine for files in the download cache
+    since they are never modified in place (only created or removed).
+
+    Returns the method used ("reflink", "link" or "copy").
+    """
+    if reflink(source, dest):
+        return "reflink"
     try:
-        # Compile statistics on all files in the output directory and subdirectories
-        stats = []
-        total_size = 0
-        for root, dirs, files in os.walk(download_dir):
-            for file in files:
-                path = os.path.join(root, file)
-                stat_list = os.stat(path)
-                # path, size, atime
-                new_stat_list = [path, stat_list.st_size, stat_list.st_atime]
-                total_size = total_size + stat_list.st_size
-                # don't want hidden files like .htaccess so don't add stuff that starts with .
-                if not file.startswith("."):
-                    stats.append(new_stat_list)
-
-        # Sort file stats by last access time
-        stats = sorted(stats, key=lambda file: file[2])
-
-        # Delete old files until we get under cache_size (configured in megabytes)
-        deletion_count = 0
-        while total_size > cache_size * 1000000:
-            # front of stats list is the file with the smallest (=oldest) access time
-            last_accessed_file = stats[0]
-            # index 1 is where size is
-            total_size = total_size - last_accessed_file[1]
-            # index 0 is where path is
-            os.remove(last_accessed_file[0])
-            # remove the file from the stats list
-            stats.pop(0)
-            deletion_count = deletion_count + 1
-
-        LOGGER.debug(
-            "Removed %d files to keep %s below %.0f megabytes"
-            % (deletion_count, download_dir, cache_size)
-        )
+        os.link(source, dest)
+        return "link"
+    except FileExistsError:
+        raise
+    except OSError:
+        # Eg. different filesystems, or hard links not supported
+        pass
+    shutil.copyfile(source, dest)
+    return "copy"
+
+
+@contextmanager
+def atomic_file(path, cache=None):
+    """
+    Context for writing a file atomically. This yields a temporary path to write to, which is
+    renamed to the given path if the block succeeds, or removed if it fails (including by
+    cancellation). So a partially written file is never left in the cache, and an existing file is
+    replaced rather than modified in place.
 
-    except Exception as e:
-        LOGGER.error(str(e))
+    :param cache: `CacheIndex` to record the finished file in
+    """
+    (directory, filename) = os.path.split(path)
+    # A leading "." keeps this out of the cache index while it is being written
+    temp_path = os.path.join(
+        directory, ".%s.%s.part" % (filename, uuid.uuid4().hex[:12])
+    )
+    try:
+        yield temp_path
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            LOGGER.debug("Removing partial file %s", temp_path)
+            try:
+                os.remove(temp_path)
+            except OSError as e:
+                LOGGER.warning("Failed to remove partial file %s: %s", temp_path, e)
+        raise
+    if cache:
+        cache.add(path)
 
 
 def iter_channels(inventory: Inventory, dedupe=True):
@@ -318,14 +368,93 @@ def get_distance(lat1, lon1, lat2, lon2):
     return meters / M_PER_DEG
 
 
-def get_arrivals(distance, event_depth):
+def get_distances(lat1, lon1, lat2, lon2):
+    """
+    Get the distances (in degrees) between two sets of points at once, like `get_distance`. The
+    arguments can be arrays, which are broadcast together.
+    """
+    (lat1, lon1, lat2, lon2) = np.broadcast_arrays(
+        *(np.asarray(a, dtype=float) for a in (lat1, lon1, lat2, lon2))
+    )
+    if lat1.size == 1:
+        # pyproj treats size 1 arrays as scalars, which NumPy is deprecating
+        return np.full(
+            lat1.shape, get_distance(lat1.item(), lon1.item(), lat2.item(), lon2.item())
+        )
+    # NOTE that GEOD takes longitude first!
+    _az, _baz, meters = GEOD.inv(lon1.ravel(), lat1.ravel(), lon2.ravel(), lat2.ravel())
+    return np.reshape(meters, lat1.shape) / M_PER_DEG
+
+
+def get_spherical_distances(lat1, lon1, lat2, lon2):
+    """
+    Get the great circle distances (in degrees) between two sets of points on a sphere. This is
+    much faster than `get_distances`, but only approximately the same (see
+    `SPHERICAL_DISTANCE_ERROR`).
+    """
+    (lat1, lon1, lat2, lon2) = (
+        np.radians(np.asarray(a, dtype=float)) for a in (lat1, lon1, lat2, lon2)
+    )
+    h = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return np.degrees(2 * np.arcsin(np.sqrt(np.clip(h, 0, 1))))
+
+
+def get_distance_matrix(
+    lats1, lons1, lats2, lons2, min_distance=None, max_distance=None
+):
+    """
+    Get the distance (in degrees) from each of one list of points to each of another.
+
+    If a distance range is given, pairs outside of it are left out (as NaN). Pairs that are
+    clearly out of range by their spherical distance are never calculated exactly, so this is
+    much faster when the range is small.
+
+    :return: a len(lats1) x len(lats2) array, with NaN for any pair left out or without a location
+    """
+    lat1 = np.asarray(lats1, dtype=float)[:, np.newaxis]
+    lon1 = np.asarray(lons1, dtype=float)[:, np.newaxis]
+    lat2 = np.asarray(lats2, dtype=float)[np.newaxis, :]
+    lon2 = np.asarray(lons2, dtype=float)[np.newaxis, :]
+    if min_distance is None and max_distance is None:
+        distances = np.full((lat1.shape[0], lat2.shape[1]), np.nan)
+        located = ~np.isnan(lat1 + lon1 + lat2 + lon2)
+    else:
+        approx = get_spherical_distances(lat1, lon1, lat2, lon2)
+        margin = approx * SPHERICAL_DISTANCE_ERROR + 0.01
+        distances = np.full(approx.shape, np.nan)
+        # Comparisons with NaN are False, so this also leaves out pairs without a location
+        located = np.ones(approx.shape, dtype=bool)
+        if min_distance is not None:
+            located &= approx + margin >= min_distance
+        if max_distance is not None:
+            located &= approx - margin <= max_distance
+    (i, j) = np.nonzero(located)
+    exact = get_distances(lat1[i, 0], lon1[i, 0], lat2[0, j], lon2[0, j])
+    in_range = np.ones(exact.shape, dtype=bool)
+    if min_distance is not None:
+        in_range &= exact >= min_distance
+    if max_distance is not None:
+        in_range &= exact <= max_distance
+    distances[i[in_range], j[in_range]] = exact[in_range]
+    return distances
+
+
+def get_arrivals(distance, event_depth, taup=None):
     """
     Calculate phase arrival times
 
     :param distance: distance in degrees
     :param event_depth: event depth in km
+    :param taup: `TauPyModel` to use, by default this uses the shared model
     """
-    arrivals = TAUP.get_travel_times(event_depth, distance, TAUP_PHASES)
+    if taup:
+        arrivals = taup.get_travel_times(event_depth, distance, TAUP_PHASES)
+    else:
+        with TAUP_LOCK:
+            arrivals = TAUP.get_travel_times(event_depth, distance, TAUP_PHASES)
 
     # From the travel time and origin, calculate the actual first arrival time for each basic phase type
     first_arrivals = {}
@@ -382,6 +511,115 @@ class CancelledException(Exception):
             return s
 
 
+class CancelToken(object):
+    """
+    Cooperative cancellation for a unit of work (eg. everything done by one loader).
+
+    Long-running code should call `check` at convenient points, and anything blocking (like an
+    open socket) can register a callback to be interrupted when the token is cancelled.
+
+    Work generally picks up its token from the current thread, see `cancel_scope`.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def cancel(self):
+        """
+        Cancel the work, calling any registered callbacks
+        """
+        with self.lock:
+            if self.event.is_set():
+                return
+            self.event.set()
+            callbacks = self.callbacks
+            self.callbacks = []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                LOGGER.debug("Error in cancel callback: %s", e)
+
+    def check(self):
+        """
+        Raise a `CancelledException` if cancelled
+        """
+        if self.event.is_set():
+            raise CancelledException()
+
+    def wait(self, timeout):
+        """
+        Sleep for the given time, or until cancelled. Raises a `CancelledException` if cancelled.
+        """
+        if self.event.wait(timeout):
+            raise CancelledException()
+
+    def add_callback(self, callback):
+        """
+        Register a function to call on cancellation (it's called right away if already cancelled)
+        """
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        with self.lock:
+            if callback in self.callbacks:
+                self.callbacks.remove(callback)
+
+
+# The cancel token for the work running in each thread
+_cancel_scope = threading.local()
+
+
+def get_cancel_token():
+    """
+    Get the `CancelToken` for the current thread, or None
+    """
+    return getattr(_cancel_scope, "token", None)
+
+
+@contextmanager
+def cancel_scope(token: CancelToken):
+    """
+    Make the token the current thread's `CancelToken` within the block
+    """
+    previous = get_cancel_token()
+    _cancel_scope.token = token
+    try:
+        yield token
+    finally:
+        _cancel_scope.token = previous
+
+
+def check_cancelled():
+    """
+    Raise a `CancelledException` if the current thread's `CancelToken` has been cancelled
+    """
+    token = get_cancel_token()
+    if token:
+        token.check()
+
+
+def call_with_token(token: CancelToken, fn, *args, **kwargs):
+    """
+    Call a function with the token as the thread's `CancelToken`, this is mainly for submitting
+    work to an executor. Raises a `CancelledException` without calling the function if the
+    token is already cancelled.
+    """
+    with cancel_scope(token):
+        token.check()
+        return fn(*args, **kwargs)
+
+
 class DataRequest(object):
     """
     Wrapper object for a data request, which may or may not be more than a single web service query.
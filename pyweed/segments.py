@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Segment store for downloaded waveform data.
+
+Each waveform's data is cached under a name for its exact time window, so any change to the time
+window (a second earlier, or a different phase) misses the cache. The segment store keeps the
+raw MiniSEED records for each channel in fixed-length segments instead, aligned to multiples of
+the segment length. A time window is then made up of whole segments:
+
+- If all of the segments are on disk, the window's data is taken from them with no request.
+- Otherwise, only the missing runs of segments (the gaps) are requested.
+
+A segment with no data is stored as an empty file, so it isn't requested again. Recent data
+may still be arriving at the data center, so windows ending within `RECENT_DATA_AGE` of now
+aren't stored as segments.
+
+If the store is set to compress the segments, each file is compressed as a whole (see
+`pyweed.compression`). The records inside are still exactly as they were received.
+
+:copyright:
+    Mazama Science, IRIS
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+
+import math
+import os
+import time
+from logging import getLogger
+from obspy import UTCDateTime
+from pyweed.compression import get_extension, open_file, write_file
+from pyweed.mseed import index_records, select_records
+
+LOGGER = getLogger(__name__)
+
+# Default length (in seconds) of a segment
+SEGMENT_LENGTH = 600
+# Data newer than this (in seconds) may be incomplete, so isn't stored
+RECENT_DATA_AGE = 86400
+# File extension for segments
+SEGMENT_EXTENSION = "segment"
+
+
+def get_timestamp(t):
+    """
+    Get a POSIX timestamp from a `UTCDateTime` (or a timestamp)
+    """
+    return getattr(t, "timestamp", t)
+
+
+class SegmentStore(object):
+    """
+    Stores waveform data in fixed-length segments for each channel.
+    """
+
+    def __init__(
+        self, directory, cache=None, segment_length=SEGMENT_LENGTH, compress=False
+    ):
+        """
+        :param directory: directory to store the segments in
+        :param cache: `CacheIndex` for the directory
+        :param segment_length: length (in seconds) of each segment
+        :param compress: whether to compress the segment files
+        """
+        self.directory = directory
+        self.cache = cache
+        self.segment_length = int(segment_length)
+        self.extension = SEGMENT_EXTENSION
+        if compress:
+            self.extension = "%s.%s" % (SEGMENT_EXTENSION, get_extension())
+
+    def get_segments(self, start, end):
+        """
+        Get the start times (as POSIX timestamps) of the segments covering a time window
+
+        >>> SegmentStore("/tmp").get_segments(1250, 2400)
+        [1200, 1800]
+        >>> SegmentStore("/tmp").get_segments(1250, 2400.5)
+        [1200, 1800, 2400]
+        """
+        length = self.segment_length
+        first = int(get_timestamp(start) // length) * length
+        return list(range(first, math.ceil(get_timestamp(end)), length))
+
+    def get_path(self, sncl, segment):
+        return os.path.join(
+            self.directory, "%s_%d.%s" % (sncl, segment, self.extension)
+        )
+
+    def has_segment(self, sncl, segment):
+        path = self.get_path(sncl, segment)
+        if self.cache:
+            return self.cache.lookup(path)
+        return os.path.exists(path)
+
+    def is_storable(self, end):
+        """
+        Check whether a time window ending at the given time can be stored as segments
+        """
+        return get_timestamp(end) < time.time() - RECENT_DATA_AGE
+
+    def get_gaps(self, sncl, start, end):
+        """
+        Find the parts of a time window that aren't stored yet.
+
+        :return: a list of (start, end) `UTCDateTime` pairs, each covering a run of missing segments
+        """
+        gaps = []
+        for segment in self.get_segments(start, end):
+            if self.has_segment(sncl, segment):
+                continue
+            if gaps and gaps[-1][1] == segment:
+                gaps[-1][1] = segment + self.segment_length
+            else:
+                gaps.append([segment, segment + self.segment_length])
+        return [(UTCDateTime(a), UTCDateTime(b)) for (a, b) in gaps]
+
+    def store(self, sncl, gaps, data, records):
+        """
+        Store the segments for the given gaps from downloaded data.
+
+        :param gaps: the gaps that were requested (see `get_gaps`)
+        :param data: the raw MiniSEED data
+        :param records: the `Record` entries for this channel in the data
+        """
+        # The data can include the same record twice, if it was requested for two waveforms
+        records = list(
+            dict(((record.start, record.end), record) for record in records).values()
+        )
+        for gap_start, gap_end in gaps:
+            for segment in self.get_segments(gap_start, gap_end):
+                # Records overlapping the boundary go in both segments
+                segment_data = select_records(
+                    data, records, segment, segment + self.segment_length
+                )
+                write_file(self.get_path(sncl, segment), segment_data, self.cache)
+
+    def read(self, sncl, start, end):
+        """
+        Get the data for a time window from the stored segments.
+
+        :return: the records overlapping the window, or None if any of the segments are missing
+        """
+        chunks = []
+        seen = set()
+        for segment in self.get_segments(start, end):
+            if not self.has_segment(sncl, segment):
+                return None
+            path = self.get_path(sncl, segment)
+            try:
+                with open_file(path) as f:
+                    data = f.read()
+                records = index_records(data).get(sncl, [])
+            except (OSError, ValueError) as e:
+                LOGGER.warning("Couldn't read segment %s: %s", path, e)
+                if self.cache:
+                    self.cache.remove(path)
+                return None
+            # Skip the records already taken from the previous segment
+            records = [
+                record for record in records if (record.start, record.end) not in seen
+            ]
+            seen.update((record.start, record.end) for record in records)
+            chunks.append(
+                select_records(data, records, get_timestamp(start), get_timestamp(end))
+            )
+        return b"".join(chunks)
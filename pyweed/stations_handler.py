@@ -12,18 +12,22 @@ Container for stations.
 from __future__ import absolute_import, division, print_function
 
 import logging
+import numpy as np
+from pyweed.clients import get_worker_count
 from pyweed.signals import SignalingThread, SignalingObject
-from obspy.core.inventory import Inventory, Station
+from obspy.core.inventory import Inventory
 from obspy.clients.fdsn import Client
 from pyweed.pyweed_utils import (
     get_service_url,
     CancelledException,
+    CancelToken,
+    call_with_token,
     DataRequest,
-    get_distance,
+    get_distance_matrix,
 )
 from PyQt5 import QtCore
 import concurrent.futures
-from pyweed.dist_from_events import get_combined_locations, CrossBorderException
+from pyweed.dist_from_events import get_combined_locations
 
 LOGGER = logging.getLogger(__name__)
 
@@ -48,6 +52,29 @@ def load_stations(client: Client, parameters):
             raise
 
 
+def merge_duplicates(inventory: Inventory):
+    """
+    Merge any networks and stations that appear more than once in an inventory, this happens
+    when the results of overlapping sub-requests are combined.
+    """
+    networks = {}
+    seen_stations = {}
+    for network in inventory:
+        key = (network.code, network.start_date)
+        if key not in networks:
+            networks[key] = network
+            seen_stations[key] = set(
+                (station.code, station.start_date) for station in network
+            )
+            continue
+        for station in network:
+            station_key = (station.code, station.start_date)
+            if station_key not in seen_stations[key]:
+                seen_stations[key].add(station_key)
+                networks[key].stations.append(station)
+    inventory.networks = list(networks.values())
+
+
 class StationsLoader(SignalingThread):
     """
     Thread to handle station requests
@@ -62,6 +89,7 @@ class StationsLoader(SignalingThread):
         # Keep a reference to globally shared components
         self.request = request
         self.futures = {}
+        self.token = CancelToken()
         super(StationsLoader, self).__init__()
 
     def run(self):
@@ -74,14 +102,24 @@ class StationsLoader(SignalingThread):
 
         inventory = None
         LOGGER.info("Making %d station requests" % len(self.request.sub_requests))
-        with concurrent.futures.ThreadPoolExecutor(5) as executor:
+        with concurrent.futures.ThreadPoolExecutor(
+            get_worker_count(self.request.client)
+        ) as executor:
             for sub_request in self.request.sub_requests:
                 # Dictionary lets us look up argument by result later
                 self.futures[
-                    executor.submit(load_stations, self.request.client, sub_request)
+                    executor.submit(
+                        call_with_token,
+                        self.token,
+                        load_stations,
+                        self.request.client,
+                        sub_request,
+                    )
                 ] = sub_request
             # Iterate through Futures as they complete
             for result in concurrent.futures.as_completed(self.futures):
+                if self.token.cancelled:
+                    break
                 LOGGER.debug("Stations loaded")
                 try:
                     if not inventory:
@@ -92,6 +130,9 @@ class StationsLoader(SignalingThread):
                 except Exception:
                     self.progress.emit()
         self.futures = {}
+        if self.token.cancelled:
+            LOGGER.info("Stations request cancelled")
+            return
         # If no inventory object (ie. no sub-requests were run) create a dummy one
         if not inventory:
             inventory = Inventory([], "INTERNAL")
@@ -114,6 +155,8 @@ class StationsLoader(SignalingThread):
         """
         self.done.disconnect()
         self.progress.disconnect()
+        # Stop any requests in progress, and anything not started yet
+        self.token.cancel()
         self.clearFutures()
 
 
@@ -121,6 +164,11 @@ class StationsDataRequest(DataRequest):
     event_locations = None
     distance_range = None
 
+    # Number of events to check the stations against at a time, this starts small and doubles
+    # with each chunk (up to the maximum), see `filter_stations`
+    min_events_chunk = 1
+    max_events_chunk = 64
+
     def __init__(self, client: Client, base_options, distance_range, event_locations):
         """
         :param client: an ObsPy FDSN client
@@ -133,42 +181,51 @@ class StationsDataRequest(DataRequest):
             # Get a list of just the (lat, lon) for each event
             self.event_locations = list((loc[1] for loc in event_locations))
             self.distance_range = distance_range
-            try:
-                combined_locations = get_combined_locations(
+            # These run in parallel, see `StationsLoader`
+            self.sub_requests = [
+                dict(base_options, **area.get_options())
+                for area in get_combined_locations(
                     self.event_locations, self.distance_range["maxdistance"]
                 )
-                self.sub_requests = [
-                    dict(
-                        base_options,
-                        minlatitude=box.lat1,
-                        maxlatitude=box.lat2,
-                        minlongitude=box.lon1,
-                        maxlongitude=box.lon2,
-                    )
-                    for box in combined_locations
-                ]
-            except CrossBorderException:
-                # Can't break into subqueries, return the base (global, we assume) query
-                LOGGER.warning(
-                    "Couldn't calculate a bounding box for events, using global"
-                )
-                self.sub_requests = [base_options]
+            ]
         else:
             self.sub_requests = [base_options]
 
-    def filter_one_station(self, station: Station):
+    def filter_stations(self, stations):
         """
-        Filter one station from the results
+        Find the stations within the distance range of any of the events.
+
+        The distances are calculated for many stations and events at a time (see
+        `get_distance_matrix`), and a station that's within range of one event isn't checked
+        against the rest. The first chunks of events are small, since when the range is wide most
+        stations will match one of the first few events.
+
+        :return: a boolean array, True for each station to keep
         """
-        for lat, lon in self.event_locations:
-            dist = get_distance(lat, lon, station.latitude, station.longitude)
-            if (
-                self.distance_range["mindistance"]
-                <= dist
-                <= self.distance_range["maxdistance"]
-            ):
-                return True
-        return False
+        lats = np.array([station.latitude for station in stations], dtype=float)
+        lons = np.array([station.longitude for station in stations], dtype=float)
+        events = np.array(self.event_locations, dtype=float).reshape(-1, 2)
+        keep = np.zeros(len(stations), dtype=bool)
+        start = 0
+        size = self.min_events_chunk
+        while start < len(events):
+            # Only the stations that haven't matched an event yet
+            pending = np.flatnonzero(~keep)
+            if not len(pending):
+                break
+            chunk = events[start : start + size]
+            start += size
+            size = min(size * 2, self.max_events_chunk)
+            distances = get_distance_matrix(
+                lats[pending],
+                lons[pending],
+                chunk[:, 0],
+                chunk[:, 1],
+                self.distance_range["mindistance"],
+                self.distance_range["maxdistance"],
+            )
+            keep[pending[~np.isnan(distances).all(axis=1)]] = True
+        return keep
 
     def process_result(self, result):
         """
@@ -176,16 +233,21 @@ class StationsDataRequest(DataRequest):
         a filter after the request, since the low-level request probably overselected.
         """
         result = super(StationsDataRequest, self).process_result(result)
+        if isinstance(result, Inventory) and len(self.sub_requests) > 1:
+            merge_duplicates(result)
         if (
             isinstance(result, Inventory)
             and self.event_locations
             and self.distance_range
         ):
+            keep = iter(
+                self.filter_stations(
+                    [station for network in result for station in network]
+                ).tolist()
+            )
             filtered_networks = []
             for network in result:
-                filtered_stations = [
-                    station for station in network if self.filter_one_station(station)
-                ]
+                filtered_stations = [station for station in network if next(keep)]
                 if filtered_stations:
                     network.stations = filtered_stations
                     filtered_networks.append(network)
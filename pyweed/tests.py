@@ -1,7 +1,39 @@
+import io
+import os
+import tempfile
+import threading
+import time
+import warnings
 from time import sleep
-from pyweed.pyweed_utils import get_distance, get_arrivals, TimeWindow
+from pyweed.pyweed_utils import (
+    get_distance, get_arrivals, TimeWindow, CancelToken, CancelledException, call_with_token,
+    check_cancelled, link_or_copy, get_distance_matrix, get_event_name)
 import unittest
+from unittest import mock
+import numpy as np
+import obspy
 from obspy.core.utcdatetime import UTCDateTime
+from obspy.core.stream import Stream
+from obspy.core.trace import Trace
+from pyweed.thumbnails import get_envelope, render_thumbnail
+from pyweed.cache import CacheIndex, CacheEvictor
+from pyweed.compression import open_file, recompress_mseed, write_file
+from pyweed.concurrency import ConcurrencyLimiter, ConcurrencyManager
+from pyweed.pipeline import Pipeline, PriorityQueue, Stage
+from pyweed.mseed import index_records, select_records
+from pyweed.segments import SegmentStore
+from pyweed.traveltimes import ArrivalsMemo, TravelTimeTable, calculate_arrivals, get_table
+from pyweed.clients import PooledClient
+from pyweed.governor import CircuitBreaker, CircuitOpenError, TokenBucket, parse_retry_after
+from pyweed.batch import check_job, JobError
+from pyweed.preferences import Preferences
+from pyweed.pyweed_core import load_concurrency_limits, save_concurrency_limits
+from pyweed.stations_handler import StationsDataRequest
+from pyweed.event_table import EventTable
+from pyweed.dist_from_events import LatLonBox, LatLonCircle, get_boxes, get_combined_locations
+from pyweed.waveforms_handler import (
+    ExactArrivals, RequestPlanner, SaveJob, WaveformEntry, WaveformJob, WaveformsSaver,
+    WaveformResult, fetch_waveforms)
 
 
 def gui_test(pyweed):
@@ -31,6 +63,123 @@ class DistanceTest(unittest.TestCase):
         dist = get_distance(0, 170, 0, -170)
         self.assertAlmostEqual(dist, 20, delta=1)
 
+    def test_distance_matrix_1(self):
+        distances = get_distance_matrix([0, 0], [0, 170], [10, 0, np.nan], [0, -170, 0])
+        self.assertAlmostEqual(distances[0, 0], get_distance(0, 0, 10, 0))
+        self.assertAlmostEqual(distances[1, 1], get_distance(0, 170, 0, -170))
+        self.assertTrue(np.isnan(distances[0, 2]))
+        # Out of range pairs are left out
+        distances = get_distance_matrix([0, 0], [0, 170], [10, 0], [0, -170], 5, 30)
+        self.assertAlmostEqual(distances[0, 0], get_distance(0, 0, 10, 0))
+        self.assertAlmostEqual(distances[1, 1], get_distance(0, 170, 0, -170))
+        self.assertTrue(np.isnan(distances[0, 1]))
+        self.assertTrue(np.isnan(distances[1, 0]))
+
+    def test_distance_matrix_2(self):
+        # A single pair shouldn't go through any deprecated NumPy conversions
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', DeprecationWarning)
+            distances = get_distance_matrix([0], [0], [10], [0])
+            self.assertEqual(distances.shape, (1, 1))
+            self.assertAlmostEqual(distances[0, 0], get_distance(0, 0, 10, 0))
+            distances = get_distance_matrix([0, 0], [0, 170], [10], [0], 5, 30)
+            self.assertAlmostEqual(distances[0, 0], get_distance(0, 0, 10, 0))
+            self.assertTrue(np.isnan(distances[1, 0]))
+
+
+class StationsFilterTest(unittest.TestCase):
+    def filter_one_station(self, request, station):
+        """
+        The original filter, checking one station against each event in turn
+        """
+        for lat, lon in request.event_locations:
+            dist = get_distance(lat, lon, station.latitude, station.longitude)
+            if (request.distance_range['mindistance'] <= dist
+                    <= request.distance_range['maxdistance']):
+                return True
+        return False
+
+    def test_filter_stations_1(self):
+        request = StationsDataRequest(
+            None, {}, {'mindistance': 5, 'maxdistance': 30},
+            [('1', (0, 0)), ('2', (45, 120)), ('3', (-30, -170))])
+        stations = [
+            obspy.core.inventory.Station('S%d' % i, lat, lon, 0)
+            for i, (lat, lon) in enumerate([
+                (0, 1), (0, 20), (50, 130), (-30, 175), (80, -60), (-60, 60), (45, 121)])
+        ]
+        keep = request.filter_stations(stations)
+        self.assertEqual(
+            keep.tolist(), [self.filter_one_station(request, station) for station in stations])
+        self.assertEqual(keep.tolist(), [False, True, True, True, False, False, False])
+
+    def test_filter_stations_2(self):
+        # Randomly placed stations and events give the same result as the original filter
+        rng = np.random.default_rng(0)
+        request = StationsDataRequest(
+            None, {}, {'mindistance': 10, 'maxdistance': 40},
+            [(str(i), location) for i, location in enumerate(
+                rng.uniform((-90, -180), (90, 180), (5, 2)).tolist())])
+        stations = [
+            obspy.core.inventory.Station('S%d' % i, lat, lon, 0)
+            for i, (lat, lon) in enumerate(
+                rng.uniform((-90, -180), (90, 180), (300, 2)).tolist())
+        ]
+        keep = request.filter_stations(stations)
+        self.assertEqual(
+            keep.tolist(), [self.filter_one_station(request, station) for station in stations])
+
+
+class DistFromEventsTest(unittest.TestCase):
+    def test_combined_locations_1(self):
+        # Japan and Chile are queried separately
+        areas = get_combined_locations([(35, 140), (38, 142), (-33, -72)], 10)
+        self.assertEqual(len(areas), 2)
+        for area in areas:
+            if isinstance(area, LatLonBox):
+                self.assertLess(area.lon2 - area.lon1, 40)
+            else:
+                self.assertLess(area.radius, 20)
+
+    def test_boxes_1(self):
+        # Split at the dateline
+        boxes = get_boxes(np.array([[-18.0, 178.0], [-20.0, -178.0]]), 5)
+        self.assertEqual(len(boxes), 2)
+        self.assertEqual((boxes[0].lon2, boxes[1].lon1), (180, -180))
+        self.assertLess(boxes[0].lon1, 173)
+        self.assertGreater(boxes[1].lon2, -173)
+        # Reaching a pole takes in all longitudes
+        boxes = get_boxes(np.array([[85.0, 30.0]]), 10)
+        self.assertEqual(
+            [(box.lat1, box.lat2, box.lon1, box.lon2) for box in boxes], [(75, 90, -180, 180)])
+
+
+class EventTableTest(unittest.TestCase):
+    def test_event_table_1(self):
+        from obspy.core.event import Catalog, Event, EventDescription, Magnitude, Origin
+        events = []
+        for i in range(3):
+            origin = Origin(
+                time=UTCDateTime(2020, 1, 1, 0, 0, i + 0.5), latitude=i, longitude=-i,
+                depth=10000 * i)
+            magnitude = Magnitude(mag=5 + i / 10, magnitude_type='Mw')
+            events.append(Event(
+                resource_id='smi:service.iris.edu/fdsnws/event/1/query?eventid=%d' % i,
+                origins=[origin], magnitudes=[magnitude],
+                preferred_origin_id=origin.resource_id,
+                preferred_magnitude_id=magnitude.resource_id,
+                event_descriptions=[EventDescription('NEAR COAST OF PERU')]))
+        events[1].origins = []
+        events[1].preferred_origin_id = None
+        table = EventTable(Catalog(events))
+        self.assertEqual(table.has_origin.tolist(), [True, False, True])
+        self.assertEqual(table.event_ids, ['0', '1', '2'])
+        self.assertEqual(table.depths[2], 20)
+        self.assertEqual(table.get_time(2), UTCDateTime(2020, 1, 1, 0, 0, 2.5))
+        self.assertEqual(table.get_name(2), get_event_name(events[2]))
+        self.assertIs(table.get_event(1), events[1])
+        self.assertEqual(table.get_rows([events[2].resource_id.id, events[0].resource_id.id]), [0, 2])
+
 
 class ArrivalsTest(unittest.TestCase):
     def test_arrivals_1(self):
@@ -39,6 +188,62 @@ class ArrivalsTest(unittest.TestCase):
         self.assertAlmostEqual(arrivals['S'], 484, delta=1)
 
 
+class TravelTimeTableTest(unittest.TestCase):
+    def test_lookup_1(self):
+        distances = np.arange(0, 181, 1.0)
+        depths = np.arange(0, 710, 10.0)
+        (d, z) = np.meshgrid(distances, depths, indexing='ij')
+        times = {'P': 10 * d + z / 10, 'S': 18 * d + z / 5}
+        times['S'][100:, :] = np.nan
+        table = TravelTimeTable('test', distances, depths, times)
+        results = table.lookup([20.5, 150.5, 45], [105, 33, 800])
+        np.testing.assert_allclose(results['P'], [215.5, 1508.3, 520])
+        self.assertAlmostEqual(results['S'][0], 390)
+        self.assertTrue(np.isnan(results['S'][1]))
+
+    def test_excluded_1(self):
+        distances = np.arange(0, 181, 1.0)
+        depths = np.arange(0, 710, 10.0)
+        (d, z) = np.meshgrid(distances, depths, indexing='ij')
+        excluded = np.zeros((len(distances) - 1, len(depths) - 1), dtype=bool)
+        excluded[150, 3] = True
+        table = TravelTimeTable(
+            'test', distances, depths, {'P': 10 * d, 'S': 18 * d}, {'P': 0.5, 'S': 0.25},
+            excluded)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'table.npz')
+            table.save(path)
+            table = TravelTimeTable.load(path)
+        self.assertEqual(table.max_error, {'P': 0.5, 'S': 0.25})
+        results = table.lookup([150.5, 151.5], [33, 33])
+        self.assertTrue(np.isnan(results['P'][0]))
+        self.assertAlmostEqual(results['P'][1], 1515)
+
+    def test_table_1(self):
+        table = get_table()
+        if not table:
+            self.skipTest('No travel time table')
+        pairs = [(3.3, 12), (47.25, 33), (101.7, 5), (143.1, 575), (171.9, 250)]
+        results = table.lookup([pair[0] for pair in pairs], [pair[1] for pair in pairs])
+        for i, (distance, depth) in enumerate(pairs):
+            exact = get_arrivals(distance, depth)
+            for phase in ('P', 'S'):
+                if not np.isnan(results[phase][i]):
+                    self.assertAlmostEqual(
+                        results[phase][i], exact[phase], delta=table.max_error[phase] + 0.01)
+
+    def test_memo_1(self):
+        with tempfile.TemporaryDirectory() as directory:
+            memo = ArrivalsMemo(os.path.join(directory, 'arrivals.sqlite'))
+            arrivals = calculate_arrivals([(20, 100), (20.001, 100.01)], memo=memo)
+            self.assertEqual(arrivals[0], arrivals[1])
+            self.assertAlmostEqual(arrivals[0]['P'], get_arrivals(20, 100)['P'], delta=0.1)
+            # Now it comes from the memo
+            memo.put_many('iasp91', [((2000, 1000), {'P': 1})])
+            self.assertEqual(calculate_arrivals([(20, 100)], memo=memo), [{'P': 1}])
+            memo.close()
+
+
 class TimeWindowTest(unittest.TestCase):
     def test_timewindow_1(self):
         time_window = TimeWindow(60, 600, 'P', 'P')
@@ -58,5 +263,770 @@ class TimeWindowTest(unittest.TestCase):
             end, expected_end, delta=1)
 
 
+class FakeClient(object):
+    """
+    Stands in for an FDSN `Client`, returning canned MiniSEED data
+    """
+    base_url = 'http://service.example.com'
+
+    def __init__(self, data):
+        self.data = data
+        self.requests = []
+
+    def select(self, network, station, location, channel, starttime, endtime):
+        sncl = '.'.join((network, station, '' if location == '--' else location, channel))
+        records = index_records(self.data).get(sncl, [])
+        return select_records(self.data, records, starttime.timestamp, endtime.timestamp)
+
+    def get_waveforms(self, network, station, location, channel, starttime, endtime,
+                      filename=None):
+        self.requests.append([(network, station, location, channel, starttime, endtime)])
+        filename.write(self.select(network, station, location, channel, starttime, endtime))
+
+    def get_waveforms_bulk(self, bulk, filename=None):
+        self.requests.append(bulk)
+        for line in bulk:
+            filename.write(self.select(*line))
+
+
+class WaveformsTestCase(unittest.TestCase):
+    """
+    Sets up waveforms for one channel and three events. The test case stands in for the
+    `WaveformsHandler` (see `WaveformEntry.update_handler_values`).
+    """
+    def setUp(self):
+        from obspy.core.event import Catalog, Event, Origin
+        from obspy.core.inventory import Channel, Network, Station
+        self.start = UTCDateTime(2020, 1, 1)
+        # Events 0 and 1 are 20 minutes apart, event 2 is 5 hours later
+        events = [
+            Event(resource_id='smi:test/event?eventid=%d' % i, origins=[
+                Origin(time=self.start + offset, latitude=0, longitude=0, depth=10000)])
+            for i, offset in enumerate([0, 1200, 5 * 3600])
+        ]
+        self.event_table = EventTable(Catalog(events))
+        self.channel = Channel('BHZ', '00', 20, 0, 0, 0)
+        self.station = Station('TEST', 20, 0, 0, channels=[self.channel])
+        self.network = Network('XX', stations=[self.station])
+        self.tmp = tempfile.TemporaryDirectory()
+        self.downloadDir = self.tmp.name
+        self.cache_index = None
+        self.compress_cache = False
+        self.download_metadata = False
+        self.waveforms = []
+        for row in range(3):
+            waveform = WaveformEntry(
+                self.event_table, row, self.network, self.station, self.channel, 20)
+            waveform.arrivals = {'P': 300}
+            self.waveforms.append(waveform)
+        self.set_time_window(TimeWindow(60, 600, 'P', 'P'))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def set_time_window(self, time_window):
+        self.time_window = time_window
+        for waveform in self.waveforms:
+            waveform.update_handler_values(self)
+
+    def get_data(self, sncl='XX.TEST.00.BHZ'):
+        """
+        Get six hours of MiniSEED data for a channel, starting with the first event
+        """
+        (network, station, location, channel) = sncl.split('.')
+        tr = Trace(np.arange(21600, dtype=np.int32), header={
+            'network': network, 'station': station, 'location': location, 'channel': channel,
+            'sampling_rate': 1.0, 'starttime': self.start,
+        })
+        buf = io.BytesIO()
+        Stream([tr]).write(buf, format='MSEED', reclen=512, encoding='INT32')
+        return buf.getvalue()
+
+
+class RequestPlannerTest(WaveformsTestCase):
+    def plan(self, planner, index):
+        waveform = self.waveforms[index]
+        if not waveform.start_time:
+            waveform.prepare()
+        (group, claimed) = planner.plan(waveform)
+        return (group, claimed, [w.waveform_id for w in group.waveforms])
+
+    def test_plan_1(self):
+        planner = RequestPlanner(self.waveforms)
+        # Windows 9 minutes apart aren't merged
+        (group, claimed, ids) = self.plan(planner, 0)
+        self.assertTrue(claimed)
+        self.assertEqual(ids, [self.waveforms[0].waveform_id])
+        self.assertEqual((group.start_time, group.end_time), (self.start + 240, self.start + 900))
+        # Overlapping windows are merged
+        self.set_time_window(TimeWindow(60, 1800, 'P', 'P'))
+        planner = RequestPlanner(self.waveforms)
+        (group, claimed, ids) = self.plan(planner, 0)
+        self.assertTrue(claimed)
+        self.assertEqual(ids, [w.waveform_id for w in self.waveforms[:2]])
+        self.assertEqual(group.end_time, self.start + 3300)
+        # The other waveform waits for the same group
+        (other_group, claimed, ids) = self.plan(planner, 1)
+        self.assertIs(other_group, group)
+        self.assertFalse(claimed)
+        # Too far away to be merged
+        (group, claimed, ids) = self.plan(planner, 2)
+        self.assertTrue(claimed)
+        self.assertEqual(ids, [self.waveforms[2].waveform_id])
+
+    def test_plan_2(self):
+        # Merging would make too long a window
+        planner = RequestPlanner(self.waveforms)
+        planner.max_window = 1800
+        self.set_time_window(TimeWindow(60, 1800, 'P', 'P'))
+        (group, claimed, ids) = self.plan(planner, 0)
+        self.assertEqual(ids, [self.waveforms[0].waveform_id])
+        # Not merged if the gap is too large
+        planner = RequestPlanner(self.waveforms)
+        planner.merge_gap = 0
+        self.set_time_window(TimeWindow(0, 1190, 'P', 'P'))
+        (group, claimed, ids) = self.plan(planner, 0)
+        self.assertEqual(ids, [self.waveforms[0].waveform_id])
+        planner = RequestPlanner(self.waveforms)
+        (group, claimed, ids) = self.plan(planner, 0)
+        self.assertEqual(len(ids), 2)
+
+    def test_plan_3(self):
+        self.set_time_window(TimeWindow(60, 1800, 'P', 'P'))
+        planner = RequestPlanner(self.waveforms)
+        (group, claimed, ids) = self.plan(planner, 0)
+        self.assertFalse(group.done.is_set())
+        # A failed request releases the other waveforms, so they can be tried on their own
+        planner.finish(group, Exception('failed'))
+        self.assertTrue(group.done.is_set())
+        (other_group, claimed, ids) = self.plan(planner, 1)
+        self.assertIsNot(other_group, group)
+        self.assertTrue(claimed)
+
+    def test_changed_window_1(self):
+        # Everything was prepared with the old time window
+        for waveform in self.waveforms:
+            waveform.prepare()
+        # With the new window, the first two overlap
+        self.set_time_window(TimeWindow(60, 1800, 'P', 'P'))
+        planner = RequestPlanner(self.waveforms)
+        (group, claimed, ids) = self.plan(planner, 0)
+        self.assertEqual(ids, [w.waveform_id for w in self.waveforms[:2]])
+        self.assertEqual(group.end_time, self.start + 3300)
+        self.assertEqual(self.waveforms[1].end_time, self.start + 3300)
+
+
+    def test_exact_arrivals_1(self):
+        for waveform in self.waveforms[1:]:
+            waveform.arrivals = None
+        memo = ArrivalsMemo(os.path.join(self.tmp.name, 'arrivals.sqlite'))
+        memo.put_many('iasp91', [((2000, 100), {'P': 1})])
+        arrivals = ExactArrivals(self.waveforms, memo)
+        thread = threading.Thread(target=arrivals.run)
+        thread.start()
+        arrivals.wait(self.waveforms[2])
+        thread.join()
+        self.assertTrue(arrivals.finished)
+        self.assertEqual(
+            [w.arrivals for w in self.waveforms], [{'P': 300}, {'P': 1}, {'P': 1}])
+        memo.close()
+
+
+class FetchWaveformsTest(WaveformsTestCase):
+    def setUp(self):
+        super(FetchWaveformsTest, self).setUp()
+        self.cache_index = CacheIndex(self.tmp.name)
+        self.set_time_window(self.time_window)
+
+    def tearDown(self):
+        self.cache_index.close()
+        super(FetchWaveformsTest, self).tearDown()
+
+    def test_deleted_file_1(self):
+        client = FakeClient(self.get_data())
+        waveform = self.waveforms[0]
+        waveform.prepare()
+        fetch_waveforms(client, RequestPlanner(self.waveforms), [WaveformJob(waveform)])
+        self.assertEqual(len(client.requests), 1)
+        with open(waveform.mseed_path, 'rb') as f:
+            data = f.read()
+        # Deleted behind the cache index's back
+        os.remove(waveform.mseed_path)
+        waveform.prepare()
+        self.assertTrue(waveform.mseed_exists)
+        # It's fetched again
+        job = WaveformJob(waveform)
+        results = fetch_waveforms(client, RequestPlanner(self.waveforms), [job])
+        self.assertEqual(results, [(job, Pipeline.CONTINUE)])
+        self.assertEqual(len(client.requests), 2)
+        self.assertEqual(job.data, data)
+        self.assertTrue(os.path.exists(waveform.mseed_path))
+        self.assertTrue(self.cache_index.lookup(waveform.mseed_path))
+
+
+    def test_bulk_1(self):
+        from obspy.core.inventory import Channel
+        # Add another channel, the data for both comes back in one response
+        channel = Channel('BHN', '00', 20, 0, 0, 0)
+        self.station.channels.append(channel)
+        waveforms = self.waveforms + [
+            WaveformEntry(self.event_table, row, self.network, self.station, channel, 20)
+            for row in range(3)
+        ]
+        for waveform in waveforms[3:]:
+            waveform.arrivals = {'P': 300}
+            waveform.update_handler_values(self)
+        data = dict(
+            (sncl, self.get_data(sncl)) for sncl in ('XX.TEST.00.BHZ', 'XX.TEST.00.BHN'))
+        client = FakeClient(b''.join(data.values()))
+        jobs = [WaveformJob(waveforms[i]) for i in (0, 2, 3)]
+        for job in jobs:
+            job.waveform.prepare()
+        results = fetch_waveforms(client, RequestPlanner(waveforms), jobs)
+        self.assertEqual(results, [(job, Pipeline.CONTINUE) for job in jobs])
+        self.assertEqual(len(client.requests), 1)
+        self.assertEqual(
+            [line[:4] for line in client.requests[0]],
+            [('XX', 'TEST', '00', 'BHZ')] * 2 + [('XX', 'TEST', '00', 'BHN')])
+        # Each waveform gets exactly the records for its own channel and time window
+        for job in jobs:
+            waveform = job.waveform
+            with open(waveform.mseed_path, 'rb') as f:
+                self.assertEqual(f.read(), job.data)
+            channel_data = data[waveform.sncl]
+            self.assertEqual(job.data, select_records(
+                channel_data, index_records(channel_data)[waveform.sncl],
+                waveform.start_time.timestamp, waveform.end_time.timestamp))
+            records = index_records(job.data)
+            self.assertEqual(list(records), [waveform.sncl])
+            self.assertLessEqual(records[waveform.sncl][0].start, waveform.start_time.timestamp)
+            self.assertGreaterEqual(records[waveform.sncl][-1].end, waveform.end_time.timestamp)
+
+    def test_pinned_segments_1(self):
+        data = self.get_data()
+        records = index_records(data)['XX.TEST.00.BHZ']
+        store = SegmentStore(self.tmp.name, self.cache_index, 600)
+        waveform = self.waveforms[0]
+        waveform.prepare()
+        gaps = store.get_gaps(waveform.sncl, waveform.start_time, waveform.end_time)
+        store.store(waveform.sncl, gaps, data, records)
+        planner = RequestPlanner(self.waveforms, store)
+        (group, claimed) = planner.plan(waveform)
+        paths = planner.get_pinned_paths()
+        self.assertEqual(len(paths), 2)
+        # The group's segments can't be evicted until it's finished
+        self.cache_index.evict(0)
+        self.assertTrue(all(os.path.exists(path) for path in paths))
+        planner.finish(group)
+        self.assertEqual(planner.get_pinned_paths(), [])
+        self.cache_index.evict(0)
+        self.assertFalse(any(os.path.exists(path) for path in paths))
+
+
+class ThumbnailTest(unittest.TestCase):
+    def test_envelope_1(self):
+        # 100 samples into 10 columns
+        tr = Trace(np.arange(100), header={'sampling_rate': 1.0})
+        columns, mins, maxs, lasts = get_envelope(
+            tr, tr.stats.starttime, tr.stats.starttime + 100, 10)
+        self.assertEqual(list(columns), list(range(10)))
+        self.assertEqual(list(mins), list(range(0, 100, 10)))
+        self.assertEqual(list(maxs), list(range(9, 100, 10)))
+
+    def test_thumbnail_1(self):
+        tr = Trace(np.sin(np.arange(10000) / 100.0), header={'sampling_rate': 40.0})
+        image = render_thumbnail(Stream([tr]), 600, 120)
+        self.assertEqual(image.shape, (120, 600, 4))
+        # Some pixels should be drawn, but not too many
+        drawn = np.count_nonzero(image[:, :, 0] == 0)
+        self.assertTrue(0 < drawn < 600 * 120 / 2)
+
+
+class ConcurrencyTest(unittest.TestCase):
+    def test_overload_1(self):
+        limiter = ConcurrencyLimiter('test', 8)
+        limiter.record(0.1, 503)
+        self.assertEqual(limiter.current_limit(), 4)
+
+    def test_increase_1(self):
+        limiter = ConcurrencyLimiter('test', 2)
+        # Only grows while all the slots are in use
+        limiter.acquire()
+        for i in range(10):
+            limiter.record(0.1, 200)
+        self.assertEqual(limiter.current_limit(), 2)
+        limiter.in_flight = 2
+        for i in range(10):
+            limiter.record(0.1, 200)
+        self.assertGreater(limiter.current_limit(), 2)
+
+    def test_mixed_latency_1(self):
+        limiter = ConcurrencyLimiter('test', 4)
+        limiter.in_flight = 4
+        clock = [0]
+
+        def monotonic():
+            clock[0] += 0.5
+            return clock[0]
+
+        # Small station queries and large dataselect requests, each kind at its usual latency
+        with mock.patch('pyweed.concurrency.time.monotonic', monotonic):
+            for i in range(50):
+                limiter.record(0.05, 200, 1000, kind=('GET', '/fdsnws/station/1/query'))
+                limiter.record(2.0, 200, 10000000, kind=('POST', '/fdsnws/dataselect/1/query'))
+        self.assertGreaterEqual(limiter.current_limit(), 4)
+
+    def test_limits_1(self):
+        manager = ConcurrencyManager()
+        manager.load_limits({'a.example.com': '7'})
+        self.assertEqual(manager.get_limiter('a.example.com').current_limit(), 7)
+        manager.get_limiter('b.example.com').record(0.1, 429)
+        self.assertEqual(
+            manager.get_limits(), {'a.example.com': 7, 'b.example.com': 2})
+
+
+class FakeResponse(object):
+    """
+    Stands in for a streaming `requests.Response`
+    """
+    def __init__(self, status_code, content, headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+class FakeSession(object):
+    """
+    Stands in for a `requests.Session`, giving every request the same response
+    """
+    def __init__(self, response):
+        self.response = response
+        self.requests = []
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url))
+        return self.response
+
+
+class PooledClientTest(unittest.TestCase):
+    base_url = 'http://service.example.com'
+
+    def setUp(self):
+        tr = Trace(np.arange(3600, dtype=np.int32), header={
+            'network': 'XX', 'station': 'TEST', 'location': '00', 'channel': 'BHZ',
+            'sampling_rate': 1.0, 'starttime': UTCDateTime(2020, 1, 1),
+        })
+        buf = io.BytesIO()
+        Stream([tr]).write(buf, format='MSEED', reclen=512, encoding='INT32')
+        self.data = buf.getvalue()
+
+    def get_waveforms(self, client, **kwargs):
+        return client.get_waveforms(
+            'XX', 'TEST', '00', 'BHZ', UTCDateTime(2020, 1, 1), UTCDateTime(2020, 1, 1, 1),
+            **kwargs)
+
+    def get_pooled_error(self, code, content):
+        client = PooledClient(
+            self.base_url, session=FakeSession(FakeResponse(code, content)),
+            _discover_services=False)
+        with self.assertRaises(Exception) as context:
+            self.get_waveforms(client)
+        return context.exception
+
+    def get_stock_error(self, code, content):
+        client = obspy.clients.fdsn.Client(self.base_url, _discover_services=False)
+        with mock.patch('obspy.clients.fdsn.client.download_url',
+                        return_value=(code, io.BytesIO(content))):
+            with self.assertRaises(Exception) as context:
+                self.get_waveforms(client)
+        return context.exception
+
+    def assertSameError(self, code, content):
+        pooled = self.get_pooled_error(code, content)
+        stock = self.get_stock_error(code, content)
+        self.assertIs(type(pooled), type(stock))
+        self.assertEqual(pooled.args, stock.args)
+        return pooled
+
+    def test_errors_1(self):
+        for code in (400, 413, 500, 503):
+            error = self.assertSameError(code, b'Error 1234\n\nSomething went wrong')
+            self.assertIn('Something went wrong', str(error))
+
+    def test_no_data_1(self):
+        error = self.assertSameError(204, b'')
+        self.assertIsInstance(error, obspy.clients.fdsn.header.FDSNNoDataException)
+
+    def test_filename_1(self):
+        session = FakeSession(FakeResponse(200, self.data))
+        client = PooledClient(self.base_url, session=session, _discover_services=False)
+        buf = io.BytesIO()
+        self.assertIsNone(self.get_waveforms(client, filename=buf))
+        self.assertEqual(buf.getvalue(), self.data)
+        self.assertEqual(len(session.requests), 1)
+        self.assertEqual(session.requests[0][0], 'GET')
+        self.assertIn('/fdsnws/dataselect/1/query?', session.requests[0][1])
+
+    def test_stream_1(self):
+        session = FakeSession(FakeResponse(200, self.data))
+        client = PooledClient(self.base_url, session=session, _discover_services=False)
+        st = self.get_waveforms(client)
+        self.assertEqual(len(st), 1)
+        self.assertEqual(st[0].id, 'XX.TEST.00.BHZ')
+
+
+class GovernorTest(unittest.TestCase):
+    def test_retry_after_1(self):
+        self.assertEqual(parse_retry_after('30'), 30)
+        self.assertIsNone(parse_retry_after('later'))
+
+    def test_breaker_1(self):
+        breaker = CircuitBreaker('test', threshold=2, timeout=60)
+        breaker.failure()
+        breaker.check()
+        breaker.failure()
+        self.assertRaises(CircuitOpenError, breaker.check)
+
+    def test_bucket_cancel_1(self):
+        bucket = TokenBucket(0.01, 1)
+        bucket.take()
+        token = CancelToken()
+        threading.Timer(0.1, token.cancel).start()
+        start = time.monotonic()
+        self.assertRaises(CancelledException, call_with_token, token, bucket.take)
+        self.assertLess(time.monotonic() - start, 5)
+        # The cancelled wait gave its token back
+        self.assertAlmostEqual(bucket.tokens, 0, delta=0.01)
+
+
+class PriorityQueueTest(unittest.TestCase):
+    def test_priorities_1(self):
+        q = PriorityQueue(key=lambda item: item)
+        for i in range(5):
+            q.put(i, priority=(1, i))
+        q.set_priorities({3: (0, 0), 10: (0, 1)})
+        self.assertEqual([q.get() for i in range(5)], [3, 0, 1, 2, 4])
+
+
+class PipelineTest(unittest.TestCase):
+    def append(self, value):
+        def fn(item):
+            item.append(value)
+            return Pipeline.CONTINUE
+        return fn
+
+    def get_results(self, pipeline, count):
+        results = [pipeline.get_result(timeout=5) for i in range(count)]
+        self.assertNotIn(None, results)
+        return results
+
+    def test_order_1(self):
+        pipeline = Pipeline([
+            Stage('a', self.append('a'), queue_size=2),
+            Stage('b', self.append('b'), queue_size=2),
+        ])
+        pipeline.start()
+        items = [[i] for i in range(10)]
+        pipeline.feed(items)
+        results = self.get_results(pipeline, 10)
+        pipeline.stop()
+        # One worker per stage keeps them in order
+        self.assertEqual([item for (item, result) in results], items)
+        self.assertEqual(results[0], ([0, 'a', 'b'], True))
+
+    def test_errors_1(self):
+        def check(item):
+            if item[0] % 2:
+                raise ValueError('odd')
+            return 'even' if item[0] == 4 else Pipeline.CONTINUE
+
+        def check_batch(items):
+            if any(item[0] == 2 for item in items):
+                raise ValueError('batch')
+            return [(item, Pipeline.CONTINUE) for item in items]
+
+        pipeline = Pipeline([
+            Stage('check', check),
+            Stage('batch', check_batch, batched=True),
+        ])
+        pipeline.start()
+        pipeline.feed([[i] for i in range(6)])
+        results = dict((item[0], result) for (item, result) in self.get_results(pipeline, 6))
+        pipeline.stop()
+        # Each error finishes only the item(s) it was raised for
+        for i in (1, 3, 5):
+            self.assertEqual(str(results[i]), 'odd')
+        self.assertEqual(str(results[2]), 'batch')
+        self.assertEqual(results[4], 'even')
+        self.assertIs(results[0], True)
+
+    def test_backpressure_1(self):
+        release = threading.Event()
+        taken = []
+
+        def take(item):
+            taken.append(item)
+            return Pipeline.CONTINUE
+
+        def block(item):
+            release.wait(5)
+            return Pipeline.CONTINUE
+
+        pipeline = Pipeline([
+            Stage('take', take, queue_size=2),
+            Stage('block', block, queue_size=2),
+        ])
+        pipeline.start()
+        pipeline.feed(range(20))
+        sleep(0.5)
+        # One being worked on and two queued in the blocked stage, one waiting to go into its
+        # queue, and two queued in the first stage
+        self.assertEqual(len(taken), 4)
+        self.assertEqual(pipeline.depths(), [('take', 2, 1), ('block', 2, 1)])
+        release.set()
+        self.get_results(pipeline, 20)
+        pipeline.stop()
+        self.assertEqual(len(taken), 20)
+
+    def test_stop_1(self):
+        release = threading.Event()
+        pipeline = Pipeline([
+            Stage('a', lambda item: Pipeline.CONTINUE, workers=2, queue_size=1),
+            Stage('b', lambda item: release.wait(5) and Pipeline.CONTINUE, queue_size=1),
+        ])
+        pipeline.start()
+        pipeline.feed(range(10))
+        sleep(0.2)
+        pipeline.stop()
+        release.set()
+        # Every worker (including ones waiting to take or put items) exits
+        for thread in pipeline.threads:
+            thread.join(5)
+            self.assertFalse(thread.is_alive(), thread.name)
+        # Anything not finished is dropped
+        self.assertLessEqual(pipeline.results.qsize(), 1)
+
+
+class CancelTokenTest(unittest.TestCase):
+    def test_cancel_1(self):
+        token = CancelToken()
+        called = []
+        token.add_callback(lambda: called.append(True))
+        self.assertTrue(call_with_token(token, lambda: True))
+        token.cancel()
+        self.assertEqual(called, [True])
+        self.assertRaises(CancelledException, call_with_token, token, check_cancelled)
+        # Callbacks added after cancelling are called right away
+        token.add_callback(lambda: called.append(True))
+        self.assertEqual(len(called), 2)
+
+
+class BatchJobTest(unittest.TestCase):
+    def test_check_job_1(self):
+        check_job({
+            'events': {'minmagnitude': 6},
+            'time_window': {'start_offset': 60, 'start_phase': 'P'},
+            'output_format': 'SAC',
+        })
+        self.assertRaises(JobError, check_job, {'output_format': 'WAV'})
+        self.assertRaises(JobError, check_job, {'time_window': {'start_phase': 'Q'}})
+        self.assertRaises(JobError, check_job, {'outputdir': '/tmp'})
+
+    def test_save_concurrency_1(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with mock.patch('pyweed.preferences.user_config_path', return_value=directory):
+                preferences = Preferences()
+                preferences.Data.eventDataCenter = 'USGS'
+                preferences.save()
+                save_concurrency_limits({'service.example.com': 7})
+                preferences = Preferences()
+                preferences.load()
+        # Only the limits are changed
+        self.assertEqual(preferences.Data.eventDataCenter, 'USGS')
+        self.assertEqual(
+            load_concurrency_limits(preferences.Data.concurrency), {'service.example.com': 7})
+
+
+class WaveformsSaverTest(unittest.TestCase):
+    def test_saver_1(self):
+        job = SaveJob('missing', '/nonexistent/missing.mseed')
+        job.output_path = '/nonexistent/missing.sac'
+        job.output_format = 'SAC'
+        saver = WaveformsSaver([job], [WaveformResult('existing', False)], 1)
+        results = []
+        saver.progress.connect(results.extend)
+        saver.run()
+        self.assertEqual([r.waveform_id for r in results], ['existing', 'missing'])
+        self.assertIs(results[0].result, False)
+        self.assertIsInstance(results[1].result, Exception)
+
+
+class LinkOrCopyTest(unittest.TestCase):
+    def test_link_or_copy_1(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, 'source.mseed')
+            dest = os.path.join(tmp, 'dest.mseed')
+            with open(source, 'wb') as f:
+                f.write(b'data')
+            self.assertIn(link_or_copy(source, dest), ('reflink', 'link', 'copy'))
+            with open(dest, 'rb') as f:
+                self.assertEqual(f.read(), b'data')
+            self.assertRaises(FileExistsError, link_or_copy, source, dest)
+
+
+class MiniSEEDTest(unittest.TestCase):
+    def test_records_1(self):
+        tr = Trace(np.arange(4000, dtype=np.int32), header={
+            'network': 'XX', 'station': 'TEST', 'location': '00', 'channel': 'BHZ',
+            'sampling_rate': 40.0, 'starttime': UTCDateTime(2020, 1, 1),
+        })
+        buf = io.BytesIO()
+        Stream([tr]).write(buf, format='MSEED', reclen=512, encoding='INT32')
+        data = buf.getvalue()
+        records = index_records(data)['XX.TEST.00.BHZ']
+        self.assertEqual(sum(r.length for r in records), len(data))
+        # Timestamps this size are only precise to about a microsecond
+        self.assertAlmostEqual(records[0].start, tr.stats.starttime.timestamp, delta=1e-6)
+        self.assertAlmostEqual(records[-1].end, tr.stats.endtime.timestamp, delta=1e-6)
+        selected = select_records(data, records, records[1].start, records[1].end)
+        self.assertEqual(selected, data[records[1].offset:records[2].offset])
+
+    def test_records_2(self):
+        self.assertRaises(ValueError, index_records, b'not miniseed data' * 10)
+
+
+class CompressionTest(unittest.TestCase):
+    def test_write_file_1(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'metadata.xml.gz')
+            write_file(path, b'<xml/>' * 1000)
+            self.assertLess(os.path.getsize(path), 1000)
+            with open_file(path) as f:
+                self.assertEqual(f.read(), b'<xml/>' * 1000)
+
+    def test_recompress_mseed_1(self):
+        tr = Trace(np.arange(4000, dtype=np.int32), header={
+            'network': 'XX', 'station': 'TEST', 'location': '00', 'channel': 'BHZ',
+            'sampling_rate': 40.0, 'starttime': UTCDateTime(2020, 1, 1),
+        })
+        buf = io.BytesIO()
+        Stream([tr]).write(buf, format='MSEED', reclen=512, encoding='INT32')
+        data = recompress_mseed(buf.getvalue())
+        self.assertLess(len(data), len(buf.getvalue()))
+        st = obspy.read(io.BytesIO(data))
+        np.testing.assert_array_equal(st[0].data, tr.data)
+
+
+class SegmentStoreTest(unittest.TestCase):
+    def test_segments_1(self):
+        start = UTCDateTime(2020, 1, 1)
+        tr = Trace(np.arange(48000, dtype=np.int32), header={
+            'network': 'XX', 'station': 'TEST', 'location': '00', 'channel': 'BHZ',
+            'sampling_rate': 40.0, 'starttime': start,
+        })
+        buf = io.BytesIO()
+        Stream([tr]).write(buf, format='MSEED', reclen=512, encoding='INT32')
+        data = buf.getvalue()
+        with tempfile.TemporaryDirectory() as tmp:
+            store = SegmentStore(tmp, segment_length=600)
+            gaps = store.get_gaps('XX.TEST.00.BHZ', start + 100, start + 700)
+            self.assertEqual(gaps, [(start, start + 1200)])
+            self.assertIsNone(store.read('XX.TEST.00.BHZ', start + 100, start + 700))
+            store.store('XX.TEST.00.BHZ', gaps, data, index_records(data)['XX.TEST.00.BHZ'])
+            self.assertEqual(store.get_gaps('XX.TEST.00.BHZ', start + 100, start + 700), [])
+            # A different window from the same segments, without any duplicate records
+            records = index_records(
+                store.read('XX.TEST.00.BHZ', start + 300, start + 900))['XX.TEST.00.BHZ']
+            self.assertEqual(len(records), len(set(r.start for r in records)))
+            self.assertLessEqual(records[0].start, (start + 300).timestamp)
+            self.assertGreaterEqual(records[-1].end, (start + 900).timestamp)
+
+    def test_compressed_segments_1(self):
+        start = UTCDateTime(2020, 1, 1)
+        tr = Trace(np.arange(48000, dtype=np.int32), header={
+            'network': 'XX', 'station': 'TEST', 'location': '00', 'channel': 'BHZ',
+            'sampling_rate': 40.0, 'starttime': start,
+        })
+        buf = io.BytesIO()
+        Stream([tr]).write(buf, format='MSEED', reclen=512, encoding='INT32')
+        data = buf.getvalue()
+        records = index_records(data)['XX.TEST.00.BHZ']
+        sizes = []
+        with tempfile.TemporaryDirectory() as tmp:
+            for compress in (False, True):
+                store = SegmentStore(
+                    os.path.join(tmp, str(compress)), segment_length=600, compress=compress)
+                os.makedirs(store.directory)
+                gaps = store.get_gaps('XX.TEST.00.BHZ', start, start + 1200)
+                store.store('XX.TEST.00.BHZ', gaps, data, records)
+                sizes.append(sum(
+                    os.path.getsize(os.path.join(store.directory, name))
+                    for name in os.listdir(store.directory)))
+                # The records come back exactly as they were received
+                self.assertEqual(
+                    store.read('XX.TEST.00.BHZ', start, start + 1199),
+                    select_records(data, records, start.timestamp, (start + 1199).timestamp))
+        self.assertLess(sizes[1], sizes[0] * 0.75)
+
+
+class CacheIndexTest(unittest.TestCase):
+    def write(self, path, size):
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+
+    def test_cache_index_1(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            old = os.path.join(tmp, 'old.mseed')
+            new = os.path.join(tmp, 'new.mseed')
+            self.write(old, 100)
+            os.utime(old, (0, 0))
+            index = CacheIndex(tmp)
+            # Existing files are picked up when the index is first built
+            self.assertEqual(index.total_size, 100)
+            self.assertFalse(index.lookup(new))
+            self.write(new, 50)
+            index.add(new)
+            self.assertEqual(index.total_size, 150)
+            self.assertEqual(index.evict(120), 1)
+            self.assertFalse(os.path.exists(old))
+            self.assertTrue(os.path.exists(new))
+            index.close()
+            index = CacheIndex(tmp)
+            self.assertEqual(list(index.files), ['new.mseed'])
+            index.close()
+
+    def get_pinned_paths(self):
+        return self.pinned_paths
+
+    def test_cache_evictor_1(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            index = CacheIndex(tmp)
+            paths = [os.path.join(tmp, '%d.mseed' % i) for i in range(4)]
+            for path in paths:
+                self.write(path, 100)
+                index.add(path)
+            # The oldest file is still in use
+            self.pinned_paths = paths[:1]
+            index.add_pins(self.get_pinned_paths)
+            evictor = CacheEvictor(index, 300, high_watermark=1.0, low_watermark=0.7)
+            self.assertEqual(evictor.check(), 2)
+            self.assertTrue(os.path.exists(paths[0]))
+            self.assertFalse(os.path.exists(paths[1]))
+            self.assertTrue(os.path.exists(paths[3]))
+            stats = index.get_stats()
+            self.assertEqual(stats['evicted_bytes'], 200)
+            self.assertEqual(stats['size'], 200)
+            # Under the high watermark, so nothing happens
+            self.assertEqual(evictor.check(), 0)
+            index.close()
+
+
 if __name__ == '__main__':
     unittest.main()
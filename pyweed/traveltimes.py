@@ -0,0 +1,485 @@
+# -*- coding: utf-8 -*-
+"""
+Precomputed travel time tables.
+
+Calculating the phase arrivals for each event/station pair with TauP (see `get_arrivals`) takes a
+few milliseconds, which adds up for a large selection. Instead, the first P and S arrival times
+are precomputed on a grid of distance and depth, and looked up for all the pairs at once with
+bilinear interpolation.
+
+The tables are built offline with TauP, and stored as compressed NumPy files in pyweed/data:
+
+    python -m pyweed.traveltimes [model]
+
+Error bound: when a table is built, the interpolated times are checked against TauP at the
+middle of every grid cell (the furthest point from the grid). The first arrival time jumps where a
+phase ends (eg. around 156 degrees, where TauP's Pdiff gives out and the first P arrival becomes
+PKIKP), and cells where the error is over `MAX_TABLE_ERROR` are excluded, so the pairs in them are
+left to TauP. The largest error in the remaining cells for each phase is stored in the table as
+`max_error` (logged when the table is loaded, and printed when it's built). Where TauP finds no
+arrival for a grid point the lookup gives no arrival, and those pairs are also left to TauP.
+
+The table in pyweed/data is for iasp91, on a grid of 0.5 degrees x 10 km (0-180 degrees, 0-700
+km). Its maximum error is 0.59s for P and 0.93s for S, with 82 of the 25200 cells (near 156-158
+degrees, and under 0.5 degrees for shallow events) excluded.
+
+If there's no table for the model, or the `Waveforms.exactArrivals` preference is set, arrivals are
+calculated exactly with TauP. This is done for all the waveforms at once by `iter_arrivals` (in the
+background while the waveforms load), in a pool of worker processes that each load their own model,
+and the results are kept in an `ArrivalsMemo` on disk so the same event/station pairs are never
+calculated twice. Memo keys are rounded to 0.01 degrees and 0.1 km, which changes the arrival times
+by well under a second.
+
+:copyright:
+    Mazama Science, IRIS
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+
+import concurrent.futures
+import json
+import os
+import sqlite3
+import sys
+import threading
+from logging import getLogger
+import numpy as np
+from obspy.taup.tau import TauPyModel
+from pyweed.pyweed_utils import TAUP_PHASES, get_arrivals
+
+LOGGER = getLogger(__name__)
+
+# The default TauP model (this is what `TauPyModel` uses by default)
+DEFAULT_MODEL = "iasp91"
+# Phases in the tables
+TABLE_PHASES = ("P", "S")
+# Default grid
+TABLE_DISTANCES = np.arange(0, 180.25, 0.5)
+TABLE_DEPTHS = np.arange(0, 710, 10)
+# Largest interpolation error (in seconds) allowed in a grid cell, pairs in cells with larger errors
+# are left to TauP
+MAX_TABLE_ERROR = 1.0
+# Where the tables are kept
+TABLE_DIR = os.path.join(os.path.dirname(__file__), "data")
+
+# Memo database, in the user configuration directory
+MEMO_FILENAME = "arrivals.sqlite"
+# Memo keys are the distance in units of 0.01 degrees, and the depth in units of 0.1 km
+MEMO_DISTANCE_SCALE = 100
+MEMO_DEPTH_SCALE = 10
+# Number of pairs each worker process calculates at a time
+ARRIVALS_CHUNK = 100
+
+# Loaded tables, by model (None if there isn't one)
+_tables = {}
+_tables_lock = threading.Lock()
+
+# Model used in a worker process, see `init_worker`
+_worker_taup = None
+
+
+def get_table_path(model=DEFAULT_MODEL):
+    return os.path.join(TABLE_DIR, "traveltimes_%s.npz" % model)
+
+
+class TravelTimeTable(object):
+    """
+    First arrival times for each phase on a regular grid of distance (degrees) x depth (km)
+    """
+
+    def __init__(self, model, distances, depths, times, max_error=None, excluded=None):
+        """
+        :param distances: grid distances, evenly spaced
+        :param depths: grid depths, evenly spaced
+        :param times: dictionary of phase -> 2D array of times (distance x depth), with NaN where
+            there is no arrival
+        :param max_error: dictionary of phase -> largest interpolation error found (see
+            `build_table`)
+        :param excluded: 2D boolean array (one less than the grid in each direction), True for the
+            grid cells the table shouldn't be used in
+        """
+        self.model = model
+        self.distances = np.asarray(distances, dtype=float)
+        self.depths = np.asarray(depths, dtype=float)
+        self.times = times
+        self.max_error = max_error or {}
+        self.excluded = excluded
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as npz:
+            return cls(
+                str(npz["model"]),
+                npz["distances"],
+                npz["depths"],
+                dict((phase, npz["times_%s" % phase]) for phase in TABLE_PHASES),
+                dict((phase, float(npz["error_%s" % phase])) for phase in TABLE_PHASES),
+                npz["excluded"] if "excluded" in npz.files else None,
+            )
+
+    def save(self, path):
+        arrays = dict(
+            model=np.array(self.model),
+            distances=self.distances,
+            depths=self.depths,
+        )
+        for phase in TABLE_PHASES:
+            arrays["times_%s" % phase] = self.times[phase].astype(np.float32)
+            arrays["error_%s" % phase] = np.array(self.max_error.get(phase, np.nan))
+        if self.excluded is not None:
+            arrays["excluded"] = self.excluded
+        np.savez_compressed(path, **arrays)
+
+    def lookup(self, distances, depths):
+        """
+        Interpolate the arrival times for many points at once
+
+        :param distances: array of distances (degrees)
+        :param depths: array of depths (km), these are clipped to the range of the table
+        :return: dictionary of phase -> array of times, with NaN where there is no arrival (or the
+            point is in an excluded cell)
+        """
+        d = np.clip(
+            np.asarray(distances, dtype=float), self.distances[0], self.distances[-1]
+        )
+        z = np.clip(np.asarray(depths, dtype=float), self.depths[0], self.depths[-1])
+        (i, fd) = self.get_cells(self.distances, d)
+        (j, fz) = self.get_cells(self.depths, z)
+        results = {}
+        for phase, times in self.times.items():
+            results[phase] = (
+                times[i, j] * (1 - fd) * (1 - fz)
+                + times[i + 1, j] * fd * (1 - fz)
+                + times[i, j + 1] * (1 - fd) * fz
+                + times[i + 1, j + 1] * fd * fz
+            )
+            if self.excluded is not None:
+                results[phase] = np.where(self.excluded[i, j], np.nan, results[phase])
+        return results
+
+    @staticmethod
+    def get_cells(grid, values):
+        """
+        Find the grid cell for each value, returning the index of the lower grid point and the
+        fractional position within the cell
+        """
+        step = grid[1] - grid[0]
+        index = np.clip(((values - grid[0]) // step).astype(int), 0, len(grid) - 2)
+        return (index, (values - grid[index]) / step)
+
+
+def get_table(model=DEFAULT_MODEL):
+    """
+    Get the travel time table for a model, or None if there isn't one
+    """
+    with _tables_lock:
+        if model not in _tables:
+            path = get_table_path(model)
+            table = None
+            if os.path.exists(path):
+                try:
+                    table = TravelTimeTable.load(path)
+                    LOGGER.info(
+                        "Loaded travel time table for %s (maximum error %s)",
+                        model,
+                        ", ".join(
+                            "%s %.2fs" % (phase, error)
+                            for (phase, error) in sorted(table.max_error.items())
+                        ),
+                    )
+                except Exception as e:
+                    LOGGER.warning("Couldn't load travel time table %s: %s", path, e)
+            else:
+                LOGGER.info("No travel time table for %s, using TauP", model)
+            _tables[model] = table
+        return _tables[model]
+
+
+def get_table_arrivals(distances, depths, model=DEFAULT_MODEL):
+    """
+    Look up the first P and S arrivals for many distance/depth pairs at once.
+
+    :return: a list with a dictionary of phase -> arrival time (like `get_arrivals`) for each pair,
+        or None for pairs that aren't covered by the table. Returns None if there's no table.
+    """
+    table = get_table(model)
+    if not table or not len(distances):
+        return None
+    times = table.lookup(distances, depths)
+    p_times = times["P"].tolist()
+    s_times = times["S"].tolist()
+    arrivals = []
+    for p_time, s_time in zip(p_times, s_times):
+        # NaN means no arrival (NaN != NaN)
+        if p_time == p_time and s_time == s_time:
+            arrivals.append({"P": p_time, "S": s_time})
+        else:
+            arrivals.append(None)
+    return arrivals
+
+
+class ArrivalsMemo(object):
+    """
+    Arrivals calculated with TauP, stored in an SQLite database. This is safe to use from multiple
+    threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS arrivals ("
+            "model TEXT, distance INTEGER, depth INTEGER, arrivals TEXT NOT NULL, "
+            "PRIMARY KEY (model, distance, depth))"
+        )
+        self.db.commit()
+
+    def get_many(self, model, keys):
+        """
+        Look up many keys (see `get_memo_key`) at once
+
+        :return: dictionary of key -> arrivals for the keys that are in the memo
+        """
+        found = {}
+        with self.lock:
+            for key in keys:
+                row = self.db.execute(
+                    "SELECT arrivals FROM arrivals "
+                    "WHERE model = ? AND distance = ? AND depth = ?",
+                    (model,) + key,
+                ).fetchone()
+                if row:
+                    found[key] = json.loads(row[0])
+        return found
+
+    def put_many(self, model, results):
+        """
+        Store a list of (key, arrivals) results
+        """
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO arrivals VALUES (?, ?, ?, ?)",
+                (
+                    (model, distance, depth, json.dumps(arrivals))
+                    for ((distance, depth), arrivals) in results
+                ),
+            )
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def open_memo(path):
+    """
+    Open the arrivals memo, recreating it if it's unusable
+    """
+    try:
+        return ArrivalsMemo(path)
+    except sqlite3.DatabaseError as e:
+        LOGGER.warning("Arrivals memo %s is unusable, recreating it: %s", path, e)
+        os.remove(path)
+        return ArrivalsMemo(path)
+
+
+def get_memo_key(distance, depth):
+    """
+    Get the memo key for a distance/depth pair
+
+    >>> get_memo_key(20.123, 10.06)
+    (2012, 101)
+    """
+    return (
+        int(round(distance * MEMO_DISTANCE_SCALE)),
+        int(round(depth * MEMO_DEPTH_SCALE)),
+    )
+
+
+def calculate_key_arrivals(keys, taup=None):
+    """
+    Calculate the arrivals for a list of memo keys, returning a list of (key, arrivals)
+    """
+    return [
+        (
+            key,
+            get_arrivals(
+                key[0] / MEMO_DISTANCE_SCALE,
+                key[1] / MEMO_DEPTH_SCALE,
+                taup or _worker_taup,
+            ),
+        )
+        for key in keys
+    ]
+
+
+def init_worker(model):
+    """
+    Load the model in a worker process
+    """
+    global _worker_taup
+    _worker_taup = TauPyModel(model=model)
+
+
+def iter_arrivals(pairs, model=DEFAULT_MODEL, memo=None, processes=None):
+    """
+    Calculate the arrivals for many distance/depth pairs with TauP, yielding them as they're ready.
+
+    Pairs that are in the memo come first. The rest are calculated in chunks (in the order they were
+    given) in a pool of worker processes (unless there are only a few of them), and added to the
+    memo.
+
+    :param pairs: list of (distance, depth) pairs, in degrees and km
+    :param memo: `ArrivalsMemo` to use
+    :param processes: number of worker processes (by default one per CPU core)
+    :return: an iterator of lists of (index, arrivals), where index is the position in pairs and
+        arrivals is a dictionary of phase -> arrival time (like `get_arrivals`)
+    """
+    # Positions of each key in pairs, in the order they first appear
+    indexes = {}
+    for i, (distance, depth) in enumerate(pairs):
+        indexes.setdefault(get_memo_key(distance, depth), []).append(i)
+
+    def get_results(key_arrivals):
+        return [(i, arrivals) for (key, arrivals) in key_arrivals for i in indexes[key]]
+
+    found = memo.get_many(model, indexes) if memo else {}
+    if found:
+        yield get_results(found.items())
+    missing = [key for key in indexes if key not in found]
+    if not missing:
+        return
+    LOGGER.info(
+        "Calculating arrivals for %d pairs (%d found in the memo)",
+        len(missing),
+        len(found),
+    )
+    chunks = [
+        missing[i : i + ARRIVALS_CHUNK] for i in range(0, len(missing), ARRIVALS_CHUNK)
+    ]
+    processes = min(processes or os.cpu_count() or 1, len(chunks))
+    if processes > 1:
+        with concurrent.futures.ProcessPoolExecutor(
+            processes, initializer=init_worker, initargs=(model,)
+        ) as executor:
+            futures = [
+                executor.submit(calculate_key_arrivals, chunk) for chunk in chunks
+            ]
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    results = future.result()
+                    if memo:
+                        memo.put_many(model, results)
+                    yield get_results(results)
+            finally:
+                # If the caller stopped early, don't calculate the rest
+                for future in futures:
+                    future.cancel()
+    else:
+        # Not worth starting any processes for
+        taup = None if model == DEFAULT_MODEL else TauPyModel(model=model)
+        for chunk in chunks:
+            results = calculate_key_arrivals(chunk, taup)
+            if memo:
+                memo.put_many(model, results)
+            yield get_results(results)
+
+
+def calculate_arrivals(pairs, model=DEFAULT_MODEL, memo=None, processes=None):
+    """
+    Calculate the arrivals for many distance/depth pairs with TauP (see `iter_arrivals`)
+
+    :return: a list with a dictionary of phase -> arrival time (like `get_arrivals`) for each pair
+    """
+    arrivals = [None] * len(pairs)
+    for results in iter_arrivals(pairs, model, memo, processes):
+        for i, pair_arrivals in results:
+            arrivals[i] = pair_arrivals
+    return arrivals
+
+
+def build_table(
+    model=DEFAULT_MODEL, distances=TABLE_DISTANCES, depths=TABLE_DEPTHS, progress=None
+):
+    """
+    Build a travel time table with TauP. This takes a while!
+
+    :param progress: function called with the fraction done
+    """
+    taup = TauPyModel(model=model)
+
+    def calculate(distance, depth):
+        first = {}
+        for arrival in taup.get_travel_times(depth, distance, TAUP_PHASES):
+            first.setdefault(arrival.name[0].upper(), arrival.time)
+        return [first.get(phase, np.nan) for phase in TABLE_PHASES]
+
+    def calculate_grid(grid_distances, grid_depths, done, total):
+        times = np.full(
+            (len(TABLE_PHASES), len(grid_distances), len(grid_depths)), np.nan
+        )
+        for i, distance in enumerate(grid_distances):
+            for j, depth in enumerate(grid_depths):
+                times[:, i, j] = calculate(distance, depth)
+            if progress:
+                progress((done + i + 1) / total)
+        return times
+
+    distances = np.asarray(distances, dtype=float)
+    depths = np.asarray(depths, dtype=float)
+    # The grid, then the middle of each cell to check the error
+    mid_distances = (distances[:-1] + distances[1:]) / 2
+    mid_depths = (depths[:-1] + depths[1:]) / 2
+    total = len(distances) + len(mid_distances)
+    grid = calculate_grid(distances, depths, 0, total)
+    table = TravelTimeTable(
+        model,
+        distances,
+        depths,
+        dict((phase, grid[k]) for k, phase in enumerate(TABLE_PHASES)),
+    )
+    exact = calculate_grid(mid_distances, mid_depths, len(distances), total)
+    (mid_d, mid_z) = np.meshgrid(mid_distances, mid_depths, indexing="ij")
+    interpolated = table.lookup(mid_d.ravel(), mid_z.ravel())
+    errors = dict(
+        (phase, np.abs(interpolated[phase] - exact[k].ravel()).reshape(mid_d.shape))
+        for k, phase in enumerate(TABLE_PHASES)
+    )
+    # Cells where the first arrival jumps (eg. where Pdiff ends) can't be interpolated
+    table.excluded = np.zeros(mid_d.shape, dtype=bool)
+    for phase_errors in errors.values():
+        table.excluded |= phase_errors > MAX_TABLE_ERROR
+    for phase, phase_errors in errors.items():
+        table.max_error[phase] = float(np.nanmax(phase_errors[~table.excluded]))
+    return table
+
+
+def main(argv=None):
+    """
+    Build the travel time table for a model (iasp91 by default)
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    model = argv[0] if argv else DEFAULT_MODEL
+    path = get_table_path(model)
+
+    def progress(fraction):
+        sys.stderr.write("\r%s: %3d%%" % (model, fraction * 100))
+
+    table = build_table(model, progress=progress)
+    sys.stderr.write("\n")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    table.save(path)
+    print(
+        "Wrote %s (maximum error %s, %d of %d cells excluded)"
+        % (path, table.max_error, table.excluded.sum(), table.excluded.size)
+    )
+
+
+# ------------------------------------------------------------------------------
+# Main
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
@@ -13,33 +13,62 @@ from __future__ import absolute_import, division, print_function
 
 import os
 from typing import List
-from pyweed.preferences import Preferences, safe_int
+from pyweed.preferences import Preferences, safe_bool, safe_int, user_config_path
 from pyweed.signals import SignalingThread, SignalingObject
 from PyQt5 import QtCore
 import obspy
 from obspy.clients.fdsn import Client
 from logging import getLogger
-import matplotlib
 import weakref
 from pyweed.pyweed_utils import (
     METADATA_FORMAT_EXTENSIONS,
     get_sncl,
-    get_event_id,
     TimeWindow,
     get_preferred_origin,
     get_preferred_magnitude,
     OUTPUT_FORMAT_EXTENSIONS,
-    get_event_description,
     get_arrivals,
-    format_time_str,
     get_distance,
     get_service_url,
     CancelledException,
+    CancelToken,
+    call_with_token,
+    check_cancelled,
+    link_or_copy,
+    atomic_file,
 )
 from obspy.core.util.attribdict import AttribDict
 from obspy.io.sac.sactrace import SACTrace
 from obspy.core.stream import Stream
+from obspy.core.inventory import Inventory, Station, Channel
+from obspy import UTCDateTime
+from pyweed.clients import get_worker_count
+from pyweed.pipeline import Pipeline, Stage, PriorityQueue, POLL_INTERVAL
+from pyweed.thumbnails import write_thumbnail
+from pyweed.mseed import index_records, select_records
+from pyweed.cache import CacheIndex
+from pyweed.segments import SegmentStore
+from pyweed.event_table import EventTable
+from pyweed.traveltimes import (
+    MEMO_FILENAME,
+    get_table_arrivals,
+    iter_arrivals,
+    open_memo,
+)
+from pyweed.compression import (
+    decompress_file,
+    get_extension,
+    is_compressed,
+    open_file,
+    recompress_mseed,
+    write_file,
+)
 import concurrent.futures
+import functools
+import io
+import itertools
+import threading
+import time
 
 LOGGER = getLogger(__name__)
 
@@ -76,11 +105,17 @@ class WaveformEntry(AttribDict):
         sncl=None,
         event_time_str=None,
         event_description=None,
+        # Event name, see `get_event_name`
+        event_name=None,
         event_mag=None,
         event_mag_value=None,
         event_depth=None,
         # Base directory to download files to (from WaveformsHandler)
         download_dir=None,
+        # Index of the files in download_dir (from WaveformsHandler)
+        cache=None,
+        # Whether to compress cached files (from WaveformsHandler)
+        compress_cache=False,
         # Time window settings (from WaveformHandler)
         time_window=None,
         # Base filename for mseed, image, etc.
@@ -91,6 +126,10 @@ class WaveformEntry(AttribDict):
         image_path=None,
         image_exists=False,
         download_metadata=True,
+        # Identifies the channel epoch, waveforms from the same epoch share a metadata file
+        channel_epoch=None,
+        channel_start=None,
+        channel_end=None,
         metadata_path=None,
         metadata_exists=False,
         # Loading indicator
@@ -99,28 +138,60 @@ class WaveformEntry(AttribDict):
         error=None,
     )
 
-    def __init__(self, event, network, station, channel, *args, **kwargs):
+    def __init__(
+        self,
+        event_table: EventTable,
+        event_row,
+        network,
+        station,
+        channel,
+        distance=None,
+        *args,
+        **kwargs,
+    ):
+        """
+        :param event_table: the `EventTable` the event comes from
+        :param event_row: the event's row in the table
+        :param distance: distance from the event to the station, if it has already been
+            calculated (see `PyWeedCore.iter_selected_events_stations`)
+        """
         super(WaveformEntry, self).__init__(*args, **kwargs)
 
-        self.event_ref = weakref.ref(event)
+        self.event_ref = weakref.ref(event_table.get_event(event_row))
         self.network_ref = weakref.ref(network)
         self.station_ref = weakref.ref(station)
         self.channel_ref = weakref.ref(channel)
 
         self.sncl = get_sncl(network, station, channel)
 
-        self.event_description = get_event_description(event)
-        origin = get_preferred_origin(event)
-        self.event_time = origin.time
-        self.event_time_str = format_time_str(origin.time)
-        self.event_depth = origin.depth / 1000
-        mag = get_preferred_magnitude(event)
-        self.event_mag = "%s%s" % (mag.mag, mag.magnitude_type)
-        self.event_mag_value = mag.mag
-        self.waveform_id = "%s_%s" % (self.sncl, get_event_id(event))
-
-        self.distance = get_distance(
-            origin.latitude, origin.longitude, station.latitude, station.longitude
+        self.event_description = event_table.descriptions[event_row]
+        self.event_name = event_table.get_name(event_row)
+        self.event_time = event_table.get_time(event_row)
+        self.event_time_str = event_table.time_strs[event_row]
+        self.event_depth = float(event_table.depths[event_row])
+        self.event_mag = event_table.get_magnitude_str(event_row)
+        self.event_mag_value = float(event_table.magnitudes[event_row])
+        self.waveform_id = "%s_%s" % (self.sncl, event_table.event_ids[event_row])
+
+        if distance is None:
+            distance = get_distance(
+                event_table.latitudes[event_row],
+                event_table.longitudes[event_row],
+                station.latitude,
+                station.longitude,
+            )
+        self.distance = distance
+
+        epoch = find_channel_epoch(station, channel, self.event_time)
+        self.channel_start = epoch.start_date
+        self.channel_end = epoch.end_date
+        self.channel_epoch = "%s_%s" % (
+            self.sncl,
+            (
+                self.channel_start.format_iris_web_service().replace(":", "_")
+                if self.channel_start
+                else "0"
+            ),
         )
 
     def update_handler_values(self, waveform_handler: "WaveformsHandler"):
@@ -128,8 +199,28 @@ class WaveformEntry(AttribDict):
         Update any values that come from the WaveformHander
         """
         self.download_dir = waveform_handler.downloadDir
+        self.cache = waveform_handler.cache_index
+        self.compress_cache = waveform_handler.compress_cache
         self.time_window = waveform_handler.time_window
+        # The time window and paths may have changed, they're recalculated by `prepare`
+        self.start_time = None
+        self.end_time = None
+        self.mseed_path = None
+        self.mseed_exists = False
+        self.image_path = None
+        self.image_exists = False
         self.download_metadata = waveform_handler.download_metadata
+        if self.download_metadata:
+            # Metadata is stored once per channel epoch
+            self.metadata_path = os.path.join(
+                self.download_dir,
+                "%s.%s"
+                % (self.channel_epoch, METADATA_FORMAT_EXTENSIONS["STATIONXML"]),
+            )
+            if self.compress_cache:
+                self.metadata_path = "%s.%s" % (self.metadata_path, get_extension())
+        else:
+            self.metadata_path = None
 
     def prepare(self):
         """
@@ -153,14 +244,6 @@ class WaveformEntry(AttribDict):
             self.download_dir, "%s.mseed" % self.base_filename
         )
         self.image_path = os.path.join(self.download_dir, "%s.png" % self.base_filename)
-        if self.download_metadata:
-            self.metadata_path = os.path.join(
-                self.download_dir,
-                "%s.%s"
-                % (self.base_filename, METADATA_FORMAT_EXTENSIONS["STATIONXML"]),
-            )
-        else:
-            self.metadata_path = None
 
         self.check_files()
 
@@ -168,9 +251,114 @@ class WaveformEntry(AttribDict):
         """
         After calculating the paths for downloaded files, check to see if they're already there
         """
-        self.mseed_exists = os.path.exists(self.mseed_path)
-        self.image_exists = os.path.exists(self.image_path)
-        self.metadata_exists = self.metadata_path and os.path.exists(self.metadata_path)
+        self.mseed_exists = self.file_exists(self.mseed_path)
+        self.image_exists = self.file_exists(self.image_path)
+        self.metadata_exists = self.metadata_path and self.file_exists(
+            self.metadata_path
+        )
+
+    def file_exists(self, path):
+        """
+        Check whether a file is in the download cache
+        """
+        if self.cache:
+            return self.cache.lookup(path)
+        return os.path.exists(path)
+
+    def forget_file(self, path, error=None):
+        """
+        Remove a cached file that couldn't be read (eg. it was deleted outside of PyWEED, so the cache
+        index still has it) so it's fetched or generated again.
+        """
+        LOGGER.warning("Couldn't read cached file %s: %s", path, error)
+        if self.cache:
+            self.cache.remove(path)
+        if path == self.mseed_path:
+            self.mseed_exists = False
+        if path == self.image_path:
+            self.image_exists = False
+        if path == self.metadata_path:
+            self.metadata_exists = False
+
+
+def set_table_arrivals(waveforms: List[WaveformEntry]):
+    """
+    Fill in the phase arrivals for many waveforms at once from the travel time table (see
+    `get_table_arrivals`). Any that aren't covered are left to be calculated with TauP.
+    """
+    arrivals = get_table_arrivals(
+        [waveform.distance for waveform in waveforms],
+        [waveform.event_depth for waveform in waveforms],
+    )
+    if arrivals:
+        for waveform, waveform_arrivals in zip(waveforms, arrivals):
+            if waveform_arrivals:
+                waveform.arrivals = waveform_arrivals
+
+
+class ExactArrivals(object):
+    """
+    Calculates the phase arrivals with TauP for any waveforms that don't have them yet (see
+    `iter_arrivals`).
+
+    This runs in the background while the waveforms load, and each waveform only waits for its own
+    arrivals (see `wait`). If the calculation fails, `WaveformEntry.prepare` calculates any that are
+    still missing.
+    """
+
+    def __init__(self, waveforms: List[WaveformEntry], memo=None):
+        self.waveforms = [waveform for waveform in waveforms if not waveform.arrivals]
+        self.memo = memo
+        self.condition = threading.Condition()
+        # Whether the calculation is over (successfully or not)
+        self.finished = not self.waveforms
+
+    def run(self):
+        try:
+            if self.waveforms:
+                pairs = [
+                    (waveform.distance, waveform.event_depth)
+                    for waveform in self.waveforms
+                ]
+                for results in iter_arrivals(pairs, memo=self.memo):
+                    check_cancelled()
+                    with self.condition:
+                        for i, arrivals in results:
+                            self.waveforms[i].arrivals = arrivals
+                        self.condition.notify_all()
+        except CancelledException:
+            raise
+        except Exception as e:
+            LOGGER.error("Failed to calculate arrivals: %s", e)
+        finally:
+            with self.condition:
+                self.finished = True
+                self.condition.notify_all()
+
+    def wait(self, waveform: WaveformEntry):
+        """
+        Wait until the waveform has its arrivals, or the calculation is over
+        """
+        with self.condition:
+            while not (waveform.arrivals or self.finished):
+                check_cancelled()
+                self.condition.wait(POLL_INTERVAL)
+
+
+def find_channel_epoch(station: Station, channel: Channel, time: UTCDateTime):
+    """
+    Find the epoch of the given channel that was active at the given time. The channel passed in
+    may not be the right one, since `iter_channels` only returns the first epoch for each channel.
+    """
+    for epoch in station.channels:
+        if (
+            epoch.code == channel.code
+            and epoch.location_code == channel.location_code
+            and (not epoch.start_date or epoch.start_date <= time)
+            and (not epoch.end_date or time <= epoch.end_date)
+        ):
+            return epoch
+    return channel
 
 
 class WaveformResult(object):
@@ -184,183 +372,1108 @@ class WaveformResult(object):
         self.result = result
 
 
-def load_waveform(client: Client, waveform: WaveformEntry):
+def group_metadata_epochs(waveforms: List[WaveformEntry]):
     """
-    Download the given waveform data and generate an image. This is a standalone function so we can
-    run it in a separate thread. This modifies the waveform entry and returns a dummy value, or
-    raises an exception on any error.
+    Group the waveforms that still need metadata by channel epoch.
+    Returns a list with one list of waveforms for each epoch.
     """
-    plot_width = 600
-    plot_height = 120
+    epochs = {}
+    for waveform in waveforms:
+        if waveform.metadata_path and not waveform.file_exists(waveform.metadata_path):
+            epochs.setdefault(waveform.channel_epoch, []).append(waveform)
+    return list(epochs.values())
 
-    waveform_id = waveform.waveform_id
-    LOGGER.debug(
-        "Loading waveform: %s (%s)", waveform_id, QtCore.QThread.currentThreadId()
-    )
-    #     LOGGER.debug("Adding slowness")
-    #     QtCore.QThread.currentThread().sleep(2)
 
+def load_metadata_bulk(client: Client, epoch_groups: List[List[WaveformEntry]]):
+    """
+    Download response-level metadata for a set of channel epochs (see `group_metadata_epochs`) using
+    a single FDSN station POST request, and write each epoch to its own file. This is a standalone
+    function so we can run it in a separate thread.
+
+    Any errors are only logged, since `load_waveform_metadata` will try again for any
+    metadata that is missing.
+    """
+    bulk = []
+    for waveforms in epoch_groups:
+        (network, station, location, channel) = waveforms[0].sncl.split(".")
+        # Open-ended epochs are limited to the time around the events
+        event_times = [waveform.event_time for waveform in waveforms]
+        bulk.append(
+            (
+                network,
+                station,
+                location or "--",
+                channel,
+                waveforms[0].channel_start or (min(event_times) - 86400),
+                waveforms[0].channel_end or (max(event_times) + 86400),
+            )
+        )
+    LOGGER.info(
+        "Retrieving metadata for %d channel epochs from %s", len(bulk), client.base_url
+    )
     try:
-        waveform.prepare()
+        inventory = client.get_stations_bulk(bulk, level="response")
+    except CancelledException:
+        raise
+    except Exception as e:
+        LOGGER.warning("Bulk metadata request failed: %s", e)
+        return False
+
+    for waveforms in epoch_groups:
+        check_cancelled()
+        (network, station, location, channel) = waveforms[0].sncl.split(".")
+        try:
+            epoch_inventory = inventory.select(
+                network=network,
+                station=station,
+                location=location,
+                channel=channel,
+                time=waveforms[0].event_time,
+            )
+            if not epoch_inventory.networks:
+                LOGGER.warning(
+                    "No metadata returned for %s", waveforms[0].channel_epoch
+                )
+                continue
+            write_metadata(
+                epoch_inventory, waveforms[0].metadata_path, waveforms[0].cache
+            )
+        except Exception as e:
+            LOGGER.warning(
+                "Failed to save metadata for %s: %s", waveforms[0].channel_epoch, e
+            )
+    return True
 
-        if waveform.image_exists and (
-            not waveform.download_metadata or waveform.metadata_exists
-        ):
-            # No download needed
-            LOGGER.info("Waveform %s already complete" % waveform_id)
-            return True
 
-        mseedFile = waveform.mseed_path
-        LOGGER.debug("%s save as MiniSEED", waveform_id)
+def set_waveform_error(waveform: WaveformEntry, e: Exception):
+    """
+    Record an error on the waveform entry
+    """
+    # Most common error is "no data" TODO: see https://github.com/obspy/obspy/issues/1656
+    if str(e).startswith("No data"):
+        waveform.error = NO_DATA_ERROR
+        # Deselect when no data available
+        waveform.keep = False
+    else:
+        waveform.error = str(e)
 
-        (network, station, location, channel) = waveform.sncl.split(".")
 
-        # Load data from disk or network as appropriate
-        if os.path.exists(mseedFile):
-            LOGGER.info("Loading waveform data for %s from %s", waveform_id, mseedFile)
-            st = obspy.read(mseedFile)
+def write_metadata(inventory: Inventory, path, cache=None):
+    """
+    Write StationXML metadata to a cache file (compressed if the path is for a compressed file)
+    """
+    buf = io.BytesIO()
+    inventory.write(buf, format="STATIONXML")
+    write_file(path, buf.getvalue(), cache)
+
+
+def write_waveform_data(waveform: WaveformEntry, data):
+    """
+    Write raw MiniSEED data to a waveform's cache file
+    """
+    LOGGER.debug("Writing %s", waveform.mseed_path)
+    if waveform.compress_cache:
+        data = recompress_mseed(data)
+    with atomic_file(waveform.mseed_path, waveform.cache) as path:
+        with open(path, "wb") as f:
+            f.write(data)
+
+
+def read_waveform_data(waveform: WaveformEntry):
+    """
+    Read the raw MiniSEED data from a waveform's cache file
+
+    :return: the data, or None if the file couldn't be read (see `WaveformEntry.forget_file`)
+    """
+    try:
+        with open(waveform.mseed_path, "rb") as f:
+            return f.read()
+    except OSError as e:
+        waveform.forget_file(waveform.mseed_path, e)
+        return None
+
+
+class FetchGroup(object):
+    """
+    A single data request covering one or more waveforms on the same channel, see `RequestPlanner`
+    """
+
+    def __init__(
+        self, sncl, waveforms: List[WaveformEntry], segments: SegmentStore = None
+    ):
+        self.sncl = sncl
+        self.waveforms = waveforms
+        self.start_time = min(waveform.start_time for waveform in waveforms)
+        self.end_time = max(waveform.end_time for waveform in waveforms)
+        # Segment store for the data, if it can be stored in segments
+        if segments and segments.is_storable(self.end_time):
+            self.segments = segments
+            # Only the segments that aren't stored yet need to be requested
+            self.windows = segments.get_gaps(sncl, self.start_time, self.end_time)
         else:
-            service_url = get_service_url(
-                client,
-                "dataselect",
-                {
-                    "network": network,
-                    "station": station,
-                    "location": location,
-                    "channel": channel,
-                    "starttime": waveform.start_time,
-                    "endtime": waveform.end_time,
-                },
+            self.segments = None
+            self.windows = [(self.start_time, self.end_time)]
+        # Set when the request has finished (successfully or not)
+        self.done = threading.Event()
+        # Error if the request failed (not counting "no data")
+        self.error = None
+
+    def get_bulk_lines(self):
+        """
+        Get the FDSN bulk request lines (as tuples) for this group
+        """
+        (network, station, location, channel) = self.sncl.split(".")
+        # FDSN web services use "--" to indicate an empty location code
+        return [
+            (network, station, location or "--", channel, start_time, end_time)
+            for (start_time, end_time) in self.windows
+        ]
+
+    def write_data(self, data, records=None):
+        """
+        Split the raw MiniSEED data for this group into the cache file for each waveform. The
+        records are written exactly as they were received, without decoding them.
+
+        If the data can't be split up (eg. it isn't MiniSEED 2) it's decoded and sliced instead.
+
+        :param records: index of the records in the data (see `index_records`), if already known
+        :return: a dictionary of waveform_id -> data written (or None if it had to be decoded),
+            for the waveforms that had data
+        """
+        try:
+            if records is None:
+                records = index_records(data)
+        except ValueError as e:
+            LOGGER.warning(
+                "Couldn't split the data for %s (%s), decoding it instead", self.sncl, e
             )
-            LOGGER.info(
-                "Retrieving waveform data for %s from %s", waveform_id, service_url
+            return self.write_stream(obspy.read(io.BytesIO(data), format="MSEED"))
+        records = records.get(self.sncl, [])
+        if self.segments:
+            self.segments.store(self.sncl, self.windows, data, records)
+        written = {}
+        for waveform in self.waveforms:
+            check_cancelled()
+            if self.segments:
+                waveform_data = self.segments.read(
+                    self.sncl, waveform.start_time, waveform.end_time
+                )
+                if waveform_data is None:
+                    # A stored segment couldn't be read, so this isn't the same as no data
+                    raise Exception(
+                        "Stored data for %s is missing" % waveform.waveform_id
+                    )
+            else:
+                waveform_data = select_records(
+                    data,
+                    records,
+                    waveform.start_time.timestamp,
+                    waveform.end_time.timestamp,
+                )
+            if waveform_data:
+                write_waveform_data(waveform, waveform_data)
+                written[waveform.waveform_id] = waveform_data
+        return written
+
+    def write_stream(self, st: Stream):
+        """
+        Slice decoded data for this group into the cache file for each waveform.
+        Returns a dictionary of waveform_id -> None for the waveforms that had data.
+        """
+        written = {}
+        st = Stream([tr for tr in st if tr.id == self.sncl])
+        for waveform in self.waveforms:
+            check_cancelled()
+            wst = st.slice(waveform.start_time, waveform.end_time)
+            if len(wst):
+                LOGGER.debug("Writing %s", waveform.mseed_path)
+                with atomic_file(waveform.mseed_path, waveform.cache) as path:
+                    wst.write(path, format="MSEED")
+                written[waveform.waveform_id] = None
+        return written
+
+
+class RequestPlanner(object):
+    """
+    Plans the data requests for a set of waveforms, so that overlapping or adjacent time windows on
+    the same channel (eg. for events close together in time) are fetched with a single request.
+    The data is then sliced into each waveform's own file.
+
+    Planning happens as waveforms come up for download: the first one to come up claims all the
+    waveforms it can be merged with, and the others then use the files it writes.
+
+    If there is a `SegmentStore`, waveforms whose segments are all stored don't need a request at all,
+    and requests are only made for the missing segments. The stored segments are pinned in the
+    cache until the request is finished, since they're read back to make each waveform's file.
+    """
+
+    # Windows separated by no more than this (in seconds) are merged
+    merge_gap = 60
+    # Maximum length (in seconds) of a merged window
+    max_window = 4 * 3600
+    # Phase arrivals are at most this long (in seconds) after the event, this limits the search
+    # for waveforms that might be merged
+    max_arrival = 3600
+
+    def __init__(
+        self,
+        waveforms: List[WaveformEntry],
+        segments: SegmentStore = None,
+        arrivals: ExactArrivals = None,
+    ):
+        self.lock = threading.Lock()
+        self.segments = segments
+        # Any arrivals still being calculated, see `ExactArrivals`
+        self.arrivals = arrivals
+        # Groups whose requests haven't finished yet
+        self.groups = set()
+        if segments and segments.cache:
+            # Don't let the segments these requests read from be evicted
+            segments.cache.add_pins(self.get_pinned_paths)
+        # Waveforms for each channel, ordered by event time
+        self.waveforms_by_sncl = {}
+        for waveform in sorted(waveforms, key=lambda w: w.event_time):
+            self.waveforms_by_sncl.setdefault(waveform.sncl, []).append(waveform)
+        # The group that each claimed waveform belongs to
+        self.claims = {}
+
+    def find_candidates(self, waveform: WaveformEntry):
+        """
+        Find the unclaimed waveforms for the same channel with events close enough in time that
+        they could be merged with the given one.
+        """
+        earliest = waveform.end_time - self.max_window - self.max_arrival
+        latest = waveform.start_time + self.max_window
+        return [
+            other
+            for other in self.waveforms_by_sncl.get(waveform.sncl, [])
+            if other is not waveform
+            and other.waveform_id not in self.claims
+            and earliest <= other.event_time <= latest
+        ]
+
+    def plan(self, waveform: WaveformEntry):
+        """
+        Get the group that will fetch the data for the given waveform.
+
+        :return: a tuple of (group, claimed) where claimed is True if the caller now needs to make the
+            request, or False if the group was already claimed by someone else.
+        """
+        with self.lock:
+            group = self.claims.get(waveform.waveform_id)
+            if group:
+                return (group, False)
+            candidates = self.find_candidates(waveform)
+        # Calculating the time windows can be slow, so do it outside the lock
+        for other in candidates:
+            if not other.start_time:
+                if self.arrivals:
+                    self.arrivals.wait(other)
+                other.prepare()
+        with self.lock:
+            group = self.claims.get(waveform.waveform_id)
+            if group:
+                return (group, False)
+            members = [waveform]
+            member_ids = set([waveform.waveform_id])
+            start_time = waveform.start_time
+            end_time = waveform.end_time
+            # Keep extending the window to cover any waveforms that overlap it
+            candidates = sorted(
+                (
+                    other
+                    for other in candidates
+                    if other.waveform_id not in self.claims
+                    and not (other.mseed_exists or other.image_exists)
+                ),
+                key=lambda w: w.start_time,
             )
-            st = client.get_waveforms(
+            extended = True
+            while extended:
+                extended = False
+                for other in candidates:
+                    if (
+                        other.start_time <= end_time + self.merge_gap
+                        and other.end_time >= start_time - self.merge_gap
+                        and max(end_time, other.end_time)
+                        - min(start_time, other.start_time)
+                        <= self.max_window
+                    ):
+                        members.append(other)
+                        member_ids.add(other.waveform_id)
+                        start_time = min(start_time, other.start_time)
+                        end_time = max(end_time, other.end_time)
+                        extended = True
+                candidates = [
+                    other for other in candidates if other.waveform_id not in member_ids
+                ]
+            group = FetchGroup(waveform.sncl, members, self.segments)
+            self.groups.add(group)
+            for member in members:
+                self.claims[member.waveform_id] = group
+            if len(members) > 1:
+                LOGGER.debug(
+                    "Merged %d waveforms for %s into one request",
+                    len(members),
+                    waveform.sncl,
+                )
+            return (group, True)
+
+    def get_pinned_paths(self):
+        """
+        Get the paths of the segments that requests in progress will read from
+        """
+        with self.lock:
+            groups = [group for group in self.groups if group.segments]
+        return [
+            self.segments.get_path(group.sncl, segment)
+            for group in groups
+            for segment in self.segments.get_segments(group.start_time, group.end_time)
+        ]
+
+    def read_segments(self, waveform: WaveformEntry):
+        """
+        Get the data for a waveform from the segment store.
+
+        :return: the data, or None if it isn't all stored
+        """
+        if self.segments and self.segments.is_storable(waveform.end_time):
+            return self.segments.read(
+                waveform.sncl, waveform.start_time, waveform.end_time
+            )
+        return None
+
+    def finish(self, group: FetchGroup, error: Exception = None):
+        """
+        Mark the group's request as finished. If it failed, the waveforms are released so they can
+        be tried again on their own.
+        """
+        with self.lock:
+            group.error = error
+            self.groups.discard(group)
+            if error:
+                for member in group.waveforms:
+                    if self.claims.get(member.waveform_id) is group:
+                        del self.claims[member.waveform_id]
+        group.done.set()
+
+
+class WaveformJob(object):
+    """
+    A waveform on its way through the `WaveformsLoader` pipeline, along with any intermediate data.
+    """
+
+    def __init__(self, waveform: WaveformEntry):
+        self.waveform = waveform
+        # Raw MiniSEED data that was just downloaded, so the render stage doesn't need to read it
+        # back in
+        self.data = None
+
+
+def prepare_waveform(arrivals: ExactArrivals, job: WaveformJob):
+    """
+    Pipeline stage: calculate the time window and file paths, and see what work is needed.
+    """
+    waveform = job.waveform
+    LOGGER.debug("Preparing waveform: %s", waveform.waveform_id)
+    if arrivals:
+        arrivals.wait(waveform)
+    waveform.prepare()
+    if waveform.image_exists and (
+        not waveform.download_metadata or waveform.metadata_exists
+    ):
+        # No download needed
+        LOGGER.info("Waveform %s already complete" % waveform.waveform_id)
+        return True
+    return Pipeline.CONTINUE
+
+
+def fetch_group(client: Client, group: FetchGroup):
+    """
+    Download the data for one group with a regular GET request, and write it to the cache.
+    Returns a dictionary of waveform_id -> data (see `FetchGroup.write_data`).
+    """
+    (network, station, location, channel) = group.sncl.split(".")
+    # Get the raw response rather than a decoded Stream
+    buf = io.BytesIO()
+    for start_time, end_time in group.windows:
+        service_url = get_service_url(
+            client,
+            "dataselect",
+            {
+                "network": network,
+                "station": station,
+                "location": location,
+                "channel": channel,
+                "starttime": start_time,
+                "endtime": end_time,
+            },
+        )
+        LOGGER.info(
+            "Retrieving waveform data for %d waveform(s) from %s",
+            len(group.waveforms),
+            service_url,
+        )
+        try:
+            client.get_waveforms(
                 network,
                 station,
                 location,
                 channel,
-                waveform.start_time,
-                waveform.end_time,
+                start_time,
+                end_time,
+                filename=buf,
             )
-            # Write to file
-            st.write(mseedFile, format="MSEED")
-
-        # Retrieve metadata or load cached version
-        if waveform.download_metadata:
-            metadata_path = waveform.metadata_path
-            if not os.path.exists(metadata_path):
-                LOGGER.info("Retrieving metadata for %s", waveform_id)
-                inventory = client.get_stations(
-                    network=network,
-                    station=station,
-                    location=location,
-                    channel=channel,
-                    starttime=waveform.start_time,
-                    endtime=waveform.end_time,
-                    level="response",
-                )
-                # Write to file
-                inventory.write(metadata_path, format="STATIONXML")
-
-        # Generate image if necessary
-        imageFile = waveform.image_path
-        if not os.path.exists(imageFile):
-            LOGGER.debug("Plotting waveform image to %s", imageFile)
-            # In order to really customize the plotting, we need to return the figure and modify it
-            h = st.plot(size=(plot_width, plot_height), handle=True)
-            # Resize the subplot to a hard size, because otherwise it will do it inconsistently
-            h.subplots_adjust(bottom=0.2, left=0.1, right=0.95, top=0.95)
-            # Remove the title
-            for c in h.get_children():
-                if isinstance(c, matplotlib.text.Text):
-                    c.remove()
-            # Save with transparency
-            h.savefig(imageFile)
-            matplotlib.pyplot.close(h)
+        except Exception as e:
+            if not str(e).startswith("No data"):
+                raise
+    return group.write_data(buf.getvalue())
 
-        waveform.check_files()
 
-    except Exception as e:
-        # Most common error is "no data" TODO: see https://github.com/obspy/obspy/issues/1656
-        if str(e).startswith("No data"):
-            waveform.error = NO_DATA_ERROR
-            # Deselect when no data available
-            waveform.keep = False
+def fetch_groups(client: Client, planner: RequestPlanner, groups: List[FetchGroup]):
+    """
+    Download the data for the given groups. If there's more than one, they are requested together with
+    a single FDSN dataselect POST request.
+    Returns a dictionary of waveform_id -> data for the waveforms that had data.
+    """
+    written = {}
+    remaining = list(groups)
+    # A single group is better served by a regular GET
+    if len(groups) > 1:
+        bulk = [line for group in groups for line in group.get_bulk_lines()]
+        LOGGER.info(
+            "Retrieving waveform data for %d channel windows from %s",
+            len(bulk),
+            client.base_url,
+        )
+        try:
+            buf = io.BytesIO()
+            try:
+                # There may be nothing to request if all the segments are already stored
+                if bulk:
+                    client.get_waveforms_bulk(bulk, filename=buf)
+            except Exception as e:
+                if not str(e).startswith("No data"):
+                    raise
+            data = buf.getvalue()
+            # Index (or if necessary decode) the data once for all the groups
+            st = None
+            try:
+                records = index_records(data)
+            except ValueError as e:
+                LOGGER.warning(
+                    "Couldn't split the bulk data (%s), decoding it instead", e
+                )
+                st = obspy.read(io.BytesIO(data), format="MSEED")
+            for group in groups:
+                try:
+                    if st is None:
+                        written.update(group.write_data(data, records))
+                    else:
+                        written.update(group.write_stream(st))
+                    planner.finish(group)
+                except Exception as e:
+                    planner.finish(group, e)
+                    raise
+            remaining = []
+        except CancelledException:
+            raise
+        except Exception as e:
+            # Fall back to requesting the groups one at a time
+            LOGGER.warning("Bulk waveform request failed: %s", e)
+            remaining = [group for group in groups if not group.done.is_set()]
+
+    for group in remaining:
+        try:
+            written.update(fetch_group(client, group))
+            planner.finish(group)
+        except Exception as e:
+            planner.finish(group, e)
+    return written
+
+
+def fetch_waveforms(client: Client, planner: RequestPlanner, jobs: List[WaveformJob]):
+    """
+    Pipeline stage: get the data for a batch of waveforms that aren't already in the cache, using the
+    planner to merge requests for overlapping time windows (and any stored segments).
+    """
+    results = []
+    groups = []
+    to_fetch = []
+    waiting = []
+    for job in jobs:
+        waveform = job.waveform
+        if waveform.image_exists:
+            LOGGER.info("Waveform image for %s is cached", waveform.waveform_id)
+            results.append((job, Pipeline.CONTINUE))
+            continue
+        if waveform.mseed_exists:
+            # The data is read here rather than when rendering, so if the file is gone it can still
+            # be fetched again
+            job.data = read_waveform_data(waveform)
+            if job.data is not None:
+                LOGGER.info("Waveform data for %s is cached", waveform.waveform_id)
+                results.append((job, Pipeline.CONTINUE))
+                continue
+        data = planner.read_segments(waveform)
+        if data is not None:
+            LOGGER.info(
+                "Waveform data for %s is in stored segments", waveform.waveform_id
+            )
+            if data:
+                write_waveform_data(waveform, data)
+                job.data = data
+                results.append((job, Pipeline.CONTINUE))
+            else:
+                results.append((job, Exception(NO_DATA_ERROR)))
+            continue
+        (group, claimed) = planner.plan(waveform)
+        if claimed:
+            groups.append(group)
+        if group in groups:
+            to_fetch.append((job, group))
         else:
-            waveform.error = str(e)
-        # Reraise the exception to signal an error to the caller
-        raise
+            # Another worker is fetching this one
+            waiting.append((job, group))
 
+    try:
+        written = fetch_groups(client, planner, groups)
     finally:
-        # Mark as finished loading
-        waveform.loading = False
+        # Make sure nothing is left waiting on these
+        for group in groups:
+            if not group.done.is_set():
+                planner.finish(group, CancelledException())
+    for job, group in to_fetch:
+        if job.waveform.waveform_id in written:
+            job.data = written[job.waveform.waveform_id]
+            results.append((job, Pipeline.CONTINUE))
+        else:
+            results.append((job, group.error or Exception(NO_DATA_ERROR)))
 
+    for job, group in waiting:
+        waveform = job.waveform
+        while not group.done.wait(POLL_INTERVAL):
+            check_cancelled()
+        waveform.check_files()
+        if waveform.mseed_exists:
+            results.append((job, Pipeline.CONTINUE))
+        elif group.error:
+            # Try again on its own
+            results.extend(fetch_waveforms(client, planner, [job]))
+        else:
+            results.append((job, Exception(NO_DATA_ERROR)))
+
+    return results
+
+
+def render_waveform(job: WaveformJob):
+    """
+    Pipeline stage: generate the waveform image if necessary.
+    """
+    waveform = job.waveform
+    imageFile = waveform.image_path
+    if not waveform.file_exists(imageFile):
+        # This is the only place the samples are needed, so the data is decoded here
+        try:
+            if job.data is not None:
+                st = obspy.read(io.BytesIO(job.data), format="MSEED")
+            else:
+                LOGGER.info(
+                    "Loading waveform data for %s from %s",
+                    waveform.waveform_id,
+                    waveform.mseed_path,
+                )
+                st = obspy.read(waveform.mseed_path)
+        except Exception as e:
+            # Don't leave unreadable data in the cache
+            waveform.forget_file(waveform.mseed_path, e)
+            raise
+        # The cached data is whole records, which can extend outside the time window
+        st.trim(waveform.start_time, waveform.end_time)
+        LOGGER.debug("Plotting waveform image to %s", imageFile)
+        with atomic_file(imageFile, waveform.cache) as path:
+            write_thumbnail(st, path)
+    # Don't hold on to the data any longer than needed
+    job.data = None
+    return Pipeline.CONTINUE
+
+
+def load_waveform_metadata(
+    client: Client, metadata_futures: List[concurrent.futures.Future], job: WaveformJob
+):
+    """
+    Pipeline stage: make sure the metadata is available, this is normally loaded in bulk by
+    `load_metadata_bulk` but if that failed for any reason try to load it for this waveform alone.
+    """
+    waveform = job.waveform
+    if waveform.download_metadata:
+        # Wait for the bulk metadata request(s)
+        concurrent.futures.wait(metadata_futures)
+        metadata_path = waveform.metadata_path
+        if not waveform.file_exists(metadata_path):
+            LOGGER.info("Retrieving metadata for %s", waveform.waveform_id)
+            (network, station, location, channel) = waveform.sncl.split(".")
+            inventory = client.get_stations(
+                network=network,
+                station=station,
+                location=location,
+                channel=channel,
+                starttime=waveform.start_time,
+                endtime=waveform.end_time,
+                level="response",
+            )
+            # Write to file
+            write_metadata(inventory, metadata_path, waveform.cache)
+    waveform.check_files()
     return True
 
 
 class WaveformsLoader(SignalingThread):
     """
     Thread to download waveform data and generate an image
+
+    The work is done in a `Pipeline` with separate stages for preparing, downloading, rendering, and
+    checking metadata, so that CPU-bound work doesn't hold up the network requests (or vice versa).
+
+    Waveforms wait to enter the pipeline in a `PriorityQueue`, so they can be reordered with
+    `prioritize` while the download is running.
     """
 
+    # Emits a list of `WaveformResult` for the waveforms finished since the last report
     progress = QtCore.pyqtSignal(object)
+    # Periodic report of the pipeline state, see `Pipeline.depths`
+    status = QtCore.pyqtSignal(object)
+
+    # How often (in seconds) to report finished waveforms
+    progress_interval = 0.1
+    # How often (in seconds) to report the pipeline state
+    status_interval = 0.5
+
+    # Priority tiers, see `prioritize`
+    PRIORITY_FIRST = 0
+    PRIORITY_NEXT = 1
+    PRIORITY_NORMAL = 2
 
     def __init__(
-        self, client: Client, waveforms: List[WaveformEntry], thread_pool_size: int
+        self,
+        client: Client,
+        waveforms: List[WaveformEntry],
+        thread_pool_size: int,
+        bulk_size: int = 1,
+        cpu_pool_size: int = 2,
+        segments: SegmentStore = None,
+        arrivals: ExactArrivals = None,
     ):
         """
         Initialization.
+
+        :param thread_pool_size: number of workers for network requests (if the client has a
+            concurrency limiter, that controls the number of fetch workers instead)
+        :param bulk_size: maximum number of waveforms to request in a single dataselect POST
+        :param cpu_pool_size: number of workers for rendering images
+        :param segments: store for the downloaded data, see `SegmentStore`
+        :param arrivals: calculates any missing arrivals alongside the pipeline
         """
         # Keep a reference to globally shared components
         self.client = client
         self.waveforms = waveforms
-        self.thread_pool_size = thread_pool_size
-        self.futures = {}
+        self.thread_pool_size = max(thread_pool_size, 1)
+        self.bulk_size = max(bulk_size, 1)
+        self.cpu_pool_size = max(cpu_pool_size, 1)
+        self.segments = segments
+        self.arrivals = arrivals
+        self.pipeline = None
+        self.queue = PriorityQueue(key=lambda job: job.waveform.waveform_id)
+        # Original position of each waveform, this orders waveforms within a priority tier
+        self.order = dict(
+            (waveform.waveform_id, i) for i, waveform in enumerate(waveforms)
+        )
+        # Waveforms currently given a higher priority than normal
+        self.promoted = set()
+        self.priority_lock = threading.Lock()
+        # Cancels all the work done for this loader
+        self.token = CancelToken()
         super(WaveformsLoader, self).__init__()
 
+    def prioritize(self, first_ids, next_ids=()):
+        """
+        Change the order in which waiting waveforms are loaded. This can be called from any thread.
+
+        :param first_ids: waveforms to load first, in this order
+        :param next_ids: waveforms to load after those (in their original order), all others go
+            back to their original order after that
+        """
+        with self.priority_lock:
+            priorities = {}
+            for i, waveform_id in enumerate(first_ids):
+                priorities[waveform_id] = (self.PRIORITY_FIRST, i)
+            for waveform_id in next_ids:
+                if waveform_id not in priorities:
+                    priorities[waveform_id] = (
+                        self.PRIORITY_NEXT,
+                        self.order.get(waveform_id, 0),
+                    )
+            promoted = set(priorities)
+            for waveform_id in self.promoted.difference(promoted):
+                priorities[waveform_id] = (
+                    self.PRIORITY_NORMAL,
+                    self.order.get(waveform_id, 0),
+                )
+            self.promoted = promoted
+            self.queue.set_priorities(priorities)
+
+    def cancellable(self, fn, *args):
+        """
+        Wrap a function (with any leading arguments) so it runs under this loader's `CancelToken`
+        """
+        return functools.partial(call_with_token, self.token, fn, *args)
+
+    def create_pipeline(self, metadata_futures):
+        """
+        Create the pipeline for processing the waveforms
+        """
+        # Enough queued up to keep all the network workers busy with full batches
+        fetch_queue_size = self.thread_pool_size * self.bulk_size * 2
+        # Merges the requests for overlapping time windows
+        planner = RequestPlanner(self.waveforms, self.segments, self.arrivals)
+        # With a concurrency limiter, the client limits the requests in flight (each request takes a
+        # slot) so there are enough workers to reach the limiter's maximum
+        fetch_workers = get_worker_count(self.client, self.thread_pool_size)
+        return Pipeline(
+            [
+                Stage(
+                    "prepare",
+                    self.cancellable(prepare_waveform, self.arrivals),
+                    stage_queue=self.queue,
+                ),
+                Stage(
+                    "fetch",
+                    self.cancellable(fetch_waveforms, self.client, planner),
+                    workers=fetch_workers,
+                    queue_size=fetch_queue_size,
+                    batch_size=self.bulk_size,
+                    batched=True,
+                    linger=0.1 if self.bulk_size > 1 else 0,
+                ),
+                Stage(
+                    "render",
+                    self.cancellable(render_waveform),
+                    workers=self.cpu_pool_size,
+                    queue_size=self.cpu_pool_size * 4,
+                ),
+                Stage(
+                    "metadata",
+                    self.cancellable(
+                        load_waveform_metadata, self.client, metadata_futures
+                    ),
+                    workers=self.thread_pool_size,
+                    queue_size=self.thread_pool_size * 4,
+                ),
+            ]
+        )
+
     def run(self):
         """
         Make a webservice request for waveform data using the passed in options.
         """
         self.setPriority(QtCore.QThread.LowestPriority)
-        self.clearFutures()
-        self.futures = {}
-        with concurrent.futures.ThreadPoolExecutor(self.thread_pool_size) as executor:
+        # Any missing arrivals are calculated alongside the pipeline, see `ExactArrivals`
+        arrivals_executor = concurrent.futures.ThreadPoolExecutor(1)
+        if self.arrivals:
+            arrivals_executor.submit(self.cancellable(self.arrivals.run))
+        with concurrent.futures.ThreadPoolExecutor(
+            self.thread_pool_size
+        ) as metadata_executor:
+            # Metadata is fetched in bulk alongside the pipeline, so it can be shared by all the
+            # waveforms in each channel epoch
+            epoch_groups = group_metadata_epochs(self.waveforms)
+            if epoch_groups:
+                LOGGER.info("Loading metadata for %d channel epochs", len(epoch_groups))
+            metadata_futures = [
+                metadata_executor.submit(
+                    self.cancellable(load_metadata_bulk),
+                    self.client,
+                    epoch_groups[i : i + self.bulk_size],
+                )
+                for i in range(0, len(epoch_groups), self.bulk_size)
+            ]
+
+            self.pipeline = self.create_pipeline(metadata_futures)
             for waveform in self.waveforms:
-                # Dictionary to look up the waveform id by Future
-                self.futures[executor.submit(load_waveform, self.client, waveform)] = (
-                    waveform.waveform_id
+                self.queue.put(
+                    WaveformJob(waveform),
+                    priority=(
+                        self.PRIORITY_NORMAL,
+                        self.order[waveform.waveform_id],
+                    ),
                 )
-            # Iterate through Futures as they complete
-            for result in concurrent.futures.as_completed(self.futures):
-                waveform_id = self.futures.get(result)
-                if waveform_id:
-                    LOGGER.debug("Loader finished: %s", waveform_id)
-                    try:
-                        self.progress.emit(WaveformResult(waveform_id, result.result()))
-                    except Exception as e:
-                        self.progress.emit(WaveformResult(waveform_id, e))
-        self.futures = {}
+            self.pipeline.start()
+
+            remaining = len(self.waveforms)
+            last_status = 0
+            # Results are reported in batches, so the GUI isn't flooded with one update per waveform
+            results = []
+            last_progress = time.monotonic()
+            while remaining and not self.pipeline.stopped.is_set():
+                finished = self.pipeline.get_result(timeout=self.progress_interval)
+                if finished:
+                    remaining -= 1
+                    (job, result) = finished
+                    waveform = job.waveform
+                    LOGGER.debug("Loader finished: %s", waveform.waveform_id)
+                    if isinstance(result, Exception):
+                        set_waveform_error(waveform, result)
+                    # Mark as finished loading
+                    waveform.loading = False
+                    results.append(WaveformResult(waveform.waveform_id, result))
+                if results and (
+                    not remaining
+                    or time.monotonic() - last_progress > self.progress_interval
+                ):
+                    last_progress = time.monotonic()
+                    self.progress.emit(results)
+                    results = []
+                if time.monotonic() - last_status > self.status_interval:
+                    last_status = time.monotonic()
+                    depths = self.pipeline.depths()
+                    LOGGER.debug("Waveform pipeline: %s", depths)
+                    self.status.emit(depths)
+            self.pipeline.stop()
+        arrivals_executor.shutdown()
         self.done.emit(None)
 
-    def clearFutures(self):
-        """
-        Cancel any outstanding tasks
-        """
-        if self.futures:
-            for future in self.futures:
-                if not future.done():
-                    LOGGER.debug("Cancelling unexecuted future")
-                    future.cancel()
-
     def cancel(self):
         """
         User-requested cancel
         """
         self.done.disconnect()
         self.progress.disconnect()
-        self.clearFutures()
+        self.status.disconnect()
+        # Stop any requests in progress, and anything not started yet
+        self.token.cancel()
+        if self.pipeline:
+            self.pipeline.stop()
+
+
+class SaveJob(object):
+    """
+    Everything needed to save one waveform, as plain values so it can be passed to a worker process
+    """
+
+    def __init__(self, waveform_id, mseed_path, start_time=None, end_time=None):
+        self.waveform_id = waveform_id
+        self.mseed_path = mseed_path
+        # Time window to trim the data to when converting it
+        self.start_time = start_time
+        self.end_time = end_time
+        # Waveform output, if it needs to be saved
+        self.output_path = None
+        self.output_format = None
+        # SAC headers (see `get_sac_headers`) if saving in a SAC format
+        self.sac_headers = None
+        # Metadata output, if it needs to be saved
+        self.metadata_path = None
+        self.md_path = None
+        self.md_format = None
+
+
+def get_sac_headers(waveform: WaveformEntry, use_event_time=False):
+    """
+    Get the SAC metadata headers for a waveform, as a list of (name, value) pairs. These need to be
+    set in order, since setting `reftime` shifts the relative times set before it.
+    """
+    headers = [("kevnm", waveform.event_description[:16])]
+    event = waveform.event_ref()
+    origin = None
+    if not event:
+        LOGGER.warning("Lost reference to event %s", waveform.event_description)
+    else:
+        origin = get_preferred_origin(event)
+        if origin:
+            headers.extend(
+                [
+                    ("evla", origin.latitude),
+                    ("evlo", origin.longitude),
+                    ("evdp", origin.depth / 1000),
+                    ("o", origin.time - waveform.start_time),
+                ]
+            )
+            # Use event time as the reftime?
+            if use_event_time:
+                headers.extend(
+                    [
+                        ("reftime", origin.time),  # ObsPy does a lot of work here!
+                        ("iztype", "io"),
+                    ]
+                )
+        magnitude = get_preferred_magnitude(event)
+        if magnitude:
+            headers.append(("mag", magnitude.mag))
+    channel = waveform.channel_ref()
+    if not channel:
+        LOGGER.warning("Lost reference to channel %s", waveform.sncl)
+    else:
+        headers.extend(
+            [
+                ("stla", channel.latitude),
+                ("stlo", channel.longitude),
+                ("stdp", channel.depth),
+                ("stel", channel.elevation),
+                ("cmpaz", channel.azimuth),
+                ("cmpinc", channel.dip + 90),
+                (
+                    "kinst",
+                    channel.sensor.description[:8] if channel.sensor else "Unknown",
+                ),
+            ]
+        )
+    if origin and channel:
+        # Calculate distances/azimuths
+        headers.append(("lcalda", True))
+    return headers
+
+
+def save_waveform(job: SaveJob):
+    """
+    Save one waveform and/or its metadata. This is a standalone function so it can run in a
+    worker process.
+
+    The cached files are already MiniSEED and StationXML, so saving in either of those formats
+    just copies the file (see `link_or_copy`), unless the StationXML is compressed.
+
+    :return: True if the waveform was saved, False if only the metadata was
+    """
+    if job.output_path and job.output_format == "MSEED":
+        LOGGER.debug(
+            "%s to %s",
+            link_or_copy(job.mseed_path, job.output_path),
+            job.output_path,
+        )
+    elif job.output_path:
+        LOGGER.debug("reading %s", job.mseed_path)
+        st = obspy.read(job.mseed_path)
+        # The cached data is whole records, which can extend outside the time window
+        if job.start_time and job.end_time:
+            st.trim(job.start_time, job.end_time)
+        if job.sac_headers is not None:
+            tr = SACTrace.from_obspy_trace(st[0])
+            for name, value in job.sac_headers:
+                setattr(tr, name, value)
+            st = Stream([tr.to_obspy_trace()])
+        LOGGER.debug("writing %s", job.output_path)
+        with atomic_file(job.output_path) as path:
+            st.write(path, format=job.output_format)
+    if job.md_path and job.md_format == "STATIONXML":
+        if is_compressed(job.metadata_path):
+            LOGGER.debug("decompressing to %s", job.md_path)
+            decompress_file(job.metadata_path, job.md_path)
+        else:
+            LOGGER.debug(
+                "%s to %s", link_or_copy(job.metadata_path, job.md_path), job.md_path
+            )
+    elif job.md_path:
+        LOGGER.debug("reading %s", job.metadata_path)
+        with open_file(job.metadata_path) as f:
+            inventory = obspy.read_inventory(f, format="STATIONXML")
+        with atomic_file(job.md_path) as path:
+            inventory.write(path, format=job.md_format)
+    return bool(job.output_path)
+
+
+class WaveformsSaver(SignalingThread):
+    """
+    Thread to save waveforms in an output format.
+
+    Reading, converting and writing the files is CPU-bound, so the work is done in a pool of
+    worker processes.
+    """
+
+    # Emits a list of `WaveformResult` for the waveforms saved since the last report, the result
+    # values are True (saved), False (already saved), or Exception (error)
+    progress = QtCore.pyqtSignal(object)
+
+    # How often (in seconds) to report saved waveforms
+    progress_interval = 0.1
+    # Number of jobs to keep queued for each process
+    jobs_per_process = 4
+
+    def __init__(
+        self,
+        jobs: List[SaveJob],
+        results: List[WaveformResult],
+        processes,
+        cache: CacheIndex = None,
+    ):
+        """
+        :param jobs: the waveforms to save
+        :param results: results for the waveforms that didn't need saving
+        :param processes: number of worker processes
+        :param cache: `CacheIndex` for the cached files being saved
+        """
+        super(WaveformsSaver, self).__init__()
+        self.jobs = jobs
+        self.results = results
+        self.processes = max(processes, 1)
+        self.cache = cache
+        self.token = CancelToken()
+
+    def run(self):
+        results = list(self.results)
+        last_progress = time.monotonic()
+        jobs = iter(self.jobs)
+        futures = {}
+        with concurrent.futures.ProcessPoolExecutor(self.processes) as executor:
+            while not self.token.cancelled:
+                # Only submit a few jobs at a time, so cancelling doesn't have to unwind a long queue
+                for job in itertools.islice(
+                    jobs, self.processes * self.jobs_per_process - len(futures)
+                ):
+                    futures[executor.submit(save_waveform, job)] = job
+                if not futures:
+                    break
+                (finished, _pending) = concurrent.futures.wait(
+                    futures,
+                    timeout=self.progress_interval,
+                    return_when=concurrent.futures.FIRST_COMPLETED,
+                )
+                for future in finished:
+                    job = futures.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        LOGGER.error(
+                            "Failed to save waveform %s: %s", job.waveform_id, e
+                        )
+                        result = e
+                        if (
+                            self.cache
+                            and isinstance(e, FileNotFoundError)
+                            and e.filename in (job.mseed_path, job.metadata_path)
+                            and not os.path.exists(e.filename)
+                        ):
+                            # The cached file is gone, remove it from the cache so it's fetched
+                            # again by the next download
+                            self.cache.remove(e.filename)
+                    results.append(WaveformResult(job.waveform_id, result))
+                if results and (
+                    not futures
+                    or time.monotonic() - last_progress > self.progress_interval
+                ):
+                    last_progress = time.monotonic()
+                    self.progress.emit(results)
+                    results = []
+            if self.token.cancelled:
+                LOGGER.info("Save cancelled")
+                executor.shutdown(cancel_futures=True)
+        if results and not self.token.cancelled:
+            self.progress.emit(results)
+        self.done.emit(CancelledException() if self.token.cancelled else None)
+
+    def cancel(self):
+        """
+        User-requested cancel, files already being written are finished
+        """
+        self.token.cancel()
 
 
 class WaveformsHandler(SignalingObject):
@@ -374,7 +1487,14 @@ class WaveformsHandler(SignalingObject):
     the size of the visible table.
     """
 
+    # Relays `WaveformsLoader.progress`, a list of `WaveformResult`
     progress = QtCore.pyqtSignal(object)
+    # Relays `WaveformsLoader.status`
+    status = QtCore.pyqtSignal(object)
+    # Relays `WaveformsSaver.progress`
+    save_progress = QtCore.pyqtSignal(object)
+    # Emitted when a save finishes, with None or an Exception
+    save_done = QtCore.pyqtSignal(object)
 
     def __init__(self, logger, pyweed):
         """
@@ -388,16 +1508,26 @@ class WaveformsHandler(SignalingObject):
         # Important preferences
         self.downloadDir = self.pyweed.preferences.Waveforms.downloadDir
         self.download_metadata = self.pyweed.preferences.Waveforms.downloadMetadata
+        self.compress_cache = safe_bool(
+            self.pyweed.preferences.Waveforms.compressCache, False
+        )
+        self.cache_index = self.pyweed.get_cache_index()
+        # Don't let the files for the current waveforms be evicted
+        self.cache_index.add_pins(self.get_cached_files)
 
         # Loader component
         self.waveforms_loader = None
         # Thread to run the loader in
         self.thread = None
+        # Save component
+        self.waveforms_saver = None
         # Asynchronous requests, each is working to download a single waveform
         self.requests = None
 
         # A TimeWindow object giving offsets and phase arrivals
         self.time_window = TimeWindow()
+        # Memo of arrivals calculated with TauP, see `get_arrivals_memo`
+        self.arrivals_memo = None
 
         # Current list of waveform entries
         self.waveforms = None
@@ -409,17 +1539,36 @@ class WaveformsHandler(SignalingObject):
         Create a list of waveform entries based on the current event/station selections
         """
         self.waveforms = [
-            WaveformEntry(event, network, station, channel)
+            WaveformEntry(
+                self.pyweed.event_table, event_row, network, station, channel, distance
+            )
             for (
-                event,
+                event_row,
                 network,
                 station,
                 channel,
+                distance,
             ) in self.pyweed.iter_selected_events_stations()
         ]
         self.waveforms_by_id = dict(
             (waveform.waveform_id, waveform) for waveform in self.waveforms
         )
+        # Any arrivals that aren't in the table are calculated while downloading, see `ExactArrivals`
+        if not safe_bool(self.pyweed.preferences.Waveforms.exactArrivals, False):
+            set_table_arrivals(self.waveforms)
+
+    def get_arrivals_memo(self):
+        """
+        Get the memo of calculated arrivals, opening it if necessary
+        """
+        if not self.arrivals_memo:
+            try:
+                self.arrivals_memo = open_memo(
+                    os.path.join(user_config_path(), MEMO_FILENAME)
+                )
+            except Exception as e:
+                LOGGER.error("Couldn't open the arrivals memo: %s", e)
+        return self.arrivals_memo
 
     def cancel_download(self):
         """
@@ -429,12 +1578,15 @@ class WaveformsHandler(SignalingObject):
         if self.waveforms_loader:
             self.waveforms_loader.cancel()
         # Mark all the waveforms that are still marked as loading
+        results = []
         for waveform in self.waveforms:
             if waveform.loading:
                 waveform.loading = False
                 waveform.error = "Cancelled download"
                 LOGGER.debug("Manually marking %s as cancelled", waveform.waveform_id)
-                self.progress.emit(WaveformResult(waveform.waveform_id, None))
+                results.append(WaveformResult(waveform.waveform_id, None))
+        if results:
+            self.progress.emit(results)
         self.done.emit(CancelledException())
 
     def download_waveforms(
@@ -444,8 +1596,8 @@ class WaveformsHandler(SignalingObject):
         Initiate a download of all the given waveforms
         """
         LOGGER.info("Downloading waveforms")
-        LOGGER.debug("Priority IDs: %s" % (priority_ids,))
-        LOGGER.debug("Other IDs: %s" % (other_ids,))
+        LOGGER.debug("Priority IDs: %s", priority_ids)
+        LOGGER.debug("Other IDs: %s", other_ids)
 
         # Prepare the waveform entries
         self.time_window = time_window
@@ -462,21 +1614,35 @@ class WaveformsHandler(SignalingObject):
 
         # Create a worker to load the data in separate threads
         thread_pool_size = safe_int(self.pyweed.preferences.Waveforms.threads, 5)
+        bulk_size = safe_int(self.pyweed.preferences.Waveforms.bulkSize, 50)
+        cpu_pool_size = safe_int(self.pyweed.preferences.Waveforms.renderThreads, 2)
+        segment_length = safe_int(self.pyweed.preferences.Waveforms.segmentLength, 600)
+        segments = None
+        if segment_length > 0:
+            segments = SegmentStore(
+                self.downloadDir, self.cache_index, segment_length, self.compress_cache
+            )
         self.waveforms_loader = WaveformsLoader(
-            self.pyweed.client_manager.dataselect_client, waveforms, thread_pool_size
+            self.pyweed.client_manager.dataselect_client,
+            waveforms,
+            thread_pool_size,
+            bulk_size,
+            cpu_pool_size,
+            segments,
+            ExactArrivals(waveforms, self.get_arrivals_memo()),
         )
         self.waveforms_loader.progress.connect(self.on_downloaded)
+        self.waveforms_loader.status.connect(self.status.emit)
         self.waveforms_loader.done.connect(self.on_all_downloaded)
         self.waveforms_loader.start()
 
-    def on_downloaded(self, result):
+    def on_downloaded(self, results):
         """
-        Called for each downloaded waveform.
+        Called for each batch of downloaded waveforms.
 
-        :param result: a `WaveformResult`
+        :param results: a list of `WaveformResult`
         """
-        # LOGGER.debug("Downloaded waveform %s (%s)", result.waveform_id, QtCore.QThread.currentThreadId())
-        self.progress.emit(result)
+        self.progress.emit(results)
 
     def on_all_downloaded(self, result):
         LOGGER.debug("All waveforms downloaded  (%s)", QtCore.QThread.currentThreadId())
@@ -486,17 +1652,41 @@ class WaveformsHandler(SignalingObject):
             LOGGER.debug("Download thread exited")
         self.done.emit(result)
 
+    def prioritize_waveforms(self, first_ids, next_ids=()):
+        """
+        Change the order of the waveforms still waiting to be downloaded, see
+        `WaveformsLoader.prioritize`
+        """
+        if self.waveforms_loader:
+            self.waveforms_loader.prioritize(first_ids, next_ids)
+
+    def get_cached_files(self):
+        """
+        Get the paths of all the cache files used by the current waveforms
+        """
+        paths = []
+        for waveform in self.waveforms or ():
+            for path in (
+                waveform.mseed_path,
+                waveform.image_path,
+                waveform.metadata_path,
+            ):
+                if path:
+                    paths.append(path)
+        return paths
+
     def get_waveform(self, waveform_id):
         """
         Retrieve the Series for the given waveform
         """
         return self.waveforms_by_id.get(waveform_id)
 
-    def save_waveforms_iter(self, base_output_path, output_format, waveforms):
+    def get_save_jobs(self, base_output_path, output_format, waveforms, use_event_time):
         """
-        Save waveforms, returning an iterator of WaveformResult objects whose values are
-        True (saved), False (already saved), or Exception (error)
-        This is so the GUI layer can handle save progress and errors in its own fashion
+        Work out what needs to be done to save the given waveforms
+
+        :return: a tuple of (list of `SaveJob`, list of `WaveformResult` for waveforms that don't
+            need saving)
         """
         if not os.path.exists(base_output_path):
             try:
@@ -519,86 +1709,100 @@ class WaveformsHandler(SignalingObject):
         )
         md_extension = METADATA_FORMAT_EXTENSIONS[md_format]
 
+        # Don't repeat any work that has already been done, listing the directory once is much
+        # faster than checking for each file
+        existing = set(os.listdir(base_output_path))
+
+        jobs = []
+        results = []
         for waveform in waveforms:
             waveform_id = waveform.waveform_id
             try:
+                job = SaveJob(
+                    waveform_id,
+                    waveform.mseed_path,
+                    waveform.start_time,
+                    waveform.end_time,
+                )
                 output_file = os.path.extsep.join((waveform.base_filename, extension))
-                output_path = os.path.join(base_output_path, output_file)
-                # Don't repeat any work that has already been done
-                save_file = not os.path.exists(output_path)
-                if save_file:
-                    LOGGER.debug("reading %s", waveform.mseed_path)
-                    st = obspy.read(waveform.mseed_path)
-                    self.save_waveform(st, output_path, output_format, waveform)
+                if output_file not in existing:
+                    job.output_path = os.path.join(base_output_path, output_file)
+                    job.output_format = output_format
+                    if output_format in (
+                        "SAC",
+                        "SACXY",
+                    ):
+                        # For SAC output, we need to pull header data from the waveform record
+                        job.sac_headers = get_sac_headers(waveform, use_event_time)
                 # Do the metadata if needed
                 if waveform.metadata_exists:
                     md_file = os.path.extsep.join(
                         (waveform.base_filename, md_extension)
                     )
-                    md_path = os.path.join(base_output_path, md_file)
-                    save_md = not os.path.exists(md_path)
-                    if save_md:
-                        LOGGER.debug("reading %s", waveform.metadata_path)
-                        inventory = obspy.read_inventory(waveform.metadata_path)
-                        inventory.write(md_path, format=md_format)
-
-                yield WaveformResult(waveform_id, save_file)
+                    if md_file not in existing:
+                        job.metadata_path = waveform.metadata_path
+                        job.md_path = os.path.join(base_output_path, md_file)
+                        job.md_format = md_format
+                if job.output_path or job.md_path:
+                    jobs.append(job)
+                else:
+                    results.append(WaveformResult(waveform_id, False))
             except Exception as e:
                 LOGGER.error("Failed to save waveform %s", e, exc_info=True)
-                yield WaveformResult(waveform_id, e)
+                results.append(WaveformResult(waveform_id, e))
+        return (jobs, results)
 
-    def save_waveform(self, st, output_path, output_format, waveform):
+    def save_waveforms(
+        self, base_output_path, output_format, waveforms, use_event_time=False
+    ):
         """
-        Save a single waveform. This should handle any special output features (eg. SAC metadata)
+        Start saving waveforms in the background. Results are reported through `save_progress`
+        and `save_done`.
+
+        :param use_event_time: for SAC output, use the event time as the reference time
         """
-        LOGGER.debug("writing %s", output_path)
-        if output_format in (
-            "SAC",
-            "SACXY",
-        ):
-            # For SAC output, we need to pull header data from the waveform record
-            st = self.to_sac_stream(st, waveform)
-        st.write(output_path, format=output_format)
+        self.cancel_save()
+        (jobs, results) = self.get_save_jobs(
+            base_output_path, output_format, waveforms, use_event_time
+        )
+        processes = (
+            safe_int(self.pyweed.preferences.Waveforms.saveProcesses, 0)
+            or os.cpu_count()
+            or 1
+        )
+        LOGGER.info(
+            "Saving %d waveforms in %d processes (%d already saved)",
+            len(jobs),
+            processes,
+            len(results),
+        )
+        self.waveforms_saver = WaveformsSaver(
+            jobs, results, processes, self.cache_index
+        )
+        self.waveforms_saver.progress.connect(self.save_progress.emit)
+        self.waveforms_saver.done.connect(
+            functools.partial(self.on_all_saved, self.waveforms_saver)
+        )
+        self.waveforms_saver.start()
+
+    def on_all_saved(self, saver, result):
+        saver.wait()
+        # Ignore a save that was replaced by a newer one
+        if saver is self.waveforms_saver:
+            self.waveforms_saver = None
+            self.save_done.emit(result)
 
-    def to_sac_stream(self, st, waveform):
+    def cancel_save(self):
         """
-        Return a SACTrace based on the given stream, containing metadata headers from the waveform
+        Cancel the save if it's running, waiting for any files being written to finish
         """
-        tr = SACTrace.from_obspy_trace(st[0])
-        tr.kevnm = waveform.event_description[:16]
-        event = waveform.event_ref()
-        origin = None
-        if not event:
-            LOGGER.warn("Lost reference to event %s", waveform.event_description)
-        else:
-            origin = get_preferred_origin(waveform.event_ref())
-            if origin:
-                tr.evla = origin.latitude
-                tr.evlo = origin.longitude
-                tr.evdp = origin.depth / 1000
-                tr.o = origin.time - waveform.start_time
-                # Use event time as the reftime?
-                if self.pyweed.preferences.Waveforms.useEventTime:
-                    tr.reftime = origin.time  # ObsPy does a lot of work here!
-                    tr.iztype = "io"
-            magnitude = get_preferred_magnitude(waveform.event_ref())
-            if magnitude:
-                tr.mag = magnitude.mag
-        channel = waveform.channel_ref()
-        if not channel:
-            LOGGER.warn("Lost reference to channel %s", waveform.sncl)
-        else:
-            tr.stla = channel.latitude
-            tr.stlo = channel.longitude
-            tr.stdp = channel.depth
-            tr.stel = channel.elevation
-            tr.cmpaz = channel.azimuth
-            tr.cmpinc = channel.dip + 90
-            tr.kinst = channel.sensor.description[:8] if channel.sensor else "Unknown"
-        if origin and channel:
-            # Calculate distances/azimuths
-            tr.lcalda = True
-        return Stream([tr.to_obspy_trace()])
+        saver = self.waveforms_saver
+        if saver:
+            LOGGER.debug("Cancelling save")
+            saver.cancel()
+            saver.wait()
+            self.waveforms_saver = None
+            self.save_done.emit(CancelledException())
 
 
 # ------------------------------------------------------------------------------